@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+"""
+Backend connections pool - Bounded number of SQream connections, reused by the sessions
+Each session checks out a backend connection when its Startup message arrives, and parks it back in the pool when
+the client disconnects or resets the session (DISCARD ALL), so sessions do not share a connection, and a reconnect
+storm cannot open more backend connections than BACKEND_POOL_MAX_CONNECTIONS.
+Parked connections are kept by their key - The parameters they connect with, e.g. (host, port, database, user) - and
+handed to the next session of the same key, so PowerBI's session churn (close, reopen with a new Startup) costs a dictionary lookup
+instead of a backend login. Up to BACKEND_POOL_MAX_IDLE connections are parked, over all the keys.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import threading
+import collections
+
+# ***********************************************
+# * Constants
+# ***********************************************
+BACKEND_POOL_MAX_CONNECTIONS = 64
+BACKEND_POOL_MAX_IDLE        = 8
+BACKEND_POOL_ACQUIRE_TIMEOUT = 10       # Seconds to wait for a connection, once all are in use
+
+# Pool statistics keys
+BACKEND_POOL__OPEN     = "BACKEND_OPEN"
+BACKEND_POOL__IDLE     = "BACKEND_IDLE"
+BACKEND_POOL__CONNECTS = "BACKEND_CONNECTS"
+BACKEND_POOL__REUSES   = "BACKEND_REUSES"
+
+# ***********************************************
+# * Pool implementation
+# ***********************************************
+class BackendPoolExhausted(Exception):
+    pass
+
+class BackendPool:
+    """
+    Thread safe pool of backend connections, parked by key
+    """
+    def __init__(self, connect_func, max_connections = BACKEND_POOL_MAX_CONNECTIONS, max_idle = BACKEND_POOL_MAX_IDLE):
+        """
+        connect_func : function (key) -> new backend connection
+        """
+        self.connect_func    = connect_func
+        self.max_connections = max_connections
+        self.max_idle        = max_idle
+        self.idle            = collections.OrderedDict()   # Key -> list of parked connections, least recently parked key first
+        self.num_of_idle     = 0
+        self.num_of_open     = 0        # Idle and checked out connections, and connections being opened
+        self.num_of_connects = 0
+        self.num_of_reuses   = 0
+        self.condition       = threading.Condition()
+
+    def pop_idle(self, key) :
+        """! Take a parked connection of a key (called with the lock held)
+        """
+        cons = self.idle[key]
+        con = cons.pop()
+        if len(cons) == 0 :
+            del self.idle[key]
+        self.num_of_idle -= 1
+        return con
+
+    def acquire(self, key = None, timeout = BACKEND_POOL_ACQUIRE_TIMEOUT) :
+        """! Check out a connection - One parked with the same key, or a new one. Once the pool is full, a connection
+             parked with another key is closed to make room.
+        @param key Connection identity, e.g. the (host, port, database, user) it connects with
+        @return backend connection
+        @raise BackendPoolExhausted if all the connections stayed in use for timeout seconds
+        """
+        evicted_con = None
+        with self.condition :
+            if not self.condition.wait_for(lambda : self.num_of_idle > 0 or self.num_of_open < self.max_connections, timeout) :
+                raise BackendPoolExhausted("All {} backend connections are in use".format(self.max_connections))
+            if key in self.idle :
+                self.num_of_reuses += 1
+                return self.pop_idle(key)
+            if self.num_of_open < self.max_connections :
+                self.num_of_open += 1
+            else :
+                # The connection slot of the least recently parked key is taken over
+                evicted_con = self.pop_idle(next(iter(self.idle)))
+
+        # Close and connect outside the lock - Other sessions may use the pool meanwhile
+        if evicted_con is not None :
+            self.close(evicted_con)
+        try :
+            con = self.connect_func(key)
+        except Exception :
+            self.forget()
+            raise
+        with self.condition :
+            self.num_of_connects += 1
+        return con
+
+    def release(self, con, key = None) :
+        """! Park a checked out connection for the next session of its key, or close it if enough are parked
+        """
+        with self.condition :
+            if self.num_of_idle < self.max_idle :
+                self.idle.setdefault(key, []).append(con)
+                self.idle.move_to_end(key)
+                self.num_of_idle += 1
+                self.condition.notify()
+                return
+        self.discard(con)
+
+    def discard(self, con) :
+        """! Close a checked out connection (e.g. broken) instead of returning it
+        """
+        self.close(con)
+        self.forget()
+
+    def close(self, con) :
+        try :
+            con.close()
+        except Exception as e :
+            logging.error("BackendPool : Closing a backend connection failed - %s", e)
+
+    def forget(self) :
+        with self.condition :
+            self.num_of_open -= 1
+            self.condition.notify()
+
+    def get_stats(self) :
+        with self.condition :
+            return {BACKEND_POOL__OPEN     : self.num_of_open,
+                    BACKEND_POOL__IDLE     : self.num_of_idle,
+                    BACKEND_POOL__CONNECTS : self.num_of_connects,
+                    BACKEND_POOL__REUSES   : self.num_of_reuses}
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""
+Output buffers pool - Reusable bytearray buffers for encoding large responses (e.g. DataRow batches)
+A response is encoded into a buffer checked out of the pool, and the buffer is returned to the pool once
+the response was transmitted, so steady state serving does not allocate (and free) a large buffer per batch,
+and the process heap does not fragment over long uptimes.
+
+Buffers are grouped in size classes - One per power of two range of requested sizes. The buffers size of a class
+follows the largest response observed in its range (rounded up to a page), instead of the range upper bound, and
+the number of idle buffers kept per class follows the recent peak of buffers checked out together.
+Responses smaller than POOL_MIN_BUFFER_SIZE, or larger than POOL_MAX_BUFFER_SIZE, are not pooled.
+
+Each worker process has its own pool (OUTPUT_BUFFER_POOL), shared by its sessions threads.
+Checked out buffers are handed out as memoryviews - Valid until released, so transmission functions
+must not keep a reference to them after the send.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import threading
+
+# ***********************************************
+# * Constants
+# ***********************************************
+POOL_MIN_BUFFER_SIZE   = 64 * 1024
+POOL_MAX_BUFFER_SIZE   = 64 * 1024 * 1024
+POOL_MAX_IDLE_BYTES    = 64 * 1024 * 1024       # Idle buffers kept, over all the size classes
+POOL_PAGE_SIZE         = 4096
+POOL_TUNE_INTERVAL     = 256                    # Check outs between two size classes tunings
+
+# Pool statistics keys
+POOL__CHECK_OUTS  = "CHECK_OUTS"
+POOL__REUSES      = "REUSES"
+POOL__IN_USE      = "IN_USE"
+POOL__IDLE_BYTES  = "IDLE_BYTES"
+
+# ***********************************************
+# * Buffers pool
+# ***********************************************
+def round_to_page(size) :
+    return (size + POOL_PAGE_SIZE - 1) // POOL_PAGE_SIZE * POOL_PAGE_SIZE
+
+class SizeClass:
+    """
+    Buffers for requested sizes in [2^n, 2^(n+1))
+    """
+    def __init__(self):
+        self.buffer_size  = 0       # Largest requested size seen (rounded to a page) - Size of new buffers
+        self.idle         = []      # Buffers ready to be checked out
+        self.in_use       = 0
+        self.peak_in_use  = 0       # Since the last tuning
+
+class BufferPool:
+    """
+    Size classed pool of reusable bytearray buffers - Thread safe
+    """
+    def __init__(self, min_buffer_size = POOL_MIN_BUFFER_SIZE, max_buffer_size = POOL_MAX_BUFFER_SIZE,
+                 max_idle_bytes = POOL_MAX_IDLE_BYTES):
+        self.min_buffer_size = min_buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.max_idle_bytes  = max_idle_bytes
+        self.lock            = threading.Lock()
+        self.size_classes    = {}       # Size class (bit length of the requested size) -> SizeClass
+        self.checked_out     = {}       # id(buffer) -> (buffer, SizeClass) of the buffers in use
+        self.idle_bytes      = 0
+        self.check_outs      = 0
+        self.reuses          = 0
+
+    def is_pooled(self, size) :
+        return self.min_buffer_size <= size <= self.max_buffer_size
+
+    def acquire(self, size) :
+        """! Check out a buffer
+        @param size Number of bytes needed
+        @return memoryview of exactly size bytes - Release it (see release) after its contents were transmitted
+        """
+        if not self.is_pooled(size) :
+            return memoryview(bytearray(size))
+
+        with self.lock :
+            size_class = self.size_classes.setdefault(size.bit_length(), SizeClass())
+            size_class.buffer_size = max(size_class.buffer_size, round_to_page(size))
+
+            buffer = None
+            while size_class.idle and buffer is None :
+                buffer = size_class.idle.pop()
+                self.idle_bytes -= len(buffer)
+                if len(buffer) < size :
+                    buffer = None       # Outgrown by the observed sizes - Dropped
+            if buffer is not None :
+                self.reuses += 1
+
+            size_class.in_use += 1
+            size_class.peak_in_use = max(size_class.peak_in_use, size_class.in_use)
+            self.check_outs += 1
+            if self.check_outs % POOL_TUNE_INTERVAL == 0 :
+                self.tune()
+
+        if buffer is None :
+            buffer = bytearray(size_class.buffer_size)
+
+        with self.lock :
+            self.checked_out[id(buffer)] = (buffer, size_class)
+        return memoryview(buffer)[:size]
+
+    def release(self, view) :
+        """! Return a checked out buffer to the pool. Views of buffers which are not pooled are ignored.
+        @param view memoryview returned by acquire
+        """
+        with self.lock :
+            entry = self.checked_out.pop(id(view.obj), None)
+            if entry is None :
+                return
+            buffer, size_class = entry
+            size_class.in_use -= 1
+
+            # Keep the buffer, unless it is smaller than the class buffers, or the class already has enough idle buffers
+            if len(buffer) >= size_class.buffer_size and \
+               size_class.in_use + len(size_class.idle) < size_class.peak_in_use and \
+               self.idle_bytes + len(buffer) <= self.max_idle_bytes :
+                size_class.idle.append(buffer)
+                self.idle_bytes += len(buffer)
+
+    def tune(self) :
+        """! Trim each size class to the buffers checked out together since the last tuning,
+             and drop the idle buffers which are smaller than the observed sizes. Called with the lock held.
+        """
+        for size_class in self.size_classes.values() :
+            keep = [buffer for buffer in size_class.idle if len(buffer) >= size_class.buffer_size]
+            keep = keep[: max(size_class.peak_in_use - size_class.in_use, 0)]
+            self.idle_bytes -= sum(len(buffer) for buffer in size_class.idle) - sum(len(buffer) for buffer in keep)
+            size_class.idle = keep
+            size_class.peak_in_use = size_class.in_use
+
+        logging.debug("BufferPool : %d check outs, %d reused, %d idle bytes, buffer sizes %s",
+                      self.check_outs, self.reuses, self.idle_bytes,
+                      [size_class.buffer_size for _, size_class in sorted(self.size_classes.items())])
+
+    def get_stats(self) :
+        with self.lock :
+            return {POOL__CHECK_OUTS : self.check_outs,
+                    POOL__REUSES     : self.reuses,
+                    POOL__IN_USE     : len(self.checked_out),
+                    POOL__IDLE_BYTES : self.idle_bytes}
+
+# Per worker (process) pool
+OUTPUT_BUFFER_POOL = BufferPool()
+
+def acquire_output_buffer(size) :
+    """! Check out an output buffer of the worker pool
+    @return memoryview of size bytes
+    """
+    return OUTPUT_BUFFER_POOL.acquire(size)
+
+def release_output_buffers(buffers) :
+    """! Return the pooled buffers of a transmitted response to the worker pool
+    @param buffers list of bytes-like objects - Packed bytes and checked out buffers
+    """
+    for buffer in buffers :
+        if isinstance(buffer, memoryview) :
+            OUTPUT_BUFFER_POOL.release(buffer)
+
+# ***********************************************
+# * Unit Testing
+# ***********************************************
+def PG_BUFFERS_UT() :
+    pool = BufferPool(min_buffer_size = 1024, max_buffer_size = 1024 * 1024, max_idle_bytes = 1024 * 1024)
+
+    # Not pooled
+    view = pool.acquire(100)
+    assert len(view) == 100 and pool.get_stats()[POOL__IN_USE] == 0
+    pool.release(view)
+
+    # Checked out buffers are reused after their release
+    view = pool.acquire(9000)
+    assert len(view) == 9000 and len(view.obj) == round_to_page(9000)
+    buffer = view.obj
+    pool.release(view)
+    view = pool.acquire(8500)
+    assert view.obj is buffer and len(view) == 8500
+    assert pool.get_stats()[POOL__REUSES] == 1
+
+    # A larger size in the same class grows the class buffers - The smaller idle buffer is dropped
+    pool.release(view)
+    view = pool.acquire(13000)
+    assert view.obj is not buffer and len(view.obj) == round_to_page(13000)
+    pool.release(view)
+    assert pool.get_stats()[POOL__IDLE_BYTES] == round_to_page(13000)
+
+    # Idle buffers per class follow the peak of buffers in use together
+    views = [pool.acquire(9000) for _ in range(3)]
+    for view in views :
+        pool.release(view)
+    assert pool.get_stats()[POOL__IDLE_BYTES] == 3 * round_to_page(13000)
+    pool.tune()
+    assert pool.get_stats()[POOL__IDLE_BYTES] == 3 * round_to_page(13000)
+    # No buffers were in use since the last tuning
+    pool.tune()
+    assert pool.get_stats()[POOL__IDLE_BYTES] == 0
+    assert pool.get_stats()[POOL__IN_USE] == 0
+
+    # A stream aborted by a failed send returns all its buffers - Sent, queued, and held by the producer
+    import pg_stream
+    import pg_buffers       # The worker pool of pg_stream - This module may run as __main__
+    def batches() :
+        for _ in range(20) :
+            yield from pg_stream.yield_batches([pg_buffers.acquire_output_buffer(POOL_MIN_BUFFER_SIZE) for _ in range(2)])
+    def tx_func(buffers) :
+        raise ConnectionResetError("Client went away")
+    for _ in range(3) :
+        try :
+            pg_stream.stream_response(batches(), tx_func)
+            assert False, "Stream did not fail"
+        except ConnectionResetError :
+            pass
+        assert pg_buffers.OUTPUT_BUFFER_POOL.get_stats()[POOL__IN_USE] == 0, pg_buffers.OUTPUT_BUFFER_POOL.get_stats()
+
+    print("PG_BUFFERS_UT Passed")
+
+if __name__ == "__main__":
+    PG_BUFFERS_UT()
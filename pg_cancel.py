@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+"""
+Query cancellation - CancelRequest support
+Each session is handed a cancel key (BackendKeyData) at startup. A client which gives up on a query (e.g. a PowerBI
+user navigating away) sends a CancelRequest with the key on a new connection, and the server cancels the running
+query of the session with the key (see pg_server_proxy.py) :
+    * The session backend connection is wrapped (CancellableConnection), so every backend call (execute, fetch) is a
+      cancellation point - A canceled query fails its next backend call with QueryCanceled, including the fetches of
+      a streamed result, and the client gets an ErrorResponse (57014) instead of the rest of the rows.
+    * A backend call in progress is aborted (see sqream_backend.abort_query), which closes the backend connection -
+      The session replaces it with a new one from the pool before its next request.
+A CancelRequest for a session which is not running a query is ignored, as in Postgres.
+
+In worker mode (see pg_workers.py) the kernel may hand the CancelRequest connection to any worker process. The cancel
+key process ID holds the index of the worker which issued it (CANCEL_KEY_WORKER_BITS high bits), so keys are unique
+over the workers, and a worker forwards a CancelRequest for another worker's session to its owner.
+
+Statement timeout - A backend statement running for longer than the session statement_timeout (startup parameter,
+SET statement_timeout, or STATEMENT_TIMEOUT by default) is canceled the same way, so a runaway query does not hold
+its session thread and backend connection. The budget runs from the statement execute, while the request which
+started it is processed.
+
+Backend statements are admitted by the server query scheduler (see pg_scheduler), when it is given - A statement
+waiting for a slot is canceled as a running one, or once it waited SCHEDULER_QUEUE_TIMEOUT seconds. A session holds
+a single slot, shared by its open cursors (e.g. two portals of a request), so it never waits for a slot it holds itself.
+The slot is given back at the end of each request - A cursor left open (e.g. a suspended portal) is admitted again on
+its next fetch.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import re
+import secrets
+import threading
+
+from pg_serdes import PG_Error, SQLSTATE_QUERY_CANCELED
+from sqream_backend import abort_query
+from pg_scheduler import classify_query, SCHEDULER_QUEUE_TIMEOUT
+
+# ***********************************************
+# * Constants
+# ***********************************************
+CANCEL_MESSAGE_USER_REQUEST      = "canceling statement due to user request"
+CANCEL_MESSAGE_STATEMENT_TIMEOUT = "canceling statement due to statement timeout"
+CANCEL_MESSAGE_QUEUE_TIMEOUT     = "canceling statement due to scheduler queue timeout"
+
+# Cancel key process ID : Worker index (high bits) | Session number of the worker (low bits)
+CANCEL_KEY_WORKER_BITS  = 8
+CANCEL_KEY_SESSION_BITS = 31 - CANCEL_KEY_WORKER_BITS
+CANCEL_KEY_MAX_WORKERS  = 1 << CANCEL_KEY_WORKER_BITS
+
+STATEMENT_TIMEOUT = 0       # Default statement timeout of the sessions (milliseconds), 0 - No timeout
+STATEMENT_TIMEOUT_PARAMETER = "statement_timeout"
+
+# statement_timeout value units, in milliseconds - A value without a unit is in milliseconds
+STATEMENT_TIMEOUT_UNITS = {"ms" : 1, "s" : 1000, "min" : 60 * 1000, "h" : 60 * 60 * 1000, "d" : 24 * 60 * 60 * 1000}
+STATEMENT_TIMEOUT_REGEXP = r"(\d+(?:\.\d+)?)\s*(ms|s|min|h|d)?"
+
+# ***********************************************
+# * Cancellation
+# ***********************************************
+class QueryCanceled(PG_Error):
+    """
+    The running query was canceled (CancelRequest, statement timeout or scheduler queue timeout)
+    """
+    def __init__(self, message = CANCEL_MESSAGE_USER_REQUEST):
+        super().__init__(SQLSTATE_QUERY_CANCELED, message)
+
+def parse_statement_timeout(value) :
+    """! Parse a statement_timeout setting, as Postgres does - e.g. '5000', '30s', '5min'
+    @return milliseconds, 0 - No timeout
+    @raise ValueError for an invalid value
+    """
+    match = re.fullmatch(STATEMENT_TIMEOUT_REGEXP, value.strip())
+    if match is None :
+        raise ValueError('invalid value for parameter "statement_timeout": "{}"'.format(value))
+    return int(float(match.group(1)) * STATEMENT_TIMEOUT_UNITS[match.group(2) or "ms"])
+
+def get_default_statement_timeout(startup_parameters) :
+    """! Statement timeout of a session - Its statement_timeout parameter, or STATEMENT_TIMEOUT
+    @param startup_parameters Parameters of the client Startup message, or the session parameters (see pg_local)
+    @return milliseconds
+    """
+    value = startup_parameters.get(STATEMENT_TIMEOUT_PARAMETER)
+    if value is None :
+        return STATEMENT_TIMEOUT
+    try :
+        return parse_statement_timeout(value)
+    except ValueError as e :
+        logging.error("get_default_statement_timeout : {} - Using the default".format(e))
+        return STATEMENT_TIMEOUT
+
+def create_cancel_key(session_number, worker_index = 0) :
+    """! Cancel key of a new session
+    @param session_number Session number, unique in the worker process
+    @param worker_index   Index of the worker process (see pg_workers.py), 0 for a single server process
+    @return (process ID, secret key) - Signed 32 bit integers, as sent in BackendKeyData
+    """
+    assert 0 <= worker_index < CANCEL_KEY_MAX_WORKERS, f"Worker index {worker_index} does not fit a cancel key"
+    process_id = (worker_index << CANCEL_KEY_SESSION_BITS) | (session_number & ((1 << CANCEL_KEY_SESSION_BITS) - 1))
+    return (process_id, secrets.randbits(31))
+
+def get_cancel_key_worker(cancel_key) :
+    """! Index of the worker process which issued a cancel key (see create_cancel_key)
+    """
+    return (cancel_key[0] >> CANCEL_KEY_SESSION_BITS) & (CANCEL_KEY_MAX_WORKERS - 1)
+
+class QueryCanceller:
+    """
+    Cancellation state of a session - Requests are run by the session thread, and canceled from another thread
+    """
+    def __init__(self, get_statement_timeout = None, scheduler = None):
+        """
+        get_statement_timeout : function () -> Statement timeout of the session (milliseconds), None - No timeout
+        scheduler             : QueryScheduler admitting the backend statements (see pg_scheduler), None - No scheduling
+        """
+        self.get_statement_timeout = get_statement_timeout
+        self.scheduler          = scheduler
+        self.slot_class         = None      # Query class of the scheduler slot held by the session, None - No slot
+        self.admitted           = []        # Cursors sharing the scheduler slot
+        self.admit_lock         = threading.Lock()  # Statements of the session wait for a slot one at a time
+        self.timers             = []        # Statement timeout timers of the running request
+        self.lock               = threading.Lock()
+        self.connection         = None
+        self.is_running         = False     # A request is being processed
+        self.cancel_message     = None      # Set once the running request is canceled
+        self.num_of_backend_calls = 0       # Backend calls in progress (session thread, stream producer)
+        self.is_backend_aborted = False     # The backend connection was closed to abort a call in progress
+
+    def wrap(self, connection):
+        """! The backend connection, with its backend calls as cancellation points
+        """
+        self.connection = connection
+        return CancellableConnection(connection, self)
+
+    def start_request(self):
+        with self.lock :
+            self.is_running     = True
+            self.cancel_message = None
+
+    def end_request(self):
+        """! The request was processed - The scheduler slots of the cursors left open are given back until their next fetch
+        @return True if the backend connection was aborted, and must not be used anymore
+        """
+        with self.lock :
+            self.is_running = False
+            timers, self.timers = self.timers, []
+            for timer in timers :
+                timer.cancel()
+            is_backend_aborted = self.is_backend_aborted
+            self.is_backend_aborted = False
+        self.release_all()
+        return is_backend_aborted
+
+    def cancel(self, message = CANCEL_MESSAGE_USER_REQUEST):
+        """! Cancel the running request, aborting its backend call in progress
+        @return False if no request is running (nothing to cancel)
+        """
+        with self.lock :
+            if not self.is_running or self.cancel_message is not None :
+                return False
+            self.cancel_message = message
+            is_abort = self.num_of_backend_calls > 0 and not self.is_backend_aborted
+            if is_abort :
+                self.is_backend_aborted = True
+
+        if is_abort :
+            try :
+                abort_query(self.connection)
+            except Exception as e :
+                logging.error("QueryCanceller : Aborting the backend query failed - {}".format(e))
+        # A statement waiting for a scheduler slot gives up
+        if self.scheduler is not None :
+            self.scheduler.wake_up()
+        return True
+
+    def start_statement(self):
+        """! A backend statement is about to be executed - A cancel applies to a single statement, so the next 
+             statements of the request run (unless the backend connection was aborted). 
+             Starts the statement timeout, if the session has one.
+        @return the timeout timer, None if no timeout
+        """
+        with self.lock :
+            if not self.is_backend_aborted :
+                self.cancel_message = None
+
+        timeout = self.get_statement_timeout() if self.get_statement_timeout is not None else 0
+        if not timeout :
+            return None
+        timer = threading.Timer(timeout / 1000, self.cancel, (CANCEL_MESSAGE_STATEMENT_TIMEOUT, ))
+        timer.daemon = True
+        with self.lock :
+            self.timers.append(timer)
+        timer.start()
+        return timer
+
+    def admit(self, cursor):
+        """! Wait for the scheduler to admit the statement of a cursor - On its execute, and on a fetch after the slot
+             was given back at the end of a request. Nothing to wait for if the session holds a slot already - The
+             cursor shares it.
+        @raise QueryCanceled if canceled while waiting, or if no slot was free for SCHEDULER_QUEUE_TIMEOUT seconds
+        """
+        if self.scheduler is None or cursor.query_class is None :
+            return
+        with self.admit_lock :
+            with self.lock :
+                if self.slot_class is not None :
+                    if not any(admitted is cursor for admitted in self.admitted) :
+                        self.admitted.append(cursor)
+                    return
+            if not self.scheduler.acquire(cursor.query_class, lambda : self.cancel_message is not None, SCHEDULER_QUEUE_TIMEOUT) :
+                raise QueryCanceled(self.cancel_message or CANCEL_MESSAGE_QUEUE_TIMEOUT)
+            with self.lock :
+                self.slot_class = cursor.query_class
+                self.admitted.append(cursor)
+
+    def release(self, cursor):
+        """! A cursor statement is done with the scheduler slot - The slot is freed once no open cursor shares it
+        """
+        with self.lock :
+            if not any(admitted is cursor for admitted in self.admitted) :
+                return
+            self.admitted = [admitted for admitted in self.admitted if admitted is not cursor]
+            if len(self.admitted) > 0 :
+                return
+            slot_class, self.slot_class = self.slot_class, None
+        self.scheduler.release(slot_class)
+
+    def release_all(self):
+        """! Free the scheduler slot of the open cursors (the request ended, or the session ended)
+        """
+        with self.lock :
+            slot_class, self.slot_class = self.slot_class, None
+            self.admitted = []
+        if slot_class is not None :
+            self.scheduler.release(slot_class)
+
+    def stop_statement_timer(self, timer):
+        if timer is None :
+            return
+        timer.cancel()
+        with self.lock :
+            if timer in self.timers :
+                self.timers.remove(timer)
+
+    def check(self):
+        """! @raise QueryCanceled if the running request was canceled
+        """
+        if self.cancel_message is not None :
+            raise QueryCanceled(self.cancel_message)
+
+    def call_backend(self, func, *args):
+        """! Run a backend call as a cancellation point
+        @raise QueryCanceled if the request was canceled before or during the call
+        """
+        with self.lock :
+            self.check()
+            self.num_of_backend_calls += 1
+        try :
+            result = func(*args)
+        except Exception as e :
+            # The call failed since its connection was aborted
+            if self.cancel_message is not None :
+                raise QueryCanceled(self.cancel_message) from e
+            raise
+        finally :
+            with self.lock :
+                self.num_of_backend_calls -= 1
+        self.check()
+        return result
+
+class CancellableConnection:
+    """
+    Backend connection wrapper - Its cursors run their backend calls through the canceller
+    """
+    def __init__(self, connection, canceller):
+        self.connection = connection
+        self.canceller  = canceller
+
+    def cursor(self):
+        return CancellableCursor(self.connection.cursor(), self.canceller)
+
+    def close(self):
+        self.connection.close()
+
+class CancellableCursor:
+    """
+    Backend cursor wrapper - execute / fetch are cancellation points, other attributes are the cursor's
+    """
+    def __init__(self, cursor, canceller):
+        self.cursor      = cursor
+        self.canceller   = canceller
+        self.timer       = None
+        self.query_class = None     # Scheduler query class of the executed statement, None - Not scheduled
+
+    def execute(self, query):
+        self.timer = self.canceller.start_statement()
+        self.query_class = classify_query(query) if self.canceller.scheduler is not None else None
+        try :
+            self.canceller.admit(self)
+            return self.canceller.call_backend(self.cursor.execute, query)
+        except Exception :
+            self.release()
+            raise
+
+    def release(self):
+        self.canceller.stop_statement_timer(self.timer)
+        self.timer = None
+        self.canceller.release(self)
+
+    def fetchall(self):
+        self.canceller.admit(self)
+        return self.canceller.call_backend(self.cursor.fetchall)
+
+    def fetchmany(self, size):
+        self.canceller.admit(self)
+        return self.canceller.call_backend(self.cursor.fetchmany, size)
+
+    def close(self):
+        self.release()
+        # The cursor of an aborted connection is gone with it
+        try :
+            self.cursor.close()
+        except Exception :
+            if self.canceller.cancel_message is None :
+                raise
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+# ***********************************************
+# * Unit Testing
+# ***********************************************
+def PG_CANCEL_UT() :
+    from pg_scheduler import QueryScheduler, QUERY_CLASS_BULK, SCHEDULER__RUNNING
+
+    class StubCursor:
+        def execute(self, query):
+            pass
+        def fetchmany(self, size):
+            return []
+        def close(self):
+            pass
+
+    class StubConnection:
+        def cursor(self):
+            return StubCursor()
+
+    scheduler = QueryScheduler(max_queries = 1, interactive_reserved = 0)
+    canceller = QueryCanceller(scheduler = scheduler)
+    connection = canceller.wrap(StubConnection())
+    get_running = lambda : scheduler.get_stats()[SCHEDULER__RUNNING]
+
+    # Two portals of a request share the session slot - The second does not queue behind the first
+    canceller.start_request()
+    portals = [connection.cursor(), connection.cursor()]
+    for portal in portals :
+        portal.execute("select * from t")
+    assert get_running() == 1, scheduler.get_stats()
+    portals[0].close()
+    assert get_running() == 1, "The slot was freed while a portal still shares it"
+    canceller.end_request()
+    assert get_running() == 0, "The slot was kept after the end of the request"
+
+    # A portal resumed by the next request is admitted again - Other sessions wait for the slot meanwhile
+    canceller.start_request()
+    portals[1].fetchmany(10)
+    assert get_running() == 1, scheduler.get_stats()
+    assert not scheduler.acquire(QUERY_CLASS_BULK, timeout = 0.1), "Admitted over the scheduler capacity"
+    portals[1].close()
+    assert get_running() == 0, scheduler.get_stats()
+    canceller.end_request()
+
+    print("PG_CANCEL_UT Passed")
+
+if __name__ == "__main__":
+    PG_CANCEL_UT()
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""
+Traffic capture and deterministic replay
+Records each client session of the pg_server_proxy (raw inbound frames and outbound bytes, with timestamps)
+to a compact binary file, and replays recorded sessions against a running server, at the original pace or faster.
+Used for benchmarking and regression testing with real client traffic (e.g. PowerBI), in addition to pg_client.
+
+Capture file format :
+    Header  : CAPTURE_FILE_MAGIC
+    Records : Byte1  Direction (CAPTURE_DIRECTION_IN - client to server / CAPTURE_DIRECTION_OUT - server to client)
+              Double Time stamp (seconds since epoch)
+              Int32  Payload length
+              Byten  Payload
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import os
+import glob
+import time
+import struct
+import socket
+import threading
+
+# ***********************************************
+# * Constants
+# ***********************************************
+CAPTURE_FILE_MAGIC      = b"PGMCAP1\n"
+CAPTURE_FILE_SUFFIX     = ".pgcap"
+CAPTURE_RECORD_FORMAT   = "!cdI"        # Direction / Time stamp / Payload length
+CAPTURE_DIRECTION_IN    = b"I"
+CAPTURE_DIRECTION_OUT   = b"O"
+
+REPLAY_SPEED_ORIGINAL   = 1.0
+REPLAY_SPEED_NO_WAIT    = 0             # Send each inbound frame as soon as the previous response arrived
+REPLAY_RX_TIMEOUT       = 30            # Seconds to wait for a response before giving up on the session
+REPLAY_RX_BUFF_SIZE     = 1024 * 1024
+
+BACKEND_MSG_HEADER_FORMAT = "!ci"       # Message ID / Length (including self)
+
+CAPTURE_RECORD__DIRECTION = "direction"
+CAPTURE_RECORD__TIMESTAMP = "timestamp"
+CAPTURE_RECORD__PAYLOAD   = "payload"
+
+REPLAY_RESULT__PATH          = "path"
+REPLAY_RESULT__LATENCIES     = "latencies"
+REPLAY_RESULT__MISMATCHES    = "mismatches"
+REPLAY_RESULT__BYTES_RX      = "bytes_rx"
+REPLAY_RESULT__DURATION      = "duration"
+
+# ***********************************************
+# * Capture
+# ***********************************************
+class SessionRecorder:
+    """
+    Records a single client session to a capture file.
+    Each session is served by a single thread, so no locking is needed.
+    """
+    def __init__(self, capture_dir, client_address):
+        os.makedirs(capture_dir, exist_ok = True)
+        file_name = "{}_{}_{}{}".format(client_address[0], client_address[1],
+                                        time.strftime("%Y%m%d_%H%M%S"), CAPTURE_FILE_SUFFIX)
+        self.path = os.path.join(capture_dir, file_name)
+        self.file = open(self.path, "wb")
+        self.file.write(CAPTURE_FILE_MAGIC)
+        logging.info("SessionRecorder : Recording session to {}".format(self.path))
+
+    def record(self, direction, payload):
+        self.file.write(struct.pack(CAPTURE_RECORD_FORMAT, direction, time.time(), len(payload)) + payload)
+
+    def record_inbound(self, payload):
+        self.record(CAPTURE_DIRECTION_IN, payload)
+
+    def record_outbound(self, payload):
+        self.record(CAPTURE_DIRECTION_OUT, payload)
+
+    def close(self):
+        self.file.close()
+
+def read_capture(path):
+    """! Read a capture file
+    @param path capture file path
+
+    @return list of records, each a dictionary with direction, time stamp and payload
+    """
+    records = []
+    record_header_len = struct.calcsize(CAPTURE_RECORD_FORMAT)
+
+    with open(path, "rb") as f :
+        assert f.read(len(CAPTURE_FILE_MAGIC)) == CAPTURE_FILE_MAGIC, f"{path} is not a pg_mimic capture file"
+        while True :
+            header = f.read(record_header_len)
+            if len(header) < record_header_len :
+                break
+            direction, timestamp, payload_len = struct.unpack(CAPTURE_RECORD_FORMAT, header)
+            records.append({CAPTURE_RECORD__DIRECTION : direction,
+                            CAPTURE_RECORD__TIMESTAMP : timestamp,
+                            CAPTURE_RECORD__PAYLOAD   : f.read(payload_len)})
+    return records
+
+def write_capture(path, records):
+    """! Write records (as returned by read_capture) to a capture file
+    """
+    with open(path, "wb") as f :
+        f.write(CAPTURE_FILE_MAGIC)
+        for record in records :
+            payload = record[CAPTURE_RECORD__PAYLOAD]
+            f.write(struct.pack(CAPTURE_RECORD_FORMAT, record[CAPTURE_RECORD__DIRECTION], 
+                                record[CAPTURE_RECORD__TIMESTAMP], len(payload)) + payload)
+
+def count_backend_msgs(data):
+    """! Count the backend messages in a stream of bytes sent by the server
+    @return (number of complete messages, number of bytes they occupy)
+    """
+    header_len = struct.calcsize(BACKEND_MSG_HEADER_FORMAT)
+    num_of_msgs = 0
+    offset = 0
+    while len(data) - offset >= header_len :
+        msg_len = struct.unpack(BACKEND_MSG_HEADER_FORMAT, data[offset : offset + header_len])[1]
+        if len(data) - offset < msg_len + 1 :
+            break
+        offset += msg_len + 1
+        num_of_msgs += 1
+    return num_of_msgs, offset
+
+# ***********************************************
+# * Replay
+# ***********************************************
+def split_to_turns(records):
+    """! Group the records of a session into turns : an inbound frame, and the outbound bytes that followed it
+    @return list of tuples (inbound record, expected outbound bytes)
+    """
+    turns = []
+    for record in records :
+        if record[CAPTURE_RECORD__DIRECTION] == CAPTURE_DIRECTION_IN :
+            turns.append((record, b""))
+        elif len(turns) > 0 :
+            inbound_record, outbound = turns[-1]
+            turns[-1] = (inbound_record, outbound + record[CAPTURE_RECORD__PAYLOAD])
+    return turns
+
+def replay_session(host, port, path, speed = REPLAY_SPEED_ORIGINAL, start_time = None):
+    """! Re-drive a recorded session against a running server
+    @param host, port  Server address
+    @param path        Capture file path
+    @param speed       Pace relative to the original session (2.0 - twice as fast). REPLAY_SPEED_NO_WAIT - no pacing at all
+    @param start_time  Original time stamp mapped to the replay start (default : first record of the session).
+                       Enables keeping the original offsets between concurrently replayed sessions.
+
+    @return replay result - per turn response latency, mismatching turns, received bytes and total duration
+    """
+    records = read_capture(path)
+    turns = split_to_turns(records)
+    if start_time is None and len(records) > 0 :
+        start_time = records[0][CAPTURE_RECORD__TIMESTAMP]
+
+    latencies  = []
+    mismatches = []
+    bytes_rx   = 0
+    replay_start = time.time()
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock :
+        sock.settimeout(REPLAY_RX_TIMEOUT)
+        sock.connect((host, port))
+
+        for turn_index, (inbound_record, expected_outbound) in enumerate(turns) :
+            # Pace the inbound frame according to its original offset
+            if speed != REPLAY_SPEED_NO_WAIT :
+                offset = (inbound_record[CAPTURE_RECORD__TIMESTAMP] - start_time) / speed
+                time.sleep(max(0, replay_start + offset - time.time()))
+
+            tx_time = time.time()
+            sock.sendall(inbound_record[CAPTURE_RECORD__PAYLOAD])
+
+            # Receive as many backend messages as were recorded - Their sizes may differ in a new build
+            expected_num_of_msgs = count_backend_msgs(expected_outbound)[0]
+            response = b""
+            try :
+                while count_backend_msgs(response)[0] < expected_num_of_msgs :
+                    data = sock.recv(REPLAY_RX_BUFF_SIZE)
+                    if len(data) == 0 :
+                        break
+                    response += data
+            except socket.timeout :
+                logging.error("replay_session : {} turn {} timed out".format(path, turn_index))
+
+            latencies.append(time.time() - tx_time)
+            bytes_rx += len(response)
+            if response != expected_outbound :
+                mismatches.append(turn_index)
+
+    return {REPLAY_RESULT__PATH       : path,
+            REPLAY_RESULT__LATENCIES  : latencies,
+            REPLAY_RESULT__MISMATCHES : mismatches,
+            REPLAY_RESULT__BYTES_RX   : bytes_rx,
+            REPLAY_RESULT__DURATION   : time.time() - replay_start}
+
+def replay_captures(host, port, paths, speed = REPLAY_SPEED_ORIGINAL):
+    """! Replay several recorded sessions concurrently, keeping their original relative start times
+    @return list of replay results, in the order of paths
+    """
+    start_times = [read_capture(path)[0][CAPTURE_RECORD__TIMESTAMP] for path in paths]
+    start_time = min(start_times) if len(start_times) > 0 else None
+
+    results = [None] * len(paths)
+
+    def replay(index, path) :
+        results[index] = replay_session(host, port, path, speed, start_time)
+
+    threads = [threading.Thread(target = replay, args = (index, path)) for index, path in enumerate(paths)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+
+    return results
+
+def print_replay_results(results):
+    for result in results :
+        if result is None :
+            continue
+        latencies = sorted(result[REPLAY_RESULT__LATENCIES])
+        p50 = latencies[len(latencies) // 2] if len(latencies) > 0 else 0
+        print("[+] {} : {} turns, {} mismatches, {} bytes received, duration {:.3f}s, p50 latency {:.3f}s, max latency {:.3f}s".format(
+              result[REPLAY_RESULT__PATH], len(latencies), len(result[REPLAY_RESULT__MISMATCHES]),
+              result[REPLAY_RESULT__BYTES_RX], result[REPLAY_RESULT__DURATION], p50, latencies[-1] if len(latencies) > 0 else 0))
+
+
+if __name__ == "__main__" :
+    PG_PORT = 5432
+    HOST = "localhost"
+    CAPTURE_DIR = "captures"
+    SPEED = REPLAY_SPEED_ORIGINAL
+
+    capture_paths = sorted(glob.glob(os.path.join(CAPTURE_DIR, "*" + CAPTURE_FILE_SUFFIX)))
+    print_replay_results(replay_captures(HOST, PG_PORT, capture_paths, SPEED))
@@ -15,6 +15,7 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 
 import socket
+import struct
 
 # ======================================================================================
 # Init queries - PBI initiates connection with PG, and queries all the tables in DB 
@@ -633,6 +634,20 @@ PSQL_SIMPLE_QUERY_MSG_3 = b'Q\x00\x00\x00\x19select * from test1;\x00'
 # -------------
 PSQL_MSGS = [PSQL_STARTUP_MSG_1, PSQL_PASSWD_MSG_2, PSQL_SIMPLE_QUERY_MSG_3]
 
+def count_ready_for_query(data):
+    """
+    Count the Ready For Query (Z) messages in a stream of bytes received from the server
+    """
+    HEADERFORMAT = "!ci"
+    header_len = struct.calcsize(HEADERFORMAT)
+    num_of_msgs = 0
+    while len(data) >= header_len :
+        msg_id, msg_len = struct.unpack(HEADERFORMAT, data[0:header_len])
+        if msg_id == b'Z' and len(data) >= msg_len + 1 :
+            num_of_msgs += 1
+        data = data[msg_len + 1 :]
+    return num_of_msgs
+
 def run_UT(host, port, msgs):
     RX_BUFF_SIZE = 64000
 
@@ -670,9 +685,15 @@ def run_UT(host, port, msgs):
             # TX
             sock.sendall(msg)
 
-            # RX
-            for i in range(rx_iterations) :
+            # RX - The responses to several queries sent together may arrive in a single read (or split between reads).
+            # Wait for rx_iterations Ready For Query messages - Startup message is answered by an authentication request only
+            num_of_ready_for_query = 0 if msg[0:1] == b'\x00' else rx_iterations
+            response = sock.recv(RX_BUFF_SIZE)
+            data = response
+            while response and count_ready_for_query(data) < num_of_ready_for_query :
                 response = sock.recv(RX_BUFF_SIZE)
+                data += response
+            response = data
 
             if not response:
                 print("[-] Not Received")
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+"""
+COPY TO STDOUT - Bulk extracts
+Serves COPY (query) TO STDOUT and COPY table [(columns)] TO STDOUT, in text, CSV and binary formats.
+The backend query rows are fetched in large batches (see pg_stream), and each batch is encoded column by column
+to a single chunk of the COPY data stream (a single CopyData message), instead of a DataRow per row.
+
+Supported options (both the WITH (...) list and the legacy syntax) :
+    FORMAT text | csv | binary, CSV, BINARY, HEADER [boolean], DELIMITER [AS] 'c', NULL [AS] 'string'
+
+References :
+------------
+COPY :                 https://www.postgresql.org/docs/12/sql-copy.html
+COPY protocol flow :   https://www.postgresql.org/docs/12/protocol-flow.html#PROTOCOL-COPY
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import re
+import struct
+
+from sqream_backend import  COL_FORMAT_TEXT,                    \
+                            COL_FORMAT_BINARY,                  \
+                            rows_to_cols,                       \
+                            get_num_of_col_rows
+from pg_types import        get_col_encoder,                    \
+                            get_col_batch_encoder
+from pg_serdes import       COL_DESC__NAME,                     \
+                            COL_DESC__TYPE,                     \
+                            COL_DESC__IS_NULLABLE
+
+# ***********************************************
+# * Constants
+# ***********************************************
+COPY_FORMAT_TEXT   = "text"
+COPY_FORMAT_CSV    = "csv"
+COPY_FORMAT_BINARY = "binary"
+
+COPY__QUERY        = "copy_query"
+COPY__FORMAT       = "copy_format"
+COPY__HEADER       = "copy_header"
+COPY__DELIMITER    = "copy_delimiter"
+COPY__NULL         = "copy_null"
+
+COPY_DEFAULT_DELIMITER = {COPY_FORMAT_TEXT : b"\t", COPY_FORMAT_CSV : b","}
+COPY_DEFAULT_NULL      = {COPY_FORMAT_TEXT : b"\\N", COPY_FORMAT_CSV : b""}
+
+COPY_QUERY_REG_EXPR     = r"^\s*COPY\b"
+COPY_TO_STDOUT_REG_EXPR = r"^\s*COPY\s+(?:\((?P<query>.+)\)|(?P<table>[\w.\"]+)\s*(?:\((?P<cols>[^()]*)\))?)\s+TO\s+STDOUT\b(?P<options>.*?)[\s;\x00]*$"
+COPY_OPTION_TOKEN_REG_EXPR = r"'(?:[^']|'')*'|[^\s,()]+"
+COPY_BOOL_VALUES        = {"true" : True, "on" : True, "1" : True, "false" : False, "off" : False, "0" : False}
+
+COPY_CSV_QUOTE          = b'"'
+COPY_TEXT_ESCAPES       = {b"\\" : b"\\\\", b"\n" : b"\\n", b"\r" : b"\\r", b"\t" : b"\\t"}
+
+# Binary format file header : Signature / Flags field / Header extension area length. Trailer : -1 field count
+COPY_BINARY_SIGNATURE   = b"PGCOPY\n\xff\r\n\x00"
+COPY_BINARY_HEADER      = COPY_BINARY_SIGNATURE + struct.pack("!ii", 0, 0)
+COPY_BINARY_TRAILER     = struct.pack("!h", -1)
+COPY_BINARY_FIELD_COUNT = struct.Struct("!h")
+
+# ***********************************************
+# * COPY statement parsing
+# ***********************************************
+def is_copy_query(query) :
+    """! Check if a query is a COPY statement (of any kind)
+    @param query string
+    """
+    return re.match(COPY_QUERY_REG_EXPR, query, re.IGNORECASE) is not None
+
+def unquote_option(token) :
+    return token[1:-1].replace("''", "'") if token.startswith("'") else token
+
+def parse_copy_options(options) :
+    """! Parse the COPY options - WITH (option value, ...) or the legacy syntax
+    @return (format, header, delimiter, null), delimiter and null are None if not set
+    """
+    tokens = re.findall(COPY_OPTION_TOKEN_REG_EXPR, options)
+    copy_format, header, delimiter, null = COPY_FORMAT_TEXT, False, None, None
+
+    index = 0
+    while index < len(tokens) :
+        option = tokens[index].lower()
+        index += 1
+        value = tokens[index] if index < len(tokens) else None
+
+        if option == "with" :
+            continue
+        elif option == "format" and value is not None :
+            copy_format = value.lower()
+            index += 1
+        elif option in (COPY_FORMAT_CSV, COPY_FORMAT_BINARY) :
+            copy_format = option
+        elif option == "header" :
+            header = True
+            if value is not None and value.lower() in COPY_BOOL_VALUES :
+                header = COPY_BOOL_VALUES[value.lower()]
+                index += 1
+        elif option in ("delimiter", "null") and value is not None :
+            if value.lower() == "as" :
+                index += 1
+                value = tokens[index] if index < len(tokens) else None
+            if value is None or not value.startswith("'") :
+                raise ValueError("COPY {} must be a quoted string".format(option))
+            index += 1
+            if option == "delimiter" :
+                delimiter = unquote_option(value).encode("utf-8")
+            else :
+                null = unquote_option(value).encode("utf-8")
+        else :
+            raise ValueError("COPY option \"{}\" is not supported".format(tokens[index - 1]))
+
+    if copy_format not in (COPY_FORMAT_TEXT, COPY_FORMAT_CSV, COPY_FORMAT_BINARY) :
+        raise ValueError("COPY format \"{}\" not recognized".format(copy_format))
+
+    return copy_format, header, delimiter, null
+
+def parse_copy_query(query) :
+    """! Parse a COPY TO STDOUT statement
+    @param query COPY statement string
+
+    @return copy object - The backend query, format and format options.
+            Raise ValueError for COPY statements which are not supported (e.g. COPY FROM, COPY TO a file)
+    """
+    copy_match = re.match(COPY_TO_STDOUT_REG_EXPR, query, re.IGNORECASE | re.DOTALL)
+    if copy_match is None :
+        raise ValueError("Only COPY TO STDOUT is supported")
+
+    backend_query = copy_match.group("query")
+    if backend_query is None :
+        cols = copy_match.group("cols")
+        backend_query = "SELECT {} FROM {}".format(cols.strip() if cols else "*", copy_match.group("table"))
+
+    copy_format, header, delimiter, null = parse_copy_options(copy_match.group("options"))
+
+    if copy_format == COPY_FORMAT_BINARY :
+        if header or delimiter is not None or null is not None :
+            raise ValueError("cannot specify HEADER, DELIMITER or NULL in BINARY mode")
+    else :
+        delimiter = COPY_DEFAULT_DELIMITER[copy_format] if delimiter is None else delimiter
+        null      = COPY_DEFAULT_NULL[copy_format] if null is None else null
+        if len(delimiter) != 1 :
+            raise ValueError("COPY delimiter must be a single one-byte character")
+        if delimiter in b"\r\n" + COPY_CSV_QUOTE :
+            raise ValueError("COPY delimiter cannot be newline, carriage return or quote")
+
+    return {COPY__QUERY     : backend_query.strip(),
+            COPY__FORMAT    : copy_format,
+            COPY__HEADER    : header,
+            COPY__DELIMITER : delimiter,
+            COPY__NULL      : null}
+
+def get_copy_cols_format(copy) :
+    """! Format code of the copied columns (CopyOutResponse)
+    """
+    return COL_FORMAT_BINARY if copy[COPY__FORMAT] == COPY_FORMAT_BINARY else COL_FORMAT_TEXT
+
+# ***********************************************
+# * COPY data stream encoding
+# ***********************************************
+def text_field_escaper(copy) :
+    """! Escaper of a text format field - Backslash, newline, carriage return, tab and the delimiter
+    """
+    delimiter = copy[COPY__DELIMITER]
+    escapes = dict(COPY_TEXT_ESCAPES)
+    escapes.setdefault(delimiter, b"\\" + delimiter)
+    pattern = re.compile(b"[" + b"".join(re.escape(char) for char in escapes) + b"]")
+    replace = lambda char_match : escapes[char_match.group()]
+    return lambda field : pattern.sub(replace, field)
+
+def csv_field_escaper(copy) :
+    """! Escaper of a CSV format field - Quoted if it holds the delimiter, a quote, a line break,
+         or if it might be read as NULL
+    """
+    delimiter, null = copy[COPY__DELIMITER], copy[COPY__NULL]
+    pattern = re.compile(b"[" + re.escape(delimiter) + re.escape(COPY_CSV_QUOTE) + b"\r\n]")
+    def escaper(field) :
+        if field == null or pattern.search(field) is not None :
+            return COPY_CSV_QUOTE + field.replace(COPY_CSV_QUOTE, COPY_CSV_QUOTE * 2) + COPY_CSV_QUOTE
+        return field
+    return escaper
+
+def get_field_escaper(copy) :
+    return csv_field_escaper(copy) if copy[COPY__FORMAT] == COPY_FORMAT_CSV else text_field_escaper(copy)
+
+def copy_data_header(copy, cols_desc) :
+    """! Start of the COPY data stream - The binary file header, or the columns names line
+    @return bytes
+    """
+    if copy[COPY__FORMAT] == COPY_FORMAT_BINARY :
+        return COPY_BINARY_HEADER
+    if not copy[COPY__HEADER] :
+        return b""
+
+    escaper = get_field_escaper(copy)
+    names = [escaper(col_desc[COL_DESC__NAME].encode("utf-8")) for col_desc in cols_desc]
+    return copy[COPY__DELIMITER].join(names) + b"\n"
+
+def copy_data_trailer(copy) :
+    """! End of the COPY data stream - The binary file trailer
+    @return bytes
+    """
+    return COPY_BINARY_TRAILER if copy[COPY__FORMAT] == COPY_FORMAT_BINARY else b""
+
+def copy_data_cols(copy, cols_desc, cols) :
+    """! Encode a batch of rows to a chunk of the COPY data stream, column by column
+    @param copy      copy object (see parse_copy_query)
+    @param cols_desc description of columns
+    @param cols      list of column batches (see fetch_cols)
+
+    @return bytes
+    """
+    if get_num_of_col_rows(cols) == 0 :
+        return b""
+
+    assert len(cols) == len(cols_desc), "Number of columns values and number of columns types do not match"
+
+    if copy[COPY__FORMAT] == COPY_FORMAT_BINARY :
+        # Binary tuples are DataRow fields (Int32 length + value, -1 for NULL), preceded by an Int16 field count
+        cols_fields = [get_col_batch_encoder(col_desc[COL_DESC__TYPE], COL_FORMAT_BINARY, col_desc.get(COL_DESC__IS_NULLABLE, True))(col_values)
+                       for col_desc, col_values in zip(cols_desc, cols)]
+        field_count = COPY_BINARY_FIELD_COUNT.pack(len(cols_desc))
+        return b"".join(field_count + b"".join(row_fields) for row_fields in zip(*cols_fields))
+
+    escaper, null = get_field_escaper(copy), copy[COPY__NULL]
+    cols_fields = []
+    for col_desc, col_values in zip(cols_desc, cols) :
+        encoder = get_col_encoder(col_desc[COL_DESC__TYPE], COL_FORMAT_TEXT)
+        cols_fields.append([null if val is None else escaper(encoder(val)) for val in col_values])
+
+    delimiter = copy[COPY__DELIMITER]
+    return b"".join(delimiter.join(row_fields) + b"\n" for row_fields in zip(*cols_fields))
+
+# *****************************************************
+# * Unit Testing
+# *****************************************************
+def PG_COPY_UT() :
+    """
+    COPY statements parsing, and text / CSV / binary encoding of known rows
+    """
+    import decimal
+    from pg_types import COL_INT_TYPE_OID, COL_TEXT_TYPE_2_OID, COL_NUMERIC_TYPE_OID, COL_REAL_TYPE_OID, FLOAT4
+
+    copy = parse_copy_query("COPY (SELECT a, b FROM t WHERE b = ')') TO STDOUT WITH (FORMAT csv, HEADER true, NULL 'n/a');")
+    assert copy[COPY__QUERY] == "SELECT a, b FROM t WHERE b = ')'", copy
+    assert (copy[COPY__FORMAT], copy[COPY__HEADER], copy[COPY__DELIMITER], copy[COPY__NULL]) == (COPY_FORMAT_CSV, True, b",", b"n/a"), copy
+
+    copy = parse_copy_query("copy public.t (a, b) to stdout csv header delimiter as '|'")
+    assert copy[COPY__QUERY] == "SELECT a, b FROM public.t", copy
+    assert (copy[COPY__FORMAT], copy[COPY__HEADER], copy[COPY__DELIMITER]) == (COPY_FORMAT_CSV, True, b"|"), copy
+
+    for query in ("COPY t FROM STDIN", "COPY t TO '/tmp/t.csv'", "COPY t TO STDOUT (FORMAT binary, HEADER)", "COPY t TO STDOUT (FREEZE)") :
+        try :
+            parse_copy_query(query)
+            assert False, f"Parsed an unsupported COPY statement : {query}"
+        except ValueError :
+            pass
+
+    cols_desc = [{COL_DESC__NAME : "a", COL_DESC__TYPE : COL_INT_TYPE_OID,    COL_DESC__IS_NULLABLE : True},
+                 {COL_DESC__NAME : "b", COL_DESC__TYPE : COL_TEXT_TYPE_2_OID, COL_DESC__IS_NULLABLE : True}]
+    rows = [[1, "x\ty"], [None, ""], [3, None], [4, 'say "hi", \\']]
+
+    copy = parse_copy_query("COPY t TO STDOUT")
+    data = copy_data_header(copy, cols_desc) + copy_data_cols(copy, cols_desc, rows_to_cols(rows)) + copy_data_trailer(copy)
+    assert data == b'1\tx\\ty\n\\N\t\n3\t\\N\n4\tsay "hi", \\\\\n', data
+
+    copy = parse_copy_query("COPY t TO STDOUT (FORMAT csv, HEADER)")
+    data = copy_data_header(copy, cols_desc) + copy_data_cols(copy, cols_desc, rows_to_cols(rows)) + copy_data_trailer(copy)
+    assert data == b'a,b\n1,x\ty\n,""\n3,\n4,"say ""hi"", \\"\n', data
+
+    copy = parse_copy_query("COPY t TO STDOUT (FORMAT binary)")
+    data = copy_data_header(copy, cols_desc) + copy_data_cols(copy, cols_desc, rows_to_cols(rows[:2])) + copy_data_trailer(copy)
+    assert data == COPY_BINARY_HEADER + b'\x00\x02\x00\x00\x00\x04\x00\x00\x00\x01\x00\x00\x00\x03x\ty' + \
+                   b'\x00\x02\xff\xff\xff\xff\x00\x00\x00\x00' + COPY_BINARY_TRAILER, data
+
+    # Numeric values are written in positional notation, as Postgres does
+    numeric_cols_desc = [{COL_DESC__NAME : "n", COL_DESC__TYPE : COL_NUMERIC_TYPE_OID, COL_DESC__IS_NULLABLE : False}]
+    numeric_rows = [[decimal.Decimal("0.00000001")], [decimal.Decimal("1E+3")], [decimal.Decimal("-Infinity")]]
+    for copy_query in ("COPY t TO STDOUT", "COPY t TO STDOUT (FORMAT csv)") :
+        copy = parse_copy_query(copy_query)
+        data = copy_data_cols(copy, numeric_cols_desc, rows_to_cols(numeric_rows))
+        assert data == b'0.00000001\n1000\n-Infinity\n', data
+
+    # Real values are written with the shortest digits which read back as the same float4
+    real_cols_desc = [{COL_DESC__NAME : "r", COL_DESC__TYPE : COL_REAL_TYPE_OID, COL_DESC__IS_NULLABLE : True}]
+    real_rows = [[FLOAT4.unpack(FLOAT4.pack(0.1))[0]], [None], [float("nan")]]
+    for copy_query, expected in (("COPY t TO STDOUT", b'0.1\n\\N\nNaN\n'), ("COPY t TO STDOUT (FORMAT csv)", b'0.1\n\nNaN\n')) :
+        copy = parse_copy_query(copy_query)
+        data = copy_data_cols(copy, real_cols_desc, rows_to_cols(real_rows))
+        assert data == expected, data
+
+    print("PG_COPY_UT : Passed")
+
+
+if __name__ == "__main__" :
+    PG_COPY_UT()
@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+"""
+Golden-output regression harness, based on the Wireshark recordings (wireshark_recordings/)
+Extracts the Postgres sessions from the pcapng recordings, feeds the frontend messages through
+tokenization -> parse -> the state machine, with a deterministic stub backend (no SQream server needed),
+and compares the responses, message by message, with :
+    * The server side of the recording (a real Postgres server) - The default. The proxy and the stub backend can not
+      reproduce the server bytes exactly, so the messages are compared by their wire-relevant fields (see
+      recorded_msg_signature), and the turns answered from the proxy's own catalog emulation are listed explicitly
+      in RECORDED_EXCEPTIONS, or
+    * The golden output of the proxy (GOLDEN_DIR), byte by byte - When run with COMPARE_GOLDEN = True, after
+      (re)generating it with UPDATE_GOLDEN = True. Catches any unintended change of the proxy output in a refactor.
+Checks serializer changes for wire compatibility without a running server or client.
+
+References :
+------------
+pcapng format : https://www.ietf.org/archive/id/draft-tuexen-opsawg-pcapng-03.html
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import os
+import glob
+import struct
+
+from pg_statemachine import *
+from pg_capture import read_capture, write_capture, split_to_turns, \
+                       CAPTURE_FILE_SUFFIX, CAPTURE_DIRECTION_IN, CAPTURE_DIRECTION_OUT, \
+                       CAPTURE_RECORD__DIRECTION, CAPTURE_RECORD__TIMESTAMP, CAPTURE_RECORD__PAYLOAD
+
+# ***********************************************
+# * Constants
+# ***********************************************
+RECORDINGS_DIR = "wireshark_recordings"
+GOLDEN_DIR     = os.path.join(RECORDINGS_DIR, "golden")
+PG_SERVER_PORT = 5432
+
+# pcapng blocks
+PCAPNG_SECTION_HEADER_BLOCK    = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESC_BLOCK    = 0x00000001
+PCAPNG_ENHANCED_PACKET_BLOCK   = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC        = 0x1A2B3C4D
+
+# Link layer types
+LINKTYPE_NULL      = 0      # BSD loopback - 4 bytes address family header (Windows loopback captures)
+LINKTYPE_ETHERNET  = 1
+LINKTYPE_RAW       = 101
+LINKTYPE_LOOP      = 108
+ETHERNET_HEADER_LEN    = 14
+ETHERNET_TYPE_IPV4     = 0x0800
+ETHERNET_TYPE_IPV6     = 0x86DD
+IP_PROTOCOL_TCP        = 6
+IPV6_HEADER_LEN        = 40
+
+# Deterministic stub backend fixtures - The "test1" table used in the recordings
+STUB_SCHEMA_NAME = "public"
+STUB_TABLE_NAME  = "test1"
+STUB_TABLE_DDL   = 'create table "public"."test1" (\n"xint" int,\n"xtext" text\n);'
+
+# Postgres type OID to SQream type, for describing recorded results through the stub backend
+STUB_PG_OID_TO_SQREAM_TYPE = {COL_INT_TYPE_OID      : SQREAM_TYPE_INT,
+                              COL_LONG_INT_TYPE_OID : SQREAM_TYPE_INT}
+STUB_PG_INT_OIDS = {COL_INT_TYPE_OID, COL_LONG_INT_TYPE_OID}
+
+# Backend messages skipped when comparing with the recorded server
+RECORDED_SKIPPED_MSG_IDS = {PARAMETER_STATUS_MSG_ID,     # The proxy reports its own parameter set and server_version
+                            BACKEND_KEY_DATA_MSG_ID}     # Harness sessions have no cancel key - The key is random anyway
+
+# Turns of the recorded sessions answered from the proxy's catalog emulation, rather than from the recorded result
+# (session name -> {turn index : reason}). Only the message types and the ReadyForQuery status are compared there
+RECORDED_EXCEPTIONS = {
+    "stage_1__pbi_Initial_connection_59513"    : {2 : "Load all supported types - pg_type rows of the proxy",
+                                                  4 : "INFORMATION_SCHEMA.tables - Only the stub backend tables",
+                                                  6 : "INFORMATION_SCHEMA.tables - Only the stub backend tables"},
+    "stage_2__pbi_Table_selection_59513"       : {0 : "INFORMATION_SCHEMA.columns - Stub backend columns, "
+                                                      "is_nullable reported without the varchar(3) modifier"},
+    "stage_3__pbi_column_selection_59544"      : {2 : "Load all supported types - pg_type rows of the proxy"},
+}
+
+# ***********************************************
+# * pcapng parsing and TCP reassembly
+# ***********************************************
+def read_pcapng_packets(path):
+    """! Read the packets of a pcapng file
+    @return list of tuples (link type, packet bytes), in capture order
+    """
+    with open(path, "rb") as f :
+        data = f.read()
+
+    packets = []
+    link_types = []
+    endian = "<"
+    offset = 0
+    while offset + 8 <= len(data) :
+        block_type = struct.unpack(endian + "I", data[offset : offset + 4])[0]
+        if block_type == PCAPNG_SECTION_HEADER_BLOCK :
+            # Byte order of the section is set by the byte order magic
+            endian = "<" if struct.unpack("<I", data[offset + 8 : offset + 12])[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            link_types = []
+        block_len = struct.unpack(endian + "I", data[offset + 4 : offset + 8])[0]
+        body = data[offset + 8 : offset + block_len - 4]
+
+        if block_type == PCAPNG_INTERFACE_DESC_BLOCK :
+            link_types.append(struct.unpack(endian + "H", body[0:2])[0])
+        elif block_type == PCAPNG_ENHANCED_PACKET_BLOCK :
+            interface_id, ts_high, ts_low, captured_len, original_len = struct.unpack(endian + "IIIII", body[0:20])
+            packets.append((link_types[interface_id], body[20 : 20 + captured_len]))
+
+        offset += block_len
+
+    return packets
+
+def get_tcp_segment(link_type, packet):
+    """! Extract the TCP segment from a captured packet
+    @return tuple (source port, destination port, sequence number, payload), or None for non TCP packets
+    """
+    if link_type in (LINKTYPE_NULL, LINKTYPE_LOOP) :
+        ip_packet = packet[4:]
+    elif link_type == LINKTYPE_ETHERNET :
+        ether_type = struct.unpack("!H", packet[12:14])[0]
+        if ether_type not in (ETHERNET_TYPE_IPV4, ETHERNET_TYPE_IPV6) :
+            return None
+        ip_packet = packet[ETHERNET_HEADER_LEN:]
+    elif link_type == LINKTYPE_RAW :
+        ip_packet = packet
+    else :
+        raise ValueError(f"Unsupported link type {link_type}")
+
+    ip_version = ip_packet[0] >> 4
+    if ip_version == 4 :
+        header_len = (ip_packet[0] & 0x0F) * 4
+        total_len = struct.unpack("!H", ip_packet[2:4])[0]
+        protocol = ip_packet[9]
+        tcp_segment = ip_packet[header_len : total_len]
+    elif ip_version == 6 :
+        payload_len = struct.unpack("!H", ip_packet[4:6])[0]
+        protocol = ip_packet[6]
+        tcp_segment = ip_packet[IPV6_HEADER_LEN : IPV6_HEADER_LEN + payload_len]
+    else :
+        return None
+
+    if protocol != IP_PROTOCOL_TCP :
+        return None
+
+    src_port, dst_port, seq = struct.unpack("!HHI", tcp_segment[0:8])
+    data_offset = (tcp_segment[12] >> 4) * 4
+    return src_port, dst_port, seq, tcp_segment[data_offset:]
+
+def read_pg_sessions(path, server_port = PG_SERVER_PORT):
+    """! Reassemble the Postgres sessions of a recording into session records
+    @param path        pcapng file path
+    @param server_port Postgres server port
+
+    @return dictionary of client port -> session records (in the pg_capture records format).
+            Consecutive segments in the same direction are merged into a single record.
+    """
+    sessions = {}
+    next_seqs = {}      # (client port, direction) -> next expected sequence number, to drop retransmissions
+
+    for index, (link_type, packet) in enumerate(read_pcapng_packets(path)) :
+        segment = get_tcp_segment(link_type, packet)
+        if segment is None :
+            continue
+        src_port, dst_port, seq, payload = segment
+        if server_port not in (src_port, dst_port) or len(payload) == 0 :
+            continue
+
+        direction   = CAPTURE_DIRECTION_OUT if src_port == server_port else CAPTURE_DIRECTION_IN
+        client_port = dst_port if src_port == server_port else src_port
+
+        next_seq = next_seqs.get((client_port, direction))
+        if next_seq is not None and seq != next_seq :
+            continue
+        next_seqs[(client_port, direction)] = (seq + len(payload)) & 0xFFFFFFFF
+
+        records = sessions.setdefault(client_port, [])
+        if len(records) > 0 and records[-1][CAPTURE_RECORD__DIRECTION] == direction :
+            records[-1][CAPTURE_RECORD__PAYLOAD] += payload
+        else :
+            records.append({CAPTURE_RECORD__DIRECTION : direction,
+                            CAPTURE_RECORD__TIMESTAMP : index,       # Deterministic - Packet index
+                            CAPTURE_RECORD__PAYLOAD   : payload})
+    return sessions
+
+def split_backend_msgs(data):
+    """! Split a stream of bytes sent by the server to backend messages
+    @return list of messages bytes (Message ID, Length and payload)
+    """
+    msgs = []
+    while len(data) >= 5 :
+        msg_len = struct.unpack("!i", data[1:5])[0]
+        msgs.append(data[ : msg_len + 1])
+        data = data[msg_len + 1 : ]
+    return msgs
+
+# ***********************************************
+# * Deterministic stub backend
+# ***********************************************
+class StubCursor:
+    """
+    pysqream cursor look-alike, answering from the stub connection fixtures
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query):
+        if query == SQREAM_CATALOG_TABLES_QUERY :
+            self.col_type_tups = [(SQREAM_TYPE_INT, 4), (SQREAM_TYPE_INT, 4), (SQREAM_TYPE_TEXT, 0), (SQREAM_TYPE_TEXT, 0)]
+            self.description   = [("database_name",), ("table_id",), (SQREAM_CATALOG_SCHEMA_NAME,), (SQREAM_CATALOG_TABLE_NAME,)]
+            self.rows          = [(0, 1, STUB_SCHEMA_NAME, STUB_TABLE_NAME)]
+        elif query == SQREAM_CATALOG_COLS_QUERY.format(tbl = STUB_TABLE_NAME) :
+            self.col_type_tups = [(SQREAM_TYPE_TEXT, 0)]
+            self.description   = [("ddl",)]
+            self.rows          = [(STUB_TABLE_DDL,)]
+        else :
+            self.col_type_tups, self.description, self.rows = self.connection.result
+        self.rows = list(self.rows)
+        # Recorded results carry no nullability - Describe all columns as nullable
+        self.col_nul = [True] * len(self.col_type_tups)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+class StubConnection:
+    """
+    pysqream connection look-alike. Regular queries are answered with the result set for the current turn,
+    decoded from the recorded server response (see set_result_from_response)
+    """
+    def __init__(self):
+        self.result = ([], [], [])
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def close(self):
+        pass
+
+    def set_result_from_response(self, response):
+        """! Decode the RowDescription and DataRow messages of a recorded response into the stub result set
+        """
+        col_type_tups, description, type_oids, formats, rows = [], [], [], [], []
+
+        for msg in split_backend_msgs(response) :
+            msg_id, payload = msg[0:1], msg[5:]
+            if msg_id == ROW_DESC_MSG_ID :
+                field_count = struct.unpack("!h", payload[0:2])[0]
+                payload = payload[2:]
+                for i in range(field_count) :
+                    name = payload[ : payload.find(NULL_TERMINATOR)]
+                    payload = payload[len(name) + 1 : ]
+                    table_oid, col_index, type_oid, col_len, type_mod, col_format = struct.unpack("!ihihih", payload[0:18])
+                    payload = payload[18:]
+                    col_type_tups.append((STUB_PG_OID_TO_SQREAM_TYPE.get(type_oid, SQREAM_TYPE_TEXT), col_len))
+                    description.append((name.decode("utf-8"),))
+                    type_oids.append(type_oid)
+                    formats.append(col_format)
+            elif msg_id == DATA_COLS_MSG_ID :
+                field_count = struct.unpack("!h", payload[0:2])[0]
+                payload = payload[2:]
+                row = []
+                for i in range(field_count) :
+                    col_len = struct.unpack("!i", payload[0:4])[0]
+                    value = None if col_len < 0 else payload[4 : 4 + col_len]
+                    payload = payload[4 + max(col_len, 0) : ]
+                    if value is not None and type_oids[i] in STUB_PG_INT_OIDS :
+                        value = int.from_bytes(value, "big", signed = True) if formats[i] == COL_FORMAT_BINARY else int(value)
+                    elif value is not None :
+                        value = value.decode("utf-8")
+                    row.append(value)
+                rows.append(tuple(row))
+
+        self.result = (col_type_tups, description, rows)
+
+# ***********************************************
+# * Harness
+# ***********************************************
+def run_session(records):
+    """! Feed the client side of a session through the state machine
+    @param records session records (pg_capture format)
+
+    @return records of the proxy session - The same inbound frames, followed by the proxy responses
+    """
+    stub_connection = StubConnection()
+    sm = CreatePGStateMachine(stub_connection)
+    output_records = []
+
+    # Recordings which start in the middle of a session (no Startup message) - Start at the query state
+    turns = split_to_turns(records)
+    if len(turns) > 0 and not is_init_message(turns[0][0][CAPTURE_RECORD__PAYLOAD][0:1]) :
+        sm.new_state = QUERY_STATE
+
+    for inbound_record, recorded_response in turns :
+        data = inbound_record[CAPTURE_RECORD__PAYLOAD]
+        output_records.append(inbound_record)
+        stub_connection.set_result_from_response(recorded_response)
+
+        responses = []
+        is_startup_msg = is_init_message(data[0:1])
+        if is_startup_msg :
+            force_initial_state(sm)
+        run_state_machine(sm, parse(tokenization(data, is_startup_msg)), 
+                          lambda output_msgs : responses.append(b"".join(output_msgs)))
+
+        output_records.append({CAPTURE_RECORD__DIRECTION : CAPTURE_DIRECTION_OUT,
+                               CAPTURE_RECORD__TIMESTAMP : inbound_record[CAPTURE_RECORD__TIMESTAMP],
+                               CAPTURE_RECORD__PAYLOAD   : b"".join(responses)})
+    return output_records
+
+def recorded_msg_signature(msg):
+    """! The wire-relevant fields of a backend message, for comparing the proxy output with a recorded server
+        * Authentication request - The request code (an MD5 salt is random)
+        * RowDescription - Name, type OID, type size, type modifier and format of each field. The table OID and
+          column number are left out - The proxy describes its own (pseudo) table
+        * Any other message (CommandComplete tag, ReadyForQuery status, DataRow, ...) - The whole message
+    """
+    msg_id, payload = msg[0:1], msg[5:]
+    if msg_id == AUTHENTICATION_REQUEST_MSG_ID :
+        return msg_id, payload[0:4]
+    if msg_id == ROW_DESC_MSG_ID :
+        fields = []
+        field_count = struct.unpack("!h", payload[0:2])[0]
+        payload = payload[2:]
+        for i in range(field_count) :
+            name = payload[ : payload.find(NULL_TERMINATOR)]
+            payload = payload[len(name) + 1 : ]
+            table_oid, col_index, type_oid, col_len, type_mod, col_format = struct.unpack("!ihihih", payload[0:18])
+            payload = payload[18:]
+            fields.append((name, type_oid, col_len, type_mod, col_format))
+        return msg_id, tuple(fields)
+    return msg_id, payload
+
+def compare_msgs(turn_index, expected_msgs, actual_msgs, differences):
+    """! Compare two lists of messages (bytes, or signatures), reporting the first difference
+    """
+    for msg_index in range(max(len(expected_msgs), len(actual_msgs))) :
+        expected_msg = expected_msgs[msg_index] if msg_index < len(expected_msgs) else None
+        actual_msg   = actual_msgs[msg_index]   if msg_index < len(actual_msgs)   else None
+        if expected_msg != actual_msg :
+            differences.append("turn {} message {} : expected {} got {}".format(turn_index, msg_index,
+                                                                                str(expected_msg)[:80], str(actual_msg)[:80]))
+            break
+
+def compare_sessions(expected_records, actual_records):
+    """! Byte-compare two sessions, message by message
+    @return list of differences strings (empty if identical)
+    """
+    differences = []
+    expected_turns = split_to_turns(expected_records)
+    actual_turns   = split_to_turns(actual_records)
+
+    for turn_index, ((expected_in, expected_out), (actual_in, actual_out)) in enumerate(zip(expected_turns, actual_turns)) :
+        compare_msgs(turn_index, split_backend_msgs(expected_out), split_backend_msgs(actual_out), differences)
+    return differences
+
+def summarize_msg_types(msgs):
+    """! Message types of a response, with a run of DataRows counted as one, and the ReadyForQuery status
+    """
+    msg_types = []
+    for msg in msgs :
+        msg_id = msg[0:1]
+        if msg_id == DATA_COLS_MSG_ID and len(msg_types) > 0 and msg_types[-1] == msg_id :
+            continue
+        msg_types.append(msg if msg_id == READY_FOR_QUERY_MSG_ID else msg_id)
+    return msg_types
+
+def compare_recorded_session(recorded_records, actual_records, exceptions = {}):
+    """! Compare a session with the recorded server side, by the wire-relevant fields of each message
+    @param exceptions {turn index : reason} - Turns where only the message types (any number of DataRows)
+                      and the ReadyForQuery status are compared
+
+    @return list of differences strings (empty if equivalent)
+    """
+    differences = []
+    recorded_turns = split_to_turns(recorded_records)
+    actual_turns   = split_to_turns(actual_records)
+
+    for turn_index, ((recorded_in, recorded_out), (actual_in, actual_out)) in enumerate(zip(recorded_turns, actual_turns)) :
+        recorded_msgs = [msg for msg in split_backend_msgs(recorded_out) if msg[0:1] not in RECORDED_SKIPPED_MSG_IDS]
+        actual_msgs   = [msg for msg in split_backend_msgs(actual_out)   if msg[0:1] not in RECORDED_SKIPPED_MSG_IDS]
+        if turn_index in exceptions :
+            compare_msgs(turn_index, summarize_msg_types(recorded_msgs), summarize_msg_types(actual_msgs), differences)
+        else :
+            compare_msgs(turn_index, [recorded_msg_signature(msg) for msg in recorded_msgs],
+                                     [recorded_msg_signature(msg) for msg in actual_msgs], differences)
+    return differences
+
+def golden_path(recording_path, client_port):
+    name = os.path.splitext(os.path.basename(recording_path))[0]
+    return os.path.join(GOLDEN_DIR, "{}_{}{}".format(name, client_port, CAPTURE_FILE_SUFFIX))
+
+def run_golden_harness(recordings_dir = RECORDINGS_DIR, update_golden = False, compare_golden = False):
+    """! Run all the recorded sessions through the state machine, and compare with the recorded (or golden) output
+    @param update_golden True - (Re)write the golden output files from the current proxy output
+    @param compare_golden True - Byte-compare with the golden output files, rather than with the recorded server
+
+    @return dictionary of session name -> list of differences (or of the exception string, if the session failed)
+    """
+    results = {}
+    for recording_path in sorted(glob.glob(os.path.join(recordings_dir, "*", "*.pcapng"))) :
+        for client_port, records in read_pg_sessions(recording_path).items() :
+            session_golden_path = golden_path(recording_path, client_port)
+            session_name = os.path.splitext(os.path.basename(session_golden_path))[0]
+            try :
+                actual_records = run_session(records)
+            except Exception as e :
+                results[session_name] = ["failed : {!r}".format(e)]
+                continue
+
+            if update_golden :
+                os.makedirs(GOLDEN_DIR, exist_ok = True)
+                write_capture(session_golden_path, actual_records)
+                results[session_name] = []
+            elif compare_golden :
+                results[session_name] = compare_sessions(read_capture(session_golden_path), actual_records)
+            else :
+                results[session_name] = compare_recorded_session(records, actual_records,
+                                                                 RECORDED_EXCEPTIONS.get(session_name, {}))
+    return results
+
+
+if __name__ == "__main__" :
+    UPDATE_GOLDEN  = False
+    COMPARE_GOLDEN = False
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = run_golden_harness(update_golden = UPDATE_GOLDEN, compare_golden = COMPARE_GOLDEN)
+    for session_name, differences in results.items() :
+        print("[{}] {}".format("+" if len(differences) == 0 else "-", session_name))
+        for difference in differences :
+            print("        " + difference)
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+"""
+Local answering of session-level and trivial queries
+Clients send session settings (SET / RESET / SHOW), SELECT version() / current_schema() and "SELECT 1" health checks,
+and BEGIN / COMMIT around their queries. SQream does not know these Postgres commands, and the backend connections
+are shared by the sessions over time (see pg_backend_pool), so they are answered by the proxy from the session
+parameters, without a backend round trip :
+    * SET / RESET change the session parameters. Changes of the parameters Postgres reports (REPORTED_PARAMETERS,
+      e.g. application_name, TimeZone) are sent to the client with ParameterStatus messages.
+    * statement_timeout is enforced by the proxy (see pg_cancel).
+    * BEGIN / COMMIT / ROLLBACK are no-ops - The backend runs each statement on its own (autocommit).
+Queries are recognized as a whole (a single statement, with an optional trailing semicolon) - Anything else goes to
+the backend. A query text with several statements (e.g. "BEGIN; DELETE FROM t") is never answered locally, so no
+statement is dropped.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import re
+
+from pg_serdes import *
+from pg_cancel import STATEMENT_TIMEOUT_PARAMETER, parse_statement_timeout, get_default_statement_timeout
+
+# ***********************************************
+# * Constants
+# ***********************************************
+# Parameters reported with ParameterStatus at startup, in order - Fixed by the proxy, startup parameters do not change them
+STARTUP_PARAMETER_STATUS = (("client_encoding",             "UTF8"),
+                            ("DateStyle",                   "ISO, MDY"),
+                            ("integer_datetimes",           "on"),
+                            ("IntervalStyle",               "postgres"),
+                            ("is_superuser",                "on"),
+                            ("server_encoding",             "UTF8"),
+                            ("server_version",              "12.7"),
+                            ("session_authorization",       "postgres"),
+                            ("standard_conforming_strings", "on"))
+
+# Other session parameters - Their startup parameters, if given, are the session defaults
+SESSION_PARAMETER_DEFAULTS = {"application_name"              : "",
+                              "timezone"                      : "UTC",
+                              "search_path"                   : '"$user", public',
+                              "extra_float_digits"            : "1",
+                              "transaction_isolation"         : "read committed",
+                              "default_transaction_isolation" : "read committed",
+                              "max_identifier_length"         : "63"}
+
+# Parameters Postgres reports with ParameterStatus when they change (GUC_REPORT), by lower case name
+REPORTED_PARAMETERS = {"application_name" : "application_name", "client_encoding" : "client_encoding",
+                       "datestyle" : "DateStyle", "integer_datetimes" : "integer_datetimes",
+                       "intervalstyle" : "IntervalStyle", "is_superuser" : "is_superuser",
+                       "server_encoding" : "server_encoding", "server_version" : "server_version",
+                       "session_authorization" : "session_authorization",
+                       "standard_conforming_strings" : "standard_conforming_strings", "timezone" : "TimeZone"}
+
+READ_ONLY_PARAMETERS  = ("integer_datetimes", "is_superuser", "server_encoding", "server_version",
+                         "session_authorization", "max_identifier_length")
+CLIENT_ENCODING_PARAMETER = "client_encoding"
+CLIENT_ENCODING_VALUES    = ("UTF8", "UTF-8", "UNICODE")
+STARTUP_CONNECTION_PARAMETERS = ("user", "database", "options", "replication")   # Not session parameters
+
+# Multi-word parameter names of SHOW / RESET / SET
+PARAMETER_ALIASES = {"time zone" : "timezone", "transaction isolation level" : "transaction_isolation"}
+PARAMETER_ALL     = "all"
+
+# Kinds of local queries
+LOCAL_QUERY_SET_TRANSACTION = "SET_TRANSACTION"
+LOCAL_QUERY_SET_TIME_ZONE   = "SET_TIME_ZONE"
+LOCAL_QUERY_SET             = "SET"
+LOCAL_QUERY_RESET           = "RESET"
+LOCAL_QUERY_SHOW            = "SHOW"
+LOCAL_QUERY_TRANSACTION     = "TRANSACTION"
+LOCAL_QUERY_SELECT_FUNCTION = "SELECT_FUNCTION"
+LOCAL_QUERY_SELECT_INTEGER  = "SELECT_INTEGER"
+
+# Recognized queries - Matched on the whole query, without its trailing semicolon
+# Keywords which may follow a select list - Not taken for a column alias (e.g. "SELECT 1 LIMIT")
+LOCAL_QUERY_RESERVED_WORDS = ("all", "and", "as", "asc", "case", "desc", "distinct", "else", "end", "except", "fetch",
+                              "for", "from", "group", "having", "in", "intersect", "into", "is", "limit", "not", "null",
+                              "offset", "on", "or", "order", "returning", "union", "where", "window", "with")
+LOCAL_QUERY_ALIAS_REGEXP = r"(?:\s+(?:AS\s+)?(?P<alias>(?!(?:" + "|".join(LOCAL_QUERY_RESERVED_WORDS) + r")\b)[a-z_]\w*|\"[^\"]+\"))?"
+LOCAL_QUERY_REGEXPS = ((LOCAL_QUERY_SET_TRANSACTION, r"SET\s+(?:TRANSACTION|SESSION\s+CHARACTERISTICS\s+AS\s+TRANSACTION)\b.*"),
+                       (LOCAL_QUERY_SET_TIME_ZONE,   r"SET\s+(?:SESSION\s+|LOCAL\s+)?TIME\s+ZONE\s+(?P<value>.+)"),
+                       (LOCAL_QUERY_SET,             r"SET\s+(?:SESSION\s+|LOCAL\s+)?(?P<name>[a-z_][\w.]*)\s*(?:=|\bTO\b)\s*(?P<value>.+)"),
+                       (LOCAL_QUERY_RESET,           r"RESET\s+(?P<name>TIME\s+ZONE|[a-z_][\w.]*)"),
+                       (LOCAL_QUERY_SHOW,            r"SHOW\s+(?P<name>TIME\s+ZONE|TRANSACTION\s+ISOLATION\s+LEVEL|[a-z_][\w.]*)"),
+                       (LOCAL_QUERY_TRANSACTION,     r"(?P<command>BEGIN|START\s+TRANSACTION|COMMIT|END|ROLLBACK|ABORT)\b.*"),
+                       (LOCAL_QUERY_SELECT_FUNCTION, r"SELECT\s+(?:pg_catalog\.)?(?P<function>version|current_schema|current_database|"
+                                                     r"current_catalog|current_user|session_user)\s*(?:\(\s*\))?" + LOCAL_QUERY_ALIAS_REGEXP),
+                       (LOCAL_QUERY_SELECT_INTEGER,  r"SELECT\s+(?P<value>[+-]?\d{1,10})" + LOCAL_QUERY_ALIAS_REGEXP))
+
+# Command tags of the transaction commands
+TRANSACTION_COMMAND_TAGS = {"BEGIN" : "BEGIN", "START TRANSACTION" : "START TRANSACTION", "COMMIT" : "COMMIT",
+                            "END" : "COMMIT", "ROLLBACK" : "ROLLBACK", "ABORT" : "ROLLBACK"}
+
+# Functions that need a parenthesized argument list, and the integer constant column name
+LOCAL_FUNCTIONS_WITH_ARGS = ("version", "current_schema", "current_database")
+INTEGER_COLUMN_NAME = "?column?"
+INT4_MIN, INT4_MAX  = -2 ** 31, 2 ** 31 - 1
+
+SHOW_ALL_COLUMNS = ("name", "setting", "description")
+
+# Local query result keys
+LOCAL_QUERY__COLS_DESC   = "cols_desc"
+LOCAL_QUERY__ROWS        = "rows"
+LOCAL_QUERY__COMMAND_TAG = "command_tag"            # None - SELECT <number of rows>
+LOCAL_QUERY__CHANGED_PARAMETERS = "changed_parameters"  # (name, value) of the reported parameters that changed
+
+# ***********************************************
+# * Session parameters
+# ***********************************************
+class LocalQueryError(PG_Error):
+    """
+    A session setting or trivial query answered by the proxy failed (e.g. an unknown or read only parameter)
+    """
+
+def create_session_parameters(startup_parameters) :
+    """! Parameters of a new session - The server defaults, and the client startup parameters
+    @param startup_parameters Parameters of the client Startup message
+    @return dictionary of lower case parameter name -> value
+    """
+    parameters = {name.lower() : value for name, value in STARTUP_PARAMETER_STATUS}
+    parameters.update(SESSION_PARAMETER_DEFAULTS)
+    parameters[STATEMENT_TIMEOUT_PARAMETER] = str(get_default_statement_timeout({}))
+    fixed_names = [name.lower() for name, value in STARTUP_PARAMETER_STATUS]
+    for name, value in startup_parameters.items() :
+        name = name.lower()
+        if name not in STARTUP_CONNECTION_PARAMETERS and name not in fixed_names :
+            parameters[name] = value
+    return parameters
+
+def get_changed_parameters(old_parameters, parameters) :
+    """! @return (name, value) of the reported parameters whose value changed, for ParameterStatus messages
+    """
+    return [(REPORTED_PARAMETERS[name], parameters[name]) for name in REPORTED_PARAMETERS
+            if name in parameters and parameters[name] != old_parameters.get(name)]
+
+def reset_parameters(parameters, startup_parameters, name = PARAMETER_ALL) :
+    """! RESET a parameter (or all) to its session default
+    @return (name, value) of the reported parameters that changed
+    """
+    old_parameters = dict(parameters)
+    defaults = create_session_parameters(startup_parameters)
+    if name == PARAMETER_ALL :
+        parameters.clear()
+        parameters.update(defaults)
+    elif name in defaults :
+        parameters[name] = defaults[name]
+    else :
+        parameters.pop(name, None)
+    return get_changed_parameters(old_parameters, parameters)
+
+def get_parameter_name(name) :
+    return PARAMETER_ALIASES.get(" ".join(name.lower().split()), name.lower())
+
+def get_parameter_value(value) :
+    """! Value of a SET command - A quoted literal is unquoted, other values (numbers, identifiers, lists) are kept
+    """
+    value = value.strip()
+    if re.fullmatch(r"'(?:[^']|'')*'", value) :
+        return value[1:-1].replace("''", "'")
+    return value
+
+def set_parameter(parameters, startup_parameters, name, value) :
+    """! SET a parameter - SET name TO DEFAULT is RESET name
+    @return (name, value) of the reported parameters that changed
+    @raise LocalQueryError for a read only parameter, or an invalid value
+    """
+    if value.upper() == "DEFAULT" :
+        return reset_parameters(parameters, startup_parameters, name)
+    value = get_parameter_value(value)
+
+    if name in READ_ONLY_PARAMETERS :
+        raise LocalQueryError(SQLSTATE_CANT_CHANGE_RUNTIME_PARAM, 'parameter "{}" cannot be changed'.format(name))
+    if name == CLIENT_ENCODING_PARAMETER :
+        if value.upper() not in CLIENT_ENCODING_VALUES :
+            raise LocalQueryError(SQLSTATE_INVALID_PARAMETER_VALUE,
+                                  'invalid value for parameter "{}": "{}"'.format(name, value))
+        value = CLIENT_ENCODING_VALUES[0]
+    elif name == STATEMENT_TIMEOUT_PARAMETER :
+        try :
+            parse_statement_timeout(value)
+        except ValueError as e :
+            raise LocalQueryError(SQLSTATE_INVALID_PARAMETER_VALUE, str(e))
+
+    old_parameters = dict(parameters)
+    parameters[name] = value
+    return get_changed_parameters(old_parameters, parameters)
+
+def get_current_schema(parameters) :
+    """! First schema of the search path, "$user" skipped as the proxy has no user schemas
+    """
+    for schema in parameters.get("search_path", "").split(",") :
+        schema = schema.strip().strip('"')
+        if schema not in ("", "$user") :
+            return schema
+    return "public"
+
+# ***********************************************
+# * Local queries
+# ***********************************************
+def normalize_local_query(query) :
+    return query.rstrip("\x00").strip().rstrip(";").strip()
+
+def match_local_query(query) :
+    """! @return (query kind, match), None if the query is not answered locally - Also for several statements
+    """
+    statements = split_query_statements(query.rstrip("\x00"))
+    if len(statements) != 1 :
+        return None
+    query = normalize_local_query(statements[0])
+    for kind, regexp in LOCAL_QUERY_REGEXPS :
+        match = re.fullmatch(regexp, query, re.IGNORECASE)
+        if match is None :
+            continue
+        if kind == LOCAL_QUERY_SELECT_FUNCTION and match.group("function").lower() in LOCAL_FUNCTIONS_WITH_ARGS and \
+           "(" not in match.group(0) :
+            return None
+        if kind == LOCAL_QUERY_SELECT_INTEGER and not INT4_MIN <= int(match.group("value")) <= INT4_MAX :
+            return None
+        return kind, match
+    return None
+
+def is_local_query(query) :
+    """! Identify the queries answered by the proxy
+    @param query: Input string query
+
+    @return Boolean: True if local query, False otherwise.
+    """
+    return match_local_query(query) is not None
+
+def prepare_local_cols_desc(cols_name, cols_type) :
+    return prepare_cols_desc(list(cols_name), list(cols_type),
+                             [4 if col_type == COL_INT_TYPE_OID else VARIABLE_LENGTH for col_type in cols_type],
+                             [COL_FORMAT_TEXT] * len(cols_name))
+
+def get_column_name(match, default_name) :
+    alias = match.group("alias")
+    if alias is None :
+        return default_name
+    return alias[1:-1] if alias.startswith('"') else alias.lower()
+
+def describe_local_query(query) :
+    """! Columns description of a local query, without running it (Describe message)
+    @return cols_desc, empty for commands without rows
+    """
+    kind, match = match_local_query(query)
+    if kind == LOCAL_QUERY_SHOW :
+        name = get_parameter_name(match.group("name"))
+        if name == PARAMETER_ALL :
+            return prepare_local_cols_desc(SHOW_ALL_COLUMNS, [COL_TEXT_TYPE_3_OID] * len(SHOW_ALL_COLUMNS))
+        return prepare_local_cols_desc([name], [COL_TEXT_TYPE_3_OID])
+    if kind == LOCAL_QUERY_SELECT_FUNCTION :
+        return prepare_local_cols_desc([get_column_name(match, match.group("function").lower())], [COL_TEXT_TYPE_3_OID])
+    if kind == LOCAL_QUERY_SELECT_INTEGER :
+        return prepare_local_cols_desc([get_column_name(match, INTEGER_COLUMN_NAME)], [COL_INT_TYPE_OID])
+    return []
+
+def run_local_query(query, parameters, startup_parameters) :
+    """! Answer a local query from the session parameters
+    @param query              Query string (see is_local_query)
+    @param parameters         Session parameters (see create_session_parameters) - Updated by SET / RESET
+    @param startup_parameters Parameters of the client Startup message
+    @return local query result - LOCAL_QUERY__COLS_DESC, LOCAL_QUERY__ROWS, LOCAL_QUERY__COMMAND_TAG and
+            LOCAL_QUERY__CHANGED_PARAMETERS
+    @raise LocalQueryError if the query failed
+    """
+    kind, match = match_local_query(query)
+    res = {LOCAL_QUERY__COLS_DESC          : describe_local_query(query),
+           LOCAL_QUERY__ROWS               : [],
+           LOCAL_QUERY__COMMAND_TAG        : None,
+           LOCAL_QUERY__CHANGED_PARAMETERS : []}
+
+    if kind == LOCAL_QUERY_SET_TRANSACTION :
+        res[LOCAL_QUERY__COMMAND_TAG] = "SET"
+    elif kind in (LOCAL_QUERY_SET, LOCAL_QUERY_SET_TIME_ZONE) :
+        name = get_parameter_name(match.group("name") if kind == LOCAL_QUERY_SET else "time zone")
+        res[LOCAL_QUERY__CHANGED_PARAMETERS] = set_parameter(parameters, startup_parameters, name, match.group("value"))
+        res[LOCAL_QUERY__COMMAND_TAG] = "SET"
+    elif kind == LOCAL_QUERY_RESET :
+        name = get_parameter_name(match.group("name"))
+        res[LOCAL_QUERY__CHANGED_PARAMETERS] = reset_parameters(parameters, startup_parameters, name)
+        res[LOCAL_QUERY__COMMAND_TAG] = "RESET"
+    elif kind == LOCAL_QUERY_SHOW :
+        name = get_parameter_name(match.group("name"))
+        if name == PARAMETER_ALL :
+            res[LOCAL_QUERY__ROWS] = [[REPORTED_PARAMETERS.get(parameter, parameter), value, ""]
+                                      for parameter, value in sorted(parameters.items())]
+        elif name in parameters :
+            res[LOCAL_QUERY__ROWS] = [[parameters[name]]]
+        else :
+            raise LocalQueryError(SQLSTATE_UNDEFINED_OBJECT, 'unrecognized configuration parameter "{}"'.format(name))
+        res[LOCAL_QUERY__COMMAND_TAG] = "SHOW"
+    elif kind == LOCAL_QUERY_TRANSACTION :
+        res[LOCAL_QUERY__COMMAND_TAG] = TRANSACTION_COMMAND_TAGS[" ".join(match.group("command").upper().split())]
+    elif kind == LOCAL_QUERY_SELECT_FUNCTION :
+        function = match.group("function").lower()
+        user = startup_parameters.get("user", parameters["session_authorization"])
+        values = {"version"          : "PostgreSQL {} (pg_mimic proxy for SQream)".format(parameters["server_version"]),
+                  "current_schema"   : get_current_schema(parameters),
+                  "current_database" : startup_parameters.get("database", user),
+                  "current_catalog"  : startup_parameters.get("database", user),
+                  "current_user"     : user,
+                  "session_user"     : user}
+        res[LOCAL_QUERY__ROWS] = [[values[function]]]
+    elif kind == LOCAL_QUERY_SELECT_INTEGER :
+        res[LOCAL_QUERY__ROWS] = [[int(match.group("value"))]]
+
+    logging.info("run_local_query : Answered {} query locally".format(kind))
+    return res
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+"""
+Parallel encoding of large results - DataRow batches encoded by a pool of worker processes
+Encoding is pure Python and CPU bound, so a single streamed query is capped by one core. In parallel mode
+(PARALLEL_ENCODE_PROCESSES > 0), the stream producer (see pg_stream) keeps fetching batches from the backend,
+and hands them to a process pool, with up to PARALLEL_ENCODE_DEPTH batches being encoded at a time.
+The encoded batches are returned in order, so the session thread sends them as if they were encoded in place.
+
+Batches are passed through shared memory (multiprocessing.shared_memory), instead of pickling them :
+    * Input  - The arrays and text buffers of the column batches are copied to a segment created by the session process.
+               Columns of Python values (e.g. with NULLs, dates) are pickled with the task.
+    * Output - The worker encodes the batch to a segment it creates, and the session process copies it to a pooled
+               output buffer (see pg_buffers), then frees the segment.
+
+Only streamed DataRow results are encoded in parallel - The first batch of a result (which holds the results that
+are not streamed) is always encoded in the session thread.
+
+References :
+------------
+shared_memory : https://docs.python.org/3/library/multiprocessing.shared_memory.html
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import array
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
+
+from sqream_backend import TextBuffer
+from pg_serdes import D_Msg_DataCols_Serialize
+from pg_stream import BatchEncoder
+from pg_buffers import acquire_output_buffer, release_output_buffers
+
+# ***********************************************
+# * Constants
+# ***********************************************
+PARALLEL_ENCODE_PROCESSES = 0       # Encoding processes, 0 - Encode in the session process (no pool)
+PARALLEL_ENCODE_DEPTH     = None    # Batches being encoded at a time per stream, None - The number of processes + 1
+
+# Start method of the pool processes - Not forked from the multithreaded server process
+PARALLEL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Shared column batch layout kinds
+SHARED_COL_ARRAY  = "array"         # (kind, typecode, offset, length)
+SHARED_COL_TEXT   = "text"          # (kind, data offset, data length, offsets offset, offsets length)
+SHARED_COL_VALUES = "values"        # (kind, list of values)
+
+# ***********************************************
+# * Shared memory transport
+# ***********************************************
+def put_shared_cols(cols) :
+    """! Copy column batches to a new shared memory segment
+    @return (SharedMemory, layout) - layout describes each column in the segment (see SHARED_COL_*)
+    """
+    parts  = []
+    layout = []
+    offset = 0
+    for col in cols :
+        if isinstance(col, array.array) :
+            part = memoryview(col).cast('B')
+            layout.append((SHARED_COL_ARRAY, col.typecode, offset, len(part)))
+            parts.append(part)
+            offset += len(part)
+        elif isinstance(col, TextBuffer) :
+            offsets = memoryview(col.offsets).cast('B')
+            layout.append((SHARED_COL_TEXT, offset, len(col.data), offset + len(col.data), len(offsets)))
+            parts += [col.data, offsets]
+            offset += len(col.data) + len(offsets)
+        else :
+            layout.append((SHARED_COL_VALUES, col))
+
+    segment = shared_memory.SharedMemory(create = True, size = max(offset, 1))
+    offset = 0
+    for part in parts :
+        segment.buf[offset : offset + len(part)] = part
+        offset += len(part)
+    return segment, layout
+
+def get_shared_cols(buf, layout) :
+    """! Column batches copied from a shared memory segment (see put_shared_cols)
+    """
+    cols = []
+    for col_layout in layout :
+        if col_layout[0] == SHARED_COL_ARRAY :
+            _, typecode, offset, length = col_layout
+            col = array.array(typecode)
+            col.frombytes(buf[offset : offset + length])
+        elif col_layout[0] == SHARED_COL_TEXT :
+            _, data_offset, data_length, offsets_offset, offsets_length = col_layout
+            offsets = array.array('q')
+            offsets.frombytes(buf[offsets_offset : offsets_offset + offsets_length])
+            col = TextBuffer.from_buffers(bytes(buf[data_offset : data_offset + data_length]), offsets)
+        else :
+            col = col_layout[1]
+        cols.append(col)
+    return cols
+
+def encode_shared_cols(cols_desc, segment_name, layout) :
+    """! Pool process task - Encode the DataRows of column batches in shared memory, to a new shared memory segment
+    @return (name of the output segment, number of bytes), or (None, 0) for an empty batch
+    """
+    segment = shared_memory.SharedMemory(name = segment_name)
+    try :
+        cols = get_shared_cols(segment.buf, layout)
+    finally :
+        segment.close()
+
+    msg = D_Msg_DataCols_Serialize(cols_desc, cols)
+    if len(msg) == 0 :
+        return None, 0
+
+    output = shared_memory.SharedMemory(create = True, size = len(msg))
+    output.buf[: len(msg)] = msg
+    # The session process frees the segment - Not this process resource tracker
+    resource_tracker.unregister(output._name, "shared_memory")
+    output.close()
+    release_output_buffers([msg])
+    return output.name, len(msg)
+
+def take_shared_output(segment_name, size) :
+    """! Copy an encoded batch from its shared memory segment to a pooled output buffer, and free the segment
+    """
+    segment = shared_memory.SharedMemory(name = segment_name)
+    try :
+        buffer = acquire_output_buffer(size)
+        buffer[:] = segment.buf[: size]
+    finally :
+        segment.close()
+        segment.unlink()
+    return buffer
+
+# ***********************************************
+# * Encoding pool
+# ***********************************************
+ENCODE_POOL      = None
+ENCODE_POOL_LOCK = threading.Lock()
+
+def get_encode_pool() :
+    """! The process pool of the worker process, started on first use
+    """
+    global ENCODE_POOL
+    with ENCODE_POOL_LOCK :
+        if ENCODE_POOL is None :
+            ENCODE_POOL = concurrent.futures.ProcessPoolExecutor(max_workers = PARALLEL_ENCODE_PROCESSES,
+                                                                 mp_context = multiprocessing.get_context(PARALLEL_START_METHOD))
+            logging.info("get_encode_pool : Started %d encoding processes (%s)", PARALLEL_ENCODE_PROCESSES, PARALLEL_START_METHOD)
+        return ENCODE_POOL
+
+class ParallelBatchEncoder:
+    """
+    Encodes the DataRows of fetched batches in the pool processes - Same interface as BatchEncoder (see pg_stream).
+    The batch sizer is tuned when a batch encoding completes.
+    """
+    def __init__(self, cols_desc, batch_sizer, depth = None):
+        self.cols_desc   = cols_desc
+        self.batch_sizer = batch_sizer
+        self.depth       = depth or PARALLEL_ENCODE_DEPTH or PARALLEL_ENCODE_PROCESSES + 1
+        self.pool        = get_encode_pool()
+        self.pending     = collections.deque()      # (future, input segment, number of rows, fetch seconds), in order
+
+    def encode(self, cols, num_of_rows, fetch_seconds):
+        """! Queue a fetched batch for encoding
+        @return list of the encoded batches ready to be sent, in order - Waits for the oldest batch when
+                PARALLEL_ENCODE_DEPTH batches are being encoded
+        """
+        if num_of_rows > 0 :
+            segment, layout = put_shared_cols(cols)
+            try :
+                future = self.pool.submit(encode_shared_cols, self.cols_desc, segment.name, layout)
+            except Exception :
+                segment.close()
+                segment.unlink()
+                raise
+            self.pending.append((future, segment, num_of_rows, fetch_seconds))
+
+        msgs = []
+        while len(self.pending) > 0 and (len(self.pending) >= self.depth or self.pending[0][0].done()) :
+            msgs += self.take_oldest()
+        return msgs
+
+    def flush(self):
+        msgs = []
+        while len(self.pending) > 0 :
+            msgs += self.take_oldest()
+        return msgs
+
+    def take_oldest(self):
+        future, segment, num_of_rows, fetch_seconds = self.pending.popleft()
+        try :
+            segment_name, size = future.result()
+        finally :
+            segment.close()
+            segment.unlink()
+
+        if segment_name is None :
+            return []
+        self.batch_sizer.observe(num_of_rows, size, fetch_seconds)
+        return [take_shared_output(segment_name, size)]
+
+    def close(self):
+        """! Drop the batches not taken (e.g. the client went away) - Frees their shared memory
+        """
+        while len(self.pending) > 0 :
+            future, segment, _, _ = self.pending.popleft()
+            if not future.cancel() :
+                try :
+                    segment_name, size = future.result()
+                    if segment_name is not None :
+                        release_output_buffers([take_shared_output(segment_name, size)])
+                except Exception as e :
+                    logging.error("ParallelBatchEncoder : Dropped batch encoding failed - %s", e)
+            segment.close()
+            segment.unlink()
+
+def create_batch_encoder(encode_cols, batch_sizer, data_rows_cols_desc = None) :
+    """! Encoder of the streamed batches of a result
+    @param encode_cols         function (column batches) -> packed bytes
+    @param data_rows_cols_desc Columns description, if encode_cols packs DataRows - Encoded in parallel
+                               when PARALLEL_ENCODE_PROCESSES > 0
+
+    @return BatchEncoder / ParallelBatchEncoder
+    """
+    if PARALLEL_ENCODE_PROCESSES > 0 and data_rows_cols_desc is not None :
+        return ParallelBatchEncoder(data_rows_cols_desc, batch_sizer)
+    return BatchEncoder(encode_cols, batch_sizer)
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+"""
+On-demand profiling of pg_mimic sessions
+Arms a profiler for the next N queries and/or N seconds, on all sessions or on selected ones
+(sessions are identified by their client port, as in the pg_server_proxy log lines).
+Activated at runtime, without restarting the server, by :
+    * A signal (SIGUSR1 toggles profiling with the default settings), or
+    * An admin query, e.g. : PG_MIMIC PROFILE queries=100 seconds=60 session=51234 mode=sample
+When not armed, the only cost is a single attribute check per received client request.
+
+Output files (in PROFILER_OUTPUT_DIR) :
+    * cprofile mode : <session>_<time>.pstats     - Open with pstats / snakeviz
+    * sample mode   : <session>_<time>.collapsed  - Collapsed stacks, for flamegraph.pl / speedscope
+
+References :
+------------
+cProfile :      https://docs.python.org/3/library/profile.html
+Flame graphs :  https://github.com/brendangregg/FlameGraph
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import os
+import re
+import sys
+import math
+import time
+import signal
+import cProfile
+import threading
+
+from pg_serdes import PG_Error, SQLSTATE_INVALID_PARAMETER_VALUE
+
+# ***********************************************
+# * Constants
+# ***********************************************
+PROFILER_MODE_CPROFILE = "cprofile"
+PROFILER_MODE_SAMPLE   = "sample"
+
+PROFILER_OUTPUT_DIR        = "profiles"
+PROFILER_DEFAULT_QUERIES   = 100        # Used when armed by signal
+PROFILER_DEFAULT_SECONDS   = None
+PROFILER_SAMPLE_INTERVAL   = 0.001      # Seconds between two stack samples
+
+# Admin query : PG_MIMIC PROFILE [queries=N] [seconds=S] [session=PORT[,PORT...]] [mode=cprofile|sample] | [off]
+PROFILER_ADMIN_QUERY_REG_EXPR = r"^\s*PG_MIMIC\s+PROFILE\b(.*?)[\s;]*$"
+PROFILER_ADMIN_OPTION_REG_EXPR = r"(\w+)\s*=\s*([\w.,]+)"
+PROFILER_ADMIN_OFF = "off"
+PROFILER_ADMIN_COMMAND_TAG = "PG_MIMIC PROFILE"
+PROFILER_ADMIN_OPTIONS = ("queries", "seconds", "session", "mode")
+
+# ***********************************************
+# * Profiler implementation
+# ***********************************************
+class ProfilerAdminError(PG_Error):
+    """
+    Invalid option of the profiler admin query
+    """
+    def __init__(self, message):
+        super().__init__(SQLSTATE_INVALID_PARAMETER_VALUE, message)
+
+class SamplingProfiler:
+    """
+    Lightweight sampling profiler, based on sys._current_frames().
+    Samples the stack of a single thread, and accumulates collapsed stacks counts.
+    """
+    def __init__(self, interval = PROFILER_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks   = {}
+
+    def run(self, func, *args):
+        """! Run func while sampling the calling thread stack in a background thread
+        @return func return value
+        """
+        target_thread_id = threading.get_ident()
+        is_done = threading.Event()
+
+        def sampler() :
+            while not is_done.wait(self.interval) :
+                frame = sys._current_frames().get(target_thread_id)
+                if frame is not None :
+                    self.add_sample(frame)
+
+        sampler_thread = threading.Thread(target = sampler, daemon = True)
+        sampler_thread.start()
+        try :
+            return func(*args)
+        finally :
+            is_done.set()
+            sampler_thread.join()
+
+    def add_sample(self, frame):
+        stack = []
+        while frame is not None :
+            code = frame.f_code
+            stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        collapsed = ";".join(reversed(stack))
+        self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+
+    def dump(self, path):
+        with open(path, "w") as f :
+            for stack, count in self.stacks.items() :
+                f.write("{} {}\n".format(stack, count))
+
+
+class ProfilingController:
+    """
+    Holds the profiling "armed" window, and the per-session profilers collected during it.
+    A single instance (PROFILER) is shared by all sessions.
+    """
+    def __init__(self):
+        self.lock          = threading.Lock()
+        self.is_armed      = False
+        self.mode          = PROFILER_MODE_CPROFILE
+        self.queries_left  = None
+        self.deadline      = None
+        self.sessions      = None       # None - profile all sessions
+        self.output_dir    = PROFILER_OUTPUT_DIR
+        self.profilers     = {}         # Session ID -> cProfile.Profile / SamplingProfiler
+        self.timer         = None
+
+    def arm(self, queries = None, seconds = None, sessions = None, mode = PROFILER_MODE_CPROFILE, output_dir = PROFILER_OUTPUT_DIR):
+        """! Start a profiling window. Ends after "queries" profiled queries, or after "seconds", whichever comes first
+        @param queries  Number of queries to profile (None - no limit)
+        @param seconds  Duration of the profiling window (None - no limit)
+        @param sessions Iterable of session IDs (client ports) to profile (None - all sessions)
+        @param mode     PROFILER_MODE_CPROFILE or PROFILER_MODE_SAMPLE
+        """
+        assert mode in (PROFILER_MODE_CPROFILE, PROFILER_MODE_SAMPLE), f"Unknown profiler mode {mode}"
+        assert queries is not None or seconds is not None, "Profiling window must be limited by queries or seconds"
+
+        self.disarm()
+
+        with self.lock :
+            self.mode         = mode
+            self.queries_left = queries
+            self.deadline     = None if seconds is None else time.time() + seconds
+            self.sessions     = None if sessions is None else set(sessions)
+            self.output_dir   = output_dir
+            self.profilers    = {}
+            if seconds is not None :
+                self.timer = threading.Timer(seconds, self.disarm)
+                self.timer.daemon = True
+                self.timer.start()
+            self.is_armed = True
+
+        logging.info("ProfilingController : Armed. mode {}, queries {}, seconds {}, sessions {}".format(mode, queries, seconds, sessions))
+
+    def disarm(self):
+        """! End the profiling window, and dump the collected profiles
+        """
+        with self.lock :
+            if not self.is_armed :
+                return
+            self.is_armed = False
+            if self.timer is not None :
+                self.timer.cancel()
+                self.timer = None
+            profilers = self.profilers
+            self.profilers = {}
+
+        os.makedirs(self.output_dir, exist_ok = True)
+        time_stamp = time.strftime("%Y%m%d_%H%M%S")
+        for session_id, profiler in profilers.items() :
+            if self.mode == PROFILER_MODE_CPROFILE :
+                path = os.path.join(self.output_dir, "{}_{}.pstats".format(session_id, time_stamp))
+                profiler.dump_stats(path)
+            else :
+                path = os.path.join(self.output_dir, "{}_{}.collapsed".format(session_id, time_stamp))
+                profiler.dump(path)
+            logging.info("ProfilingController : Dumped session {} profile to {}".format(session_id, path))
+
+    def toggle(self):
+        if self.is_armed :
+            self.disarm()
+        else :
+            self.arm(queries = PROFILER_DEFAULT_QUERIES, seconds = PROFILER_DEFAULT_SECONDS)
+
+    def run(self, session_id, num_of_queries, func, *args):
+        """! Run func under the session profiler, if the session is selected in the current window.
+             Callers check is_armed first, so nothing here is paid when profiling is off.
+        @param session_id      Session identifier (client port)
+        @param num_of_queries  Number of queries handled by func, counted against the window
+        @param func            Callable to profile
+
+        @return func return value
+        """
+        with self.lock :
+            is_selected = self.is_armed and (self.sessions is None or session_id in self.sessions)
+            if is_selected :
+                profiler = self.profilers.get(session_id)
+                if profiler is None :
+                    profiler = cProfile.Profile() if self.mode == PROFILER_MODE_CPROFILE else SamplingProfiler()
+                    self.profilers[session_id] = profiler
+
+        if not is_selected :
+            return func(*args)
+
+        try :
+            if isinstance(profiler, SamplingProfiler) :
+                return profiler.run(func, *args)
+            return profiler.runcall(func, *args)
+        except ValueError as e :
+            # Python 3.12+ allows a single active cProfile at a time - Do not profile concurrent sessions
+            if "profiling tool" not in str(e) :
+                raise
+            logging.warning("ProfilingController : Skipping session {} - {}".format(session_id, e))
+            return func(*args)
+        finally :
+            self.count_queries(num_of_queries)
+
+    def count_queries(self, num_of_queries):
+        with self.lock :
+            if self.queries_left is None :
+                return
+            self.queries_left -= num_of_queries
+            is_window_over = self.queries_left <= 0
+        if is_window_over :
+            self.disarm()
+
+# Single profiling controller for the whole server
+PROFILER = ProfilingController()
+
+# ***********************************************
+# * Activation
+# ***********************************************
+def install_profiler_signal_handler(signum = getattr(signal, "SIGUSR1", None)):
+    """! Toggle profiling (with the default settings) when receiving signum.
+         Must be called from the main thread. Does nothing on platforms without SIGUSR1 (Windows).
+    """
+    if signum is None :
+        logging.info("install_profiler_signal_handler : No profiling signal on this platform")
+        return
+    signal.signal(signum, lambda received_signum, frame : PROFILER.toggle())
+
+def is_profiler_admin_query(query):
+    """! Identify the profiler admin query
+    @param query: Input string query
+
+    @return Boolean: True if profiler admin query, False otherwise.
+    """
+    return re.match(PROFILER_ADMIN_QUERY_REG_EXPR, query, re.IGNORECASE) is not None
+
+def parse_profiler_admin_options(options_str):
+    """! Parse and validate the options of the profiler admin query
+    @param options_str: Admin query options, e.g. "queries=100 mode=sample"
+
+    @return dictionary of option name -> value (int queries, float seconds, list of int session ports, str mode)
+    @raise ProfilerAdminError for an unknown option or an invalid option value
+    """
+    option_matches = list(re.finditer(PROFILER_ADMIN_OPTION_REG_EXPR, options_str))
+    unparsed = re.sub(PROFILER_ADMIN_OPTION_REG_EXPR, "", options_str).strip()
+    if len(unparsed) > 0 :
+        raise ProfilerAdminError('invalid PG_MIMIC PROFILE option "{}"'.format(unparsed))
+
+    options = {}
+    for match in option_matches :
+        name, value = match.group(1).lower(), match.group(2)
+        if name not in PROFILER_ADMIN_OPTIONS :
+            raise ProfilerAdminError('unrecognized PG_MIMIC PROFILE option "{}"'.format(name))
+        try :
+            if name == "queries" :
+                options[name] = int(value)
+                is_valid = options[name] > 0
+            elif name == "seconds" :
+                options[name] = float(value)
+                is_valid = math.isfinite(options[name]) and options[name] > 0
+            elif name == "session" :
+                options[name] = [int(port) for port in value.split(",")]
+                is_valid = all(0 < port < 65536 for port in options[name])
+            else :
+                options[name] = value.lower()
+                is_valid = options[name] in (PROFILER_MODE_CPROFILE, PROFILER_MODE_SAMPLE)
+        except ValueError :
+            is_valid = False
+        if not is_valid :
+            raise ProfilerAdminError('invalid value for PG_MIMIC PROFILE option "{}": "{}"'.format(name, value))
+
+    return options
+
+def run_profiler_admin_query(query):
+    """! Arm / disarm the profiler according to the admin query options
+    @param query: Admin query, e.g. "PG_MIMIC PROFILE queries=100 mode=sample" or "PG_MIMIC PROFILE off"
+
+    @return Command tag for the command complete message
+    @raise ProfilerAdminError for invalid options - The profiler is left as is
+    """
+    options_str = re.match(PROFILER_ADMIN_QUERY_REG_EXPR, query, re.IGNORECASE).group(1).strip()
+
+    if options_str.lower() == PROFILER_ADMIN_OFF :
+        PROFILER.disarm()
+        return PROFILER_ADMIN_COMMAND_TAG
+
+    options = parse_profiler_admin_options(options_str)
+    queries  = options.get("queries")
+    seconds  = options.get("seconds")
+    sessions = options.get("session")
+    mode     = options.get("mode", PROFILER_MODE_CPROFILE)
+    if queries is None and seconds is None :
+        queries = PROFILER_DEFAULT_QUERIES
+
+    PROFILER.arm(queries = queries, seconds = seconds, sessions = sessions, mode = mode)
+
+    return PROFILER_ADMIN_COMMAND_TAG
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""
+Idle and abandoned sessions reaper
+PowerBI opens new sessions without closing the old ones, and clients may disappear without closing their connection.
+Such sessions would hold their thread and backend connection forever. This module :
+    * Tracks the activity of each session (SessionActivity) - The time of its last request, and if a request is
+      being processed.
+    * Enables TCP keepalive on the client connections, so a peer that is gone fails the session receive.
+    * Runs a background reaper (SessionReaper), which terminates sessions idle for longer than their timeout,
+      with a FATAL ErrorResponse, as Postgres does for idle_session_timeout / idle_in_transaction_session_timeout :
+        - SESSION_IDLE_TIMEOUT        - Sessions with no open backend query
+        - SESSION_TRANSACTION_TIMEOUT - Sessions holding an open backend query (a portal suspended by an Execute row limit)
+      The terminated session ends as if the client closed it, so its backend connection returns to the pool.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import time
+import socket
+import threading
+
+from pg_serdes import SQLSTATE_IDLE_SESSION_TIMEOUT, SQLSTATE_IDLE_IN_TRANSACTION_TIMEOUT
+
+# ***********************************************
+# * Constants
+# ***********************************************
+SESSION_IDLE_TIMEOUT        = 60 * 60   # Seconds, 0 - No timeout
+SESSION_TRANSACTION_TIMEOUT = 10 * 60   # Seconds, 0 - No timeout
+SESSION_REAPER_INTERVAL     = 10        # Seconds between two checks of the sessions
+
+TCP_KEEPALIVE_IDLE          = 60        # Seconds of silence before the first probe
+TCP_KEEPALIVE_INTERVAL      = 10        # Seconds between probes
+TCP_KEEPALIVE_COUNT         = 6         # Unanswered probes before the connection is dropped
+
+# ***********************************************
+# * Session activity
+# ***********************************************
+def set_tcp_keepalive(sock) :
+    """! Enable TCP keepalive on a client connection, with the probes timing where the platform supports it
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", TCP_KEEPALIVE_IDLE), ("TCP_KEEPINTVL", TCP_KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", TCP_KEEPALIVE_COUNT)) :
+        if hasattr(socket, option) :
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+class SessionActivity:
+    """
+    Activity of a single session - Updated by the session thread, checked by the reaper
+    """
+    def __init__(self):
+        self.lock          = threading.Lock()
+        self.last_activity = time.monotonic()
+        self.is_busy       = False
+        self.is_terminated = False
+
+    def on_receive(self):
+        with self.lock :
+            self.last_activity = time.monotonic()
+
+    def start_request(self):
+        """! A request was received, and is about to be processed
+        @return False if the session was terminated by the reaper - The request must not be processed
+        """
+        with self.lock :
+            if self.is_terminated :
+                return False
+            self.is_busy = True
+            return True
+
+    def end_request(self):
+        with self.lock :
+            self.is_busy = False
+            self.last_activity = time.monotonic()
+
+    def check_timeout(self, is_in_transaction, idle_timeout = None, transaction_timeout = None):
+        """! Terminate the session if it is idle for longer than its timeout
+        @param is_in_transaction function () -> True if the session holds an open backend query.
+                                 Called while the session is not processing a request.
+        @return (SQLSTATE, message) of the ErrorResponse to terminate the session with, None if it is not timed out
+        """
+        idle_timeout = SESSION_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        transaction_timeout = SESSION_TRANSACTION_TIMEOUT if transaction_timeout is None else transaction_timeout
+        with self.lock :
+            if self.is_busy or self.is_terminated :
+                return None
+            idle_seconds = time.monotonic() - self.last_activity
+            if is_in_transaction() :
+                if transaction_timeout > 0 and idle_seconds > transaction_timeout :
+                    self.is_terminated = True
+                    return SQLSTATE_IDLE_IN_TRANSACTION_TIMEOUT, "terminating connection due to idle-in-transaction timeout"
+            elif idle_timeout > 0 and idle_seconds > idle_timeout :
+                self.is_terminated = True
+                return SQLSTATE_IDLE_SESSION_TIMEOUT, "terminating connection due to idle-session timeout"
+        return None
+
+# ***********************************************
+# * Reaper
+# ***********************************************
+class SessionReaper(threading.Thread):
+    """
+    Background thread terminating the timed out sessions.
+    Sessions provide : activity (SessionActivity), is_in_transaction() and terminate(sqlstate, message)
+    """
+    def __init__(self, get_sessions, interval = None):
+        """
+        get_sessions : function () -> list of the active sessions
+        interval     : Seconds between two checks of the sessions (None - SESSION_REAPER_INTERVAL)
+        """
+        super().__init__(name = "pg_session_reaper", daemon = True)
+        self.get_sessions = get_sessions
+        self.interval     = SESSION_REAPER_INTERVAL if interval is None else interval
+        self.is_stopped   = threading.Event()
+
+    def run(self):
+        while not self.is_stopped.wait(self.interval) :
+            self.reap()
+
+    def reap(self):
+        """! Terminate the timed out sessions
+        @return Number of sessions terminated
+        """
+        num_of_terminated = 0
+        for session in self.get_sessions() :
+            timeout_error = session.activity.check_timeout(session.is_in_transaction)
+            if timeout_error is None :
+                continue
+            sqlstate, message = timeout_error
+            logging.error("SessionReaper : {}".format(message))
+            try :
+                session.terminate(sqlstate, message)
+            except Exception as e :
+                logging.error("SessionReaper : Terminating a session failed - {}".format(e))
+            num_of_terminated += 1
+        return num_of_terminated
+
+    def stop(self):
+        self.is_stopped.set()
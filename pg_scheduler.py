@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+"""
+Backend queries scheduler - Priority between interactive and bulk queries
+PowerBI navigator and preview queries (catalog lookups, small "limit 1000" queries) compete for the backend with the
+multi-GB imports of dataset refreshes. The scheduler admits the backend statements of all the sessions, with at most
+SCHEDULER_MAX_QUERIES running at a time :
+    * Statements are classified (classify_query) - CATALOG (catalog lookups), PREVIEW (row limit up to
+      SCHEDULER_PREVIEW_MAX_ROWS), and BULK (the rest).
+    * Each class has its own queue. Once all the slots are in use, a freed slot goes to the queued class with the least
+      service relative to its weight (SCHEDULER_WEIGHTS) - Weighted fair sharing, so bulk queries still progress
+      under a steady interactive load.
+    * SCHEDULER_INTERACTIVE_RESERVED slots are reserved for the interactive classes - Bulk queries can not take them,
+      so a refresh with many bulk queries does not delay the navigator.
+A statement holds its slot while the client request which runs it is processed - From its execute until its cursor is
+closed (all rows fetched, or the portal closed), or until the end of the request. The statements of a session share a
+single slot (e.g. two portals of a request), so a session is admitted once per request, and never queues behind itself.
+A cursor left open between requests (a portal suspended by an Execute row limit, or opened by a Describe) gives its
+slot back, and waits for a slot again when the portal is resumed - So idle sessions holding open portals do not block
+the other sessions, or themselves.
+A statement waiting for a slot is canceled as a running one (CancelRequest, statement timeout - see pg_cancel), and
+gives up after SCHEDULER_QUEUE_TIMEOUT seconds.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import re
+import time
+import threading
+import collections
+
+# ***********************************************
+# * Constants
+# ***********************************************
+SCHEDULER_MAX_QUERIES          = 16     # Backend statements running at a time, 0 - No scheduling
+SCHEDULER_INTERACTIVE_RESERVED = 4      # Slots that only the interactive (catalog, preview) statements may take
+SCHEDULER_PREVIEW_MAX_ROWS     = 1000   # Largest row limit of a preview query
+SCHEDULER_QUEUE_TIMEOUT        = 60     # Seconds a statement waits for a slot, 0 - No limit
+
+# Query classes
+QUERY_CLASS_CATALOG = "CATALOG"
+QUERY_CLASS_PREVIEW = "PREVIEW"
+QUERY_CLASS_BULK    = "BULK"
+QUERY_CLASSES       = (QUERY_CLASS_CATALOG, QUERY_CLASS_PREVIEW, QUERY_CLASS_BULK)
+INTERACTIVE_QUERY_CLASSES = (QUERY_CLASS_CATALOG, QUERY_CLASS_PREVIEW)
+
+SCHEDULER_WEIGHTS = {QUERY_CLASS_CATALOG : 4,
+                     QUERY_CLASS_PREVIEW : 2,
+                     QUERY_CLASS_BULK    : 1}
+
+CATALOG_QUERY_REGEXP   = r"sqream_catalog\.|\bget_ddl\s*\("
+ROWS_LIMIT_QUERY_REGEXP = r"\blimit\s+(\d+)\s*;?\s*$|^\s*select\s+top\s+(\d+)\b"
+
+# Queued statement ticket
+TICKET__IS_GRANTED = "is_granted"
+
+# Scheduler statistics keys
+SCHEDULER__RUNNING       = "QUERIES_RUNNING"
+SCHEDULER__QUEUED        = "QUERIES_QUEUED"
+SCHEDULER__QUEUE_SECONDS = "QUERIES_QUEUE_SECONDS"   # Total time statements waited for a slot
+SCHEDULER__ADMITTED      = "QUERIES_{}"               # Statements admitted, by query class
+
+# ***********************************************
+# * Classification
+# ***********************************************
+def classify_query(query) :
+    """! Query class of a backend statement
+    @param query query string
+    @return QUERY_CLASS_CATALOG / QUERY_CLASS_PREVIEW / QUERY_CLASS_BULK
+    """
+    if re.search(CATALOG_QUERY_REGEXP, query, re.IGNORECASE) :
+        return QUERY_CLASS_CATALOG
+    match = re.search(ROWS_LIMIT_QUERY_REGEXP, query.rstrip("\x00"), re.IGNORECASE)
+    if match is not None and int(match.group(1) or match.group(2)) <= SCHEDULER_PREVIEW_MAX_ROWS :
+        return QUERY_CLASS_PREVIEW
+    return QUERY_CLASS_BULK
+
+# ***********************************************
+# * Scheduler
+# ***********************************************
+class QueryScheduler:
+    """
+    Thread safe admission of the backend statements, by query class
+    """
+    def __init__(self, max_queries = None, interactive_reserved = None, weights = None):
+        """
+        max_queries          : Backend statements running at a time (None - SCHEDULER_MAX_QUERIES)
+        interactive_reserved : Slots reserved for the interactive classes (None - SCHEDULER_INTERACTIVE_RESERVED)
+        weights              : Query class -> weight (None - SCHEDULER_WEIGHTS)
+        """
+        self.max_queries   = SCHEDULER_MAX_QUERIES if max_queries is None else max_queries
+        interactive_reserved = SCHEDULER_INTERACTIVE_RESERVED if interactive_reserved is None else interactive_reserved
+        self.max_bulk      = max(self.max_queries - interactive_reserved, 1)
+        self.weights       = SCHEDULER_WEIGHTS if weights is None else weights
+        self.queues        = {query_class : collections.deque() for query_class in QUERY_CLASSES}   # Waiting tickets
+        self.running       = {query_class : 0 for query_class in QUERY_CLASSES}
+        self.virtual_times = {query_class : 0.0 for query_class in QUERY_CLASSES}  # Service / weight
+        self.admitted      = {query_class : 0 for query_class in QUERY_CLASSES}
+        self.queue_seconds = 0.0
+        self.condition     = threading.Condition()
+
+    def is_eligible(self, query_class) :
+        if query_class == QUERY_CLASS_BULK :
+            return self.running[QUERY_CLASS_BULK] < self.max_bulk
+        return True
+
+    def dispatch(self) :
+        """! Hand the free slots to the queued statements - The eligible class with the least virtual time first
+             (called with the lock held)
+        """
+        while sum(self.running.values()) < self.max_queries :
+            candidates = [query_class for query_class in QUERY_CLASSES
+                          if len(self.queues[query_class]) > 0 and self.is_eligible(query_class)]
+            if len(candidates) == 0 :
+                return
+            query_class = min(candidates, key = lambda candidate : self.virtual_times[candidate])
+            ticket = self.queues[query_class].popleft()
+            ticket[TICKET__IS_GRANTED] = True
+            self.grant(query_class)
+            self.condition.notify_all()
+
+    def grant(self, query_class) :
+        self.running[query_class] += 1
+        self.admitted[query_class] += 1
+        self.virtual_times[query_class] += 1 / self.weights[query_class]
+
+    def acquire(self, query_class, is_canceled = lambda : False, timeout = None) :
+        """! Wait for a slot for a statement of the class
+        @param is_canceled function () -> True if the statement was canceled meanwhile (see wake_up)
+        @param timeout     Seconds to wait for a slot, None / 0 - No limit
+        @return True if admitted, False if canceled or timed out while waiting
+        """
+        if self.max_queries == 0 :
+            return True
+
+        with self.condition :
+            # An idle class starts at the current virtual time of the busy ones - Its idle time is not credited
+            if len(self.queues[query_class]) == 0 and self.running[query_class] == 0 :
+                busy_times = [self.virtual_times[busy_class] for busy_class in QUERY_CLASSES
+                              if len(self.queues[busy_class]) > 0 or self.running[busy_class] > 0]
+                if len(busy_times) > 0 :
+                    self.virtual_times[query_class] = max(self.virtual_times[query_class], min(busy_times))
+
+            # Fast path - A free slot, and no statement waiting for it
+            if sum(self.running.values()) < self.max_queries and self.is_eligible(query_class) and \
+               not any(len(queue) > 0 for queue in self.queues.values()) :
+                self.grant(query_class)
+                return True
+
+            ticket = {TICKET__IS_GRANTED : False}
+            self.queues[query_class].append(ticket)
+            wait_start = time.perf_counter()
+            self.dispatch()
+            self.condition.wait_for(lambda : ticket[TICKET__IS_GRANTED] or is_canceled(), timeout or None)
+            self.queue_seconds += time.perf_counter() - wait_start
+            if ticket[TICKET__IS_GRANTED] :
+                return True
+            self.queues[query_class].remove(ticket)
+            return False
+
+    def release(self, query_class) :
+        """! Free the slot of an admitted statement
+        """
+        if self.max_queries == 0 :
+            return
+        with self.condition :
+            self.running[query_class] -= 1
+            self.dispatch()
+
+    def wake_up(self) :
+        """! Wake up the waiting statements, to check if they were canceled
+        """
+        with self.condition :
+            self.condition.notify_all()
+
+    def get_stats(self) :
+        with self.condition :
+            stats = {SCHEDULER__RUNNING       : sum(self.running.values()),
+                     SCHEDULER__QUEUED        : sum(len(queue) for queue in self.queues.values()),
+                     SCHEDULER__QUEUE_SECONDS : self.queue_seconds}
+            for query_class in QUERY_CLASSES :
+                stats[SCHEDULER__ADMITTED.format(query_class)] = self.admitted[query_class]
+            return stats
@@ -20,13 +20,18 @@ from sqream_backend import  sqream_catalog_tables,              \
                             SQREAM_TYPE_TEXT,                   \
                             SQREAM_CATALOG_COL_INFO_COL_NAME,   \
                             SQREAM_CATALOG_COL_INFO_COL_TYPE,   \
-                            SQREAM_CATALOG_COL_INFO_IS_NULLABLE 
+                            SQREAM_CATALOG_COL_INFO_IS_NULLABLE, \
+                            rows_to_cols,                       \
+                            get_num_of_col_rows
+from pg_types import *
+from pg_buffers import OUTPUT_BUFFER_POOL, acquire_output_buffer
 
 # ***********************************************
 # * Constants
 # ***********************************************
 # Deserialize Message IDs (RX messages)
 STARTUP_MSG_ID = bytes('STARTUP', "utf-8")
+CANCEL_REQUEST_MSG_ID = bytes('CANCEL', "utf-8")
 QUERY_MSG_ID = bytes('Q', "utf-8")
 PARSE_MSG_ID = bytes('P', "utf-8")
 PASSWORD_MSG_ID = bytes('p', "utf-8")
@@ -34,6 +39,8 @@ BIND_MSG_ID = bytes('B', "utf-8")
 DESCRIBE_MSG_ID = bytes('D', "utf-8")
 EXECUTE_MSG_ID = bytes('E', "utf-8")
 SYNC_MSG_ID = bytes('S', "utf-8")
+CLOSE_MSG_ID = bytes('C', "utf-8")
+FLUSH_MSG_ID = bytes('H', "utf-8")
 # Serialize Message IDs (TX messages)
 PARAMETER_STATUS_MSG_ID = bytes('S', "utf-8")
 AUTHENTICATION_REQUEST_MSG_ID = bytes('R', "utf-8")
@@ -43,6 +50,19 @@ DATA_COLS_MSG_ID = bytes('D', "utf-8")
 ROW_DESC_MSG_ID = bytes('T', "utf-8")
 PARSE_COMPLETE_MSG_ID = bytes('1', "utf-8")
 BIND_COMPLETE_MSG_ID = bytes('2', "utf-8")
+CLOSE_COMPLETE_MSG_ID = bytes('3', "utf-8")
+NO_DATA_MSG_ID = bytes('n', "utf-8")
+PARAMETER_DESC_MSG_ID = bytes('t', "utf-8")
+ERROR_RESPONSE_MSG_ID = bytes('E', "utf-8")
+PORTAL_SUSPENDED_MSG_ID = bytes('s', "utf-8")
+COPY_OUT_RESPONSE_MSG_ID = bytes('H', "utf-8")
+COPY_DATA_MSG_ID = bytes('d', "utf-8")
+COPY_DONE_MSG_ID = bytes('c', "utf-8")
+BACKEND_KEY_DATA_MSG_ID = bytes('K', "utf-8")
+
+# Startup message protocol version (3.0) - Other requests (e.g. SSLRequest) use other codes in its place
+STARTUP_PROTOCOL_MAJOR_VERSION = 3
+CANCEL_REQUEST_CODE            = 80877102       # In place of the protocol version of a CancelRequest
 
 # Server state
 READY_FOR_QUERY_SERVER_STATUS_IDLE = bytes('I', "utf-8")
@@ -50,25 +70,41 @@ READY_FOR_QUERY_SERVER_STATUS_IDLE = bytes('I', "utf-8")
 # Message attributes
 MSG_ID = "msg_id"
 
+STARTUP_MSG__PARAMETERS = "parameters"     # Parameter name -> value (str), e.g. user, database, application_name
+
+CANCEL_REQUEST_MSG__PROCESS_ID = "process_id"
+CANCEL_REQUEST_MSG__SECRET_KEY = "secret_key"
+
 QUERY_MSG__SIMPLE_QUERY = "simple_query"
 
 PARSE_MSG__STATEMENT = "statement"
 PARSE_MSG__QUERY     = "query"
 PARSE_MSG__PARAMETER = "parameter"
+PARSE_MSG__PARAMETER_TYPES = "parameter_types"
 
 BIND_MSG__STATEMENT         = "statement"
 BIND_MSG__PORTAL            = "portal"
-BIND_MSG__PARAM_FORMATS     = "param_formats"
-BIND_MSG__PARAM_VALUES      = "param_values"
-BIND_MSG__RESULT_FORMATS    = "result_formats"
-BIND_MSG__FORMAT_TYPES      = "format_type"
+BIND_MSG__PARAM_FORMATS     = "param_formats"     # List of parameters format codes
+BIND_MSG__PARAM_VALUES      = "param_values"      # List of parameters values (bytes, None for NULL)
+BIND_MSG__RESULT_FORMATS    = "result_formats"    # List of result columns format codes
 
 DESCRIBE_MSG__PARAM_FORMATS = "description"
 DESCRIBE_MSG__PORTAL        = "portal"
+DESCRIBE_MSG__TYPE          = "describe_type"
+
+CLOSE_MSG__TYPE             = "close_type"
+CLOSE_MSG__NAME             = "name"
+
+# Describe / Close message target types
+DESCRIBE_TYPE_STATEMENT     = bytes('S', "utf-8")
+DESCRIBE_TYPE_PORTAL        = bytes('P', "utf-8")
     
 EXECUTE_MSG__PORTAL         = "portal"
 EXECUTE_MSG__ROWS_TO_RETURN = "rows_to_return"
 
+# Data rows (D message)
+DATA_ROWS_COPY_CHUNK = 256      # Messages copied together to a pooled output buffer
+
 # Column description (T message)
 # ------------------------------
 # Description dictionary names
@@ -76,17 +112,34 @@ COL_DESC__NAME   = "col_desc_name"
 COL_DESC__TYPE   = "col_desc_type"
 COL_DESC__FORMAT = "col_desc_format"
 COL_DESC__LENGTH = "col_desc_length"
-
-# Postgres Column types 
-COL_INT_TYPE_OID        = 23
-COL_LONG_INT_TYPE_OID   = 26
-COL_TEXT_TYPE_OID       = 19
-COL_TEXT_TYPE_2_OID     = 1043
-COL_TEXT_TYPE_3_OID     = 25
-COL_CHAR_TYPE_OID       = 18
+COL_DESC__IS_NULLABLE = "col_desc_is_nullable"
+
+# Postgres Column types - see pg_types
+
+# Error response fields and SQLSTATE codes - https://www.postgresql.org/docs/12/errcodes-appendix.html
+ERROR_FIELD_SEVERITY        = bytes('S', "utf-8")
+ERROR_FIELD_CODE            = bytes('C', "utf-8")
+ERROR_FIELD_MESSAGE         = bytes('M', "utf-8")
+ERROR_SEVERITY_ERROR        = "ERROR"
+ERROR_SEVERITY_FATAL        = "FATAL"
+SQLSTATE_INVALID_STATEMENT_NAME = "26000"
+SQLSTATE_INVALID_CURSOR_NAME    = "34000"
+SQLSTATE_PROTOCOL_VIOLATION     = "08P01"
+SQLSTATE_FEATURE_NOT_SUPPORTED  = "0A000"
+SQLSTATE_SYNTAX_ERROR           = "42601"
+SQLSTATE_TOO_MANY_CONNECTIONS   = "53300"
+SQLSTATE_CONNECTION_FAILURE     = "08006"
+SQLSTATE_QUERY_CANCELED         = "57014"
+SQLSTATE_INVALID_PARAMETER_VALUE = "22023"
+SQLSTATE_UNDEFINED_OBJECT       = "42704"
+SQLSTATE_CANT_CHANGE_RUNTIME_PARAM = "55P02"
+SQLSTATE_IDLE_SESSION_TIMEOUT   = "57P05"
+SQLSTATE_IDLE_IN_TRANSACTION_TIMEOUT = "25P03"
+SQLSTATE_INTERNAL_ERROR         = "XX000"
 
 # Misc
 NULL_TERMINATOR = b'\x00'
+UNNAMED = NULL_TERMINATOR       # Name of the unnamed prepared statement / portal, as received (null terminated)
 PBI_CATALOG_SUPPORTED_TYPES_QUERY           = b"\r\n/*** Load all supported types ***/\r\nSELECT ns.nspname, a.typname, a.oid, a.typrelid, a.typbasetype,\r\nCASE WHEN pg_proc.proname='array_recv' THEN 'a' ELSE a.typtype END AS type,\r\nCASE\r\n  WHEN pg_proc.proname='array_recv' THEN a.typelem\r\n  WHEN a.typtype='r' THEN rngsubtype\r\n  ELSE 0\r\nEND AS elemoid,\r\nCASE\r\n  WHEN pg_proc.proname IN ('array_recv','oidvectorrecv') THEN 3    /* Arrays last */\r\n  WHEN a.typtype='r' THEN 2                                        /* Ranges before */\r\n  WHEN a.typtype='d' THEN 1                                        /* Domains before */\r\n  ELSE 0                                                           /* Base types first */\r\nEND AS ord\r\nFROM pg_type AS a\r\nJOIN pg_namespace AS ns ON (ns.oid = a.typnamespace)\r\nJOIN pg_proc ON pg_proc.oid = a.typreceive\r\nLEFT OUTER JOIN pg_class AS cls ON (cls.oid = a.typrelid)\r\nLEFT OUTER JOIN pg_type AS b ON (b.oid = a.typelem)\r\nLEFT OUTER JOIN pg_class AS elemcls ON (elemcls.oid = b.typrelid)\r\nLEFT OUTER JOIN pg_range ON (pg_range.rngtypid = a.oid) \r\nWHERE\r\n  a.typtype IN ('b', 'r', 'e', 'd') OR         /* Base, range, enum, domain */\r\n  (a.typtype = 'c' AND cls.relkind='c') OR /* User-defined free-standing composites (not table composites) by default */\r\n  (pg_proc.proname='array_recv' AND (\r\n    b.typtype IN ('b', 'r', 'e', 'd') OR       /* Array of base, range, enum, domain */\r\n    (b.typtype = 'p' AND b.typname IN ('record', 'void')) OR /* Arrays of special supported pseudo-types */\r\n    (b.typtype = 'c' AND elemcls.relkind='c')  /* Array of user-defined free-standing composites (not table composites) */\r\n  )) OR\r\n  (a.typtype = 'p' AND a.typname IN ('record', 'void'))  /* Some special supported pseudo-types */\r\nORDER BY ord\x00"
 PBI_CATALOG_FIELD_DEF_COMPOSITE_TYPES_QUERY = b"/*** Load field definitions for (free-standing) composite types ***/\r\nSELECT typ.oid, att.attname, att.atttypid\r\nFROM pg_type AS typ\r\nJOIN pg_namespace AS ns ON (ns.oid = typ.typnamespace)\r\nJOIN pg_class AS cls ON (cls.oid = typ.typrelid)\r\nJOIN pg_attribute AS att ON (att.attrelid = typ.typrelid)\r\nWHERE\r\n  (typ.typtype = 'c' AND cls.relkind='c') AND\r\n  attnum > 0 AND     /* Don't load system attributes */\r\n  NOT attisdropped\r\nORDER BY typ.oid, att.attnum\x00"
 PBI_CATALOG_ENUM_FIELDS_QUERY               = b'/*** Load enum fields ***/\r\nSELECT pg_type.oid, enumlabel\r\nFROM pg_enum\r\nJOIN pg_type ON pg_type.oid=enumtypid\r\nORDER BY oid, enumsortorder\x00'
@@ -103,17 +156,33 @@ PBI_CATALOG_TABLE_CONSTRAINT_REG_EXPR       = r"\b(INFORMATION_SCHEMA)\b.*\b(CON
 PG_DISCARD_ALL_QUERY                        = b'DISCARD ALL\x00'
 PG_DISCARD_ALL_STRING                       = 'DISCARD ALL'
 
-USER_TABLE_TYPE                             =  'BASE TABLE'  # Currently hard coded all user tables o be BASE TABLE type
-
-PG_INT_STRING  = "integer"
-SQ_INT_STRING  = "int"
-PG_TEXT_STRING = "text"
-SQ_TEXT_STRING = "text"
+# Tokens of a multi-statement query - Quoted strings and identifiers, comments and dollar-quoted strings are single
+# tokens, so their semicolons do not split the query (an unterminated one runs to the end of the query)
+QUERY_STATEMENT_SEPARATOR   = ";"
+QUERY_TOKEN_REG_EXPR        = (r"(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*'?"                 # Escape string constant - E'it\'s'
+                               r"|'(?:[^']|'')*'?"                                   # String constant
+                               r'|"(?:[^"]|"")*"?'                                   # Quoted identifier
+                               r"|--[^\n]*"                                          # Line comment
+                               r"|/\*.*?(?:\*/|$)"                                    # Block comment
+                               r"|(?<![\w$])\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?(?:\$(?P=tag)\$|$)"   # Dollar-quoted string
+                               r"|;|[^'\"\-/$;eE]+|.")
 
-SQ_TEXT_LENGTH = -1
+USER_TABLE_TYPE                             =  'BASE TABLE'  # Currently hard coded all user tables o be BASE TABLE type
 
 INT_LENGTH = 4
 
+# ***********************************************
+# * Errors
+# ***********************************************
+class PG_Error(Exception):
+    """
+    Error reported to the client with an ErrorResponse message, instead of ending the session
+    """
+    def __init__(self, sqlstate, message):
+        super().__init__(message)
+        self.sqlstate = sqlstate
+        self.message  = message
+
 # ***********************************************
 # * Utility functions
 # ***********************************************
@@ -149,6 +218,24 @@ def remove_table_varable_from_query(query) :
         logging.info("remove_table_varable_from_query : No table variale in query")
     return query
 
+def split_query_statements(query) :
+    """! Split the query of a simple Query message to its statements, on the semicolons outside of quoted strings,
+         quoted identifiers and comments
+    @param query Query string
+    @return list of the statements, without their separators - Empty statements are dropped
+    """
+    if QUERY_STATEMENT_SEPARATOR not in query :
+        return [query]
+
+    statements = []
+    start = 0
+    for token in re.finditer(QUERY_TOKEN_REG_EXPR, query, re.DOTALL) :
+        if token.group(0) == QUERY_STATEMENT_SEPARATOR :
+            statements.append(query[start : token.start()])
+            start = token.end()
+    statements.append(query[start:])
+    return [statement.strip() for statement in statements if statement.strip(" \t\r\n\x00") != ""]
+
 def get_table_from_catalog_col_info_query(query) :
     """
     Extract from the catalog query PBI_CATALOG_COLUMN_INFO_QUERY the table name 
@@ -157,61 +244,58 @@ def get_table_from_catalog_col_info_query(query) :
     assert len(table_names) == 1, "Mismatch number of table names in query"
     return table_names[0]
 
-def prepare_cols_desc(cols_name, cols_type, cols_length, cols_format):
+def prepare_cols_desc(cols_name, cols_type, cols_length, cols_format, cols_nullable = None):
     """! Prepare the columns description object, needed by the T message
     @param cols_name
     @param cols_type
     @param cols_length
     @param cols_format
+    @param cols_nullable Column may hold NULL values (None - all columns are nullable)
 
     @return cols_desc
     """
     num_of_cols = len(cols_name)
 
-    assert num_of_cols == len(cols_type) == len(cols_length) == len(cols_format), "Mismatch in number columns description attributes"
+    if cols_nullable is None :
+        cols_nullable = [True] * num_of_cols
+
+    assert num_of_cols == len(cols_type) == len(cols_length) == len(cols_format) == len(cols_nullable), "Mismatch in number columns description attributes"
 
     cols_desc = []
     for index in range(num_of_cols) :
-        # Translate SQream types to Postgres types
-        if cols_type[index] == SQREAM_TYPE_INT :
-            cols_type[index] = COL_INT_TYPE_OID
-        elif cols_type[index] == SQREAM_TYPE_TEXT :
-            cols_type[index] = COL_TEXT_TYPE_3_OID
-            cols_length[index] = SQ_TEXT_LENGTH
+        # Translate SQream types to Postgres types (catalog queries are already described by Postgres types)
+        if cols_type[index] in SQREAM_TO_PG_TYPES :
+            cols_type[index], cols_length[index] = sqream_to_pg_type(cols_type[index])
 
         cols_desc.append({COL_DESC__NAME   : cols_name[index],
                           COL_DESC__TYPE   : cols_type[index],
                           COL_DESC__FORMAT : cols_format[index],
-                          COL_DESC__LENGTH : cols_length[index]})
+                          COL_DESC__LENGTH : cols_length[index],
+                          COL_DESC__IS_NULLABLE : cols_nullable[index]})
 
     return cols_desc
 
-def utility_int_to_text(val) :
-    """! Translate a string to an ordinal string, little endian
-    @param val integer to translate
+def get_result_formats(result_formats, num_of_cols) :
+    """! Expand the result-column format codes of a Bind message to a format per column
+    @param result_formats Bind message format codes : none (all text), one (applied to all columns) or one per column
+    @param num_of_cols    Number of result columns
 
-    @return bytes comprises of list of ordinals ascii value, representing the input val
-            For example : int value 192, return value 0x31/0x39/0x32
+    @return list of format codes, one per column
     """
-    rVal = bytes('', "utf-8")
-    while val != 0 :
-        digit = val % 10
-        val = val // 10
-        char_digit = struct.pack("!c",  bytes(str(digit), "utf-8"))
-        rVal += char_digit
-    rVal = rVal[::-1]           # Reverse the string
-    return rVal
-
-def utility_int_to_bytes(val) :
-    """! Translate an int to bytes array, big endian
-    @param val integer to translate
-
-    @return bytes of 4 bytes int representation in Big Endian
-            For example : int value 1, return value 0x00/0x00/0x00/0x01
+    if len(result_formats) == 0 :
+        return [COL_FORMAT_TEXT] * num_of_cols
+    if len(result_formats) == 1 :
+        return list(result_formats) * num_of_cols
+    if len(result_formats) != num_of_cols :
+        raise ValueError("bind message has {} result formats but query has {} columns".format(len(result_formats), num_of_cols))
+    return list(result_formats)
+
+def apply_result_formats(cols_desc, result_formats) :
+    """! Columns description with the result-column format codes requested by the client (Bind message)
+    @return new cols_desc, the input cols_desc is not modified
     """
-    rVal = val.to_bytes(INT_LENGTH, byteorder = "big")
-    return rVal
-
+    cols_format = get_result_formats(result_formats, len(cols_desc))
+    return [dict(col_desc, **{COL_DESC__FORMAT : col_format}) for col_desc, col_format in zip(cols_desc, cols_format)]
 
 def is_password_msg(msg):
     """
@@ -511,10 +595,7 @@ def prepare_pg_catalog_cols_value(connection, query) :
         cols_values = []
         for index, col_detail in enumerate(col_details) :
             # Type SQ to PG translation
-            col_type = col_detail[SQREAM_CATALOG_COL_INFO_COL_TYPE]
-            if   SQ_INT_STRING  in col_type : col_type = PG_INT_STRING
-            elif SQ_TEXT_STRING in col_type : col_type = PG_TEXT_STRING
-            else : raise ValueError (f"Unsupported type {col_type}")
+            col_type = sqream_ddl_to_pg_data_type(col_detail[SQREAM_CATALOG_COL_INFO_COL_TYPE])
             cols_values.append([col_detail[SQREAM_CATALOG_COL_INFO_COL_NAME],   \
                                index + 1,                                       \
                                col_detail[SQREAM_CATALOG_COL_INFO_IS_NULLABLE], \
@@ -544,39 +625,64 @@ def is_init_message(first_byte) :
         first_byte == BIND_MSG_ID       or \
         first_byte == DESCRIBE_MSG_ID   or \
         first_byte == EXECUTE_MSG_ID    or \
+        first_byte == CLOSE_MSG_ID      or \
+        first_byte == FLUSH_MSG_ID      or \
         first_byte == SYNC_MSG_ID :
             return False
     else :
             return True
 
 
-def tokenization(data, is_startup_msg):
+def split_frames(data, is_startup_msg):
     """
-    Tokenize a stream of bytes into a list of tuples with two values :
-        [(Header Msg ID size of byte, Msg payload), 
-        (Msg ID_2, Payload_2), ...].
-    This is a first step in parsing the incoming PG message.
-    Next step would be to build a sentence with a specific meaning out of a series of words
+    Tokenize the complete messages at the start of a receive buffer, like tokenization().
+    A partial message at the end of the buffer is left for the next receive.
+    Only the first message may be a startup message (no Msg ID).
+    Output : (tokenized messages, number of bytes consumed from data)
     """
     tokenized_msgs = []
+    offset = 0
 
-    while len(data) > 0 :
+    while len(data) - offset > 0 :
         # Get message at the start of the data frame - MsgID / Length
-        if is_startup_msg == True :
+        if is_startup_msg == True and offset == 0 :
             HEADERFORMAT = "!i"     
             header_len = struct.calcsize(HEADERFORMAT)
-            msg_len = struct.unpack(HEADERFORMAT, data[0:header_len])[0]
+            if len(data) - offset < header_len :
+                break
+            msg_len = struct.unpack(HEADERFORMAT, data[offset : offset + header_len])[0]
             msg_id = ''
+            # Startup message length does not follow a Msg ID byte
+            frame_len = msg_len
         else : 
             HEADERFORMAT = "!ci"     
             header_len = struct.calcsize(HEADERFORMAT)
-            msg_id, msg_len = struct.unpack(HEADERFORMAT, data[0:header_len])
+            if len(data) - offset < header_len :
+                break
+            msg_id, msg_len = struct.unpack(HEADERFORMAT, data[offset : offset + header_len])
+            frame_len = msg_len + 1
+
+        # Partial message - Wait for the rest of it
+        if len(data) - offset < frame_len :
+            break
 
-        msg_data = data[header_len:msg_len + 1]
+        msg_data = data[offset + header_len : offset + frame_len]
         tokenized_msgs.append((msg_id, msg_data))
 
         # Iterate to the next message
-        data = data[msg_len + 1 :]
+        offset += frame_len
+
+    return tokenized_msgs, offset
+
+def tokenization(data, is_startup_msg):
+    """
+    Tokenize a stream of bytes into a list of tuples with two values :
+        [(Header Msg ID size of byte, Msg payload), 
+        (Msg ID_2, Payload_2), ...].
+    This is a first step in parsing the incoming PG message.
+    Next step would be to build a sentence with a specific meaning out of a series of words
+    """
+    tokenized_msgs, _ = split_frames(data, is_startup_msg)
 
     return tokenized_msgs
 
@@ -606,6 +712,12 @@ def parse(tokenized_msgs) :
             parsed_msgs.append(E_Msg_Execute_Deserialize(msg))
         elif msg_id == SYNC_MSG_ID :
             parsed_msgs.append(S_Msg_Sync_Deserialize(msg))
+        elif msg_id == CLOSE_MSG_ID :
+            parsed_msgs.append(C_Msg_Close_Deserialize(msg))
+        elif msg_id == FLUSH_MSG_ID :
+            parsed_msgs.append({MSG_ID : FLUSH_MSG_ID})
+        elif is_cancel_request(msg) :
+            parsed_msgs.append(CancelRequest_Msg_Deserialize(msg))
         else :
             # Assume this is a startup message if could not match any message ID
             parsed_msgs.append(Startup_Msg_Deserialize(msg)) 
@@ -660,8 +772,54 @@ def Startup_Msg_Deserialize(data) :
 
     logging.info("Startup message : protocol major: %d, protocol minor: %d", protocol_major_ver, protocol_minor_ver)
 
+    # Name / value pairs, up to the terminating zero byte (none in other requests, e.g. SSLRequest)
+    parameters = {}
+    if protocol_major_ver == STARTUP_PROTOCOL_MAJOR_VERSION :
+        strings = payload[struct.calcsize(PAYLOAD_STRUCT) : ].split(NULL_TERMINATOR)
+        for name, value in zip(strings[0::2], strings[1::2]) :
+            if len(name) == 0 :
+                break
+            parameters[name.decode("utf-8")] = value.decode("utf-8")
+    parsed_msg[STARTUP_MSG__PARAMETERS] = parameters
+
     return parsed_msg
 
+def is_cancel_request(data) :
+    """
+    Test if a message without a message ID is a CancelRequest (and not a Startup message)
+    """
+    payload = data[1]
+    return len(payload) >= 4 and struct.unpack("!i", payload[0:4])[0] == CANCEL_REQUEST_CODE
+
+def CancelRequest_Msg_Deserialize(data) :
+    """! Deserialize cancel request message
+    @param data tokenized message (no message ID)
+
+    @return parsed message, with the process ID and secret key of the session to cancel
+
+    CancelRequest (Frontend)
+        Int32(16)
+        Length of message contents in bytes, including self.
+
+        Int32(80877102)
+        The cancel request code. The value is chosen to contain 1234 in the most significant 16 bits, and 5678 in the 
+        least significant 16 bits. (To avoid confusion, this code must not be the same as any protocol version number.)
+
+        Int32
+        The process ID of the target backend.
+
+        Int32
+        The secret key for the target backend.
+    """
+    payload = data[1]
+
+    PAYLOAD_STRUCT = "!iii"
+    _, process_id, secret_key = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])
+
+    return {MSG_ID                         : CANCEL_REQUEST_MSG_ID,
+            CANCEL_REQUEST_MSG__PROCESS_ID : process_id,
+            CANCEL_REQUEST_MSG__SECRET_KEY : secret_key}
+
 def Q_Msg_Simple_Query_Deserialize(data) :
     """! Deserialize simple query message
     @param data bytes array of the simple query
@@ -731,6 +889,10 @@ def P_Msg_Parse_Deserialize(data) :
     PAYLOAD_STRUCT = "!h"     
     parameter = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])
     parsed_msg[PARSE_MSG__PARAMETER] = parameter[0]
+    payload = payload[struct.calcsize(PAYLOAD_STRUCT) : ]
+
+    PARAMETER_TYPES_STRUCT = "!{}i".format(parameter[0])
+    parsed_msg[PARSE_MSG__PARAMETER_TYPES] = list(struct.unpack(PARAMETER_TYPES_STRUCT, payload[0:struct.calcsize(PARAMETER_TYPES_STRUCT)]))
 
     return parsed_msg
 
@@ -795,12 +957,27 @@ def B_Msg_Bind_Deserialize(data) :
     parsed_msg[BIND_MSG__STATEMENT] = statement
     payload = payload[len(statement) : ]
 
-    PAYLOAD_STRUCT = "!hhhh"     
-    param_formats, param_values, result_formats, format_type = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])
+    # Parameters format codes
+    num_of_param_formats = struct.unpack("!h", payload[0:2])[0]
+    param_formats = list(struct.unpack("!{}h".format(num_of_param_formats), payload[2 : 2 + 2 * num_of_param_formats]))
+    payload = payload[2 + 2 * num_of_param_formats : ]
+
+    # Parameters values
+    num_of_params = struct.unpack("!h", payload[0:2])[0]
+    payload = payload[2:]
+    param_values = []
+    for i in range(num_of_params) :
+        param_len = struct.unpack("!i", payload[0:4])[0]
+        param_values.append(None if param_len < 0 else payload[4 : 4 + param_len])
+        payload = payload[4 + max(param_len, 0) : ]
+
+    # Result columns format codes
+    num_of_result_formats = struct.unpack("!h", payload[0:2])[0]
+    result_formats = list(struct.unpack("!{}h".format(num_of_result_formats), payload[2 : 2 + 2 * num_of_result_formats]))
+
     parsed_msg[BIND_MSG__PARAM_FORMATS]  = param_formats
     parsed_msg[BIND_MSG__PARAM_VALUES]   = param_values
     parsed_msg[BIND_MSG__RESULT_FORMATS] = result_formats
-    parsed_msg[BIND_MSG__FORMAT_TYPES]   = format_type
 
     return parsed_msg
 
@@ -832,6 +1009,7 @@ def D_Msg_Describe_Deserialize(data) :
     PAYLOAD_STRUCT = "!c"     
     description = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])
     parsed_msg[DESCRIBE_MSG__PARAM_FORMATS]  = description
+    parsed_msg[DESCRIBE_MSG__TYPE]           = description[0]
     payload = payload[struct.calcsize(PAYLOAD_STRUCT) : ]
 
     portal = payload[ : payload.find(NULL_TERMINATOR) + 1]
@@ -867,11 +1045,42 @@ def E_Msg_Execute_Deserialize(data) :
     payload = payload[len(portal) : ]
 
     PAYLOAD_STRUCT = "!i"     
-    rows_to_return = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])
+    rows_to_return = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])[0]
     parsed_msg[EXECUTE_MSG__ROWS_TO_RETURN]  = rows_to_return
 
     return parsed_msg
 
+def C_Msg_Close_Deserialize(data) :
+    """! Deserialize Close message
+    @param data bytes array 
+
+    @return  
+
+    Close (Frontend)
+        Byte1
+        'S' to close a prepared statement; or 'P' to close a portal.
+
+        String
+        The name of the prepared statement or portal to close (an empty string selects the unnamed prepared statement or portal).
+    """
+    msg_id = data[0]
+    payload = data[1]
+
+    parsed_msg = {}
+
+    assert msg_id == CLOSE_MSG_ID, f"Received '{msg_id}' unexpected message ID"
+
+    parsed_msg[MSG_ID] = msg_id
+
+    PAYLOAD_STRUCT = "!c"     
+    parsed_msg[CLOSE_MSG__TYPE] = struct.unpack(PAYLOAD_STRUCT, payload[0:struct.calcsize(PAYLOAD_STRUCT)])[0]
+    payload = payload[struct.calcsize(PAYLOAD_STRUCT) : ]
+
+    name = payload[ : payload.find(NULL_TERMINATOR) + 1]
+    parsed_msg[CLOSE_MSG__NAME] = name
+
+    return parsed_msg
+
 def S_Msg_Sync_Deserialize(data) :
     """! Deserialize Execute message
     @param data bytes array 
@@ -960,20 +1169,12 @@ def D_Msg_DataRow_Serialize(cols_desc, cols_values) :
 
     fields_count = len(cols_values)
 
-    for index, col_value in enumerate (cols_values) :
-        if cols_desc[index][COL_DESC__FORMAT] == COL_FORMAT_BINARY and \
-            cols_desc[index][COL_DESC__TYPE]  == COL_INT_TYPE_OID :
-                col_value_string = utility_int_to_bytes(col_value)
-        elif cols_desc[index][COL_DESC__FORMAT] == COL_FORMAT_BINARY or \
-             cols_desc[index][COL_DESC__TYPE] == COL_TEXT_TYPE_OID   or \
-             cols_desc[index][COL_DESC__TYPE] == COL_TEXT_TYPE_2_OID or \
-             cols_desc[index][COL_DESC__TYPE] == COL_TEXT_TYPE_3_OID or \
-             cols_desc[index][COL_DESC__TYPE] == COL_CHAR_TYPE_OID :
-                col_value_string = bytes(col_value, "utf-8")
-        elif cols_desc[index][COL_DESC__FORMAT] == COL_FORMAT_TEXT :
-                col_value_string = utility_int_to_text(col_value)
-        else :
-            raise ValueError('Unsupported serialize type : ', cols_desc[index])
+    for col_desc, col_value in zip(cols_desc, cols_values) :
+        if col_value is None :
+            msg += NULL_FIELD
+            continue
+
+        col_value_string = get_col_encoder(col_desc[COL_DESC__TYPE], col_desc[COL_DESC__FORMAT])(col_value)
 
         msg += struct.pack(COLDESC_FORMAT, len(col_value_string)) + col_value_string
 
@@ -984,6 +1185,82 @@ def D_Msg_DataRow_Serialize(cols_desc, cols_values) :
     return msg
 
 
+def D_Msg_DataRows_Serialize(cols_desc, rows) :
+    """! Serialize the data rows of a result set, encoding column by column
+    @param cols_desc description of columns - Column name, type, format and length
+    @param rows list of rows, each a list of column values
+
+    @return packed bytes of all the rows (D messages)
+    """
+    if len(rows) == 0 :
+        return bytes('', "utf-8")
+
+    assert len(rows[0]) == len(cols_desc), "Number of columns values and number of columns types do not match"
+
+    return D_Msg_DataCols_Serialize(cols_desc, rows_to_cols(rows))
+
+def D_Msg_DataCols_Serialize(cols_desc, cols) :
+    """! Serialize the data rows of a result set, given as column batches (see fetch_cols)
+    @param cols_desc description of columns - Column name, type, format and length
+    @param cols list of column batches - array.array, TextBuffer or list of values
+
+    @return packed bytes of all the rows (D messages) - Large batches are packed in a pooled output buffer (see pg_buffers),
+            to be released after their transmission
+    """
+    num_of_rows = get_num_of_col_rows(cols)
+    if num_of_rows == 0 :
+        return bytes('', "utf-8")
+
+    assert len(cols) == len(cols_desc), "Number of columns values and number of columns types do not match"
+
+    # Encode each column in a batch, then join each row fields. 
+    # NOT NULL columns are encoded without checking each value for NULL
+    cols_fields = [get_col_batch_encoder(col_desc[COL_DESC__TYPE], col_desc[COL_DESC__FORMAT], col_desc.get(COL_DESC__IS_NULLABLE, True))(col_values) 
+                   for col_desc, col_values in zip(cols_desc, cols)]
+
+    HEADERFORMAT = struct.Struct("!ih")        # Length / Field count
+    fields_count = len(cols_desc)
+    header_len = HEADERFORMAT.size
+
+    if all(isinstance(col_fields, FixedWidthFields) for col_fields in cols_fields) :
+        # All the fields are fixed width - So are the messages. Interleave the columns buffers to the messages buffer,
+        # by strided slice assignments (one per byte of the message, for all the rows)
+        msg_header = DATA_COLS_MSG_ID + HEADERFORMAT.pack(header_len + sum(col_fields.field_size for col_fields in cols_fields), fields_count)
+        msg_size = len(msg_header) + sum(col_fields.field_size for col_fields in cols_fields)
+        msgs_size = num_of_rows * msg_size
+        buffer = acquire_output_buffer(msgs_size)
+        # Strided assignments to the underlying bytearray - Much faster than to the memoryview
+        target = buffer.obj
+        for index, header_byte in enumerate(msg_header) :
+            target[index : msgs_size : msg_size] = bytes((header_byte,)) * num_of_rows
+        offset = len(msg_header)
+        for col_fields in cols_fields :
+            for index in range(col_fields.field_size) :
+                target[offset + index : msgs_size : msg_size] = col_fields.buffer[index : : col_fields.field_size]
+            offset += col_fields.field_size
+        return buffer
+
+    msgs = []
+    for row_fields in zip(*cols_fields) :
+        row = b"".join(row_fields)
+        msgs.append(DATA_COLS_MSG_ID + HEADERFORMAT.pack(header_len + len(row), fields_count) + row)
+
+    msgs_size = sum(map(len, msgs))
+    if not OUTPUT_BUFFER_POOL.is_pooled(msgs_size) :
+        return b"".join(msgs)
+
+    # Copy the messages to a pooled output buffer, a chunk of messages at a time - The chunks are small
+    # enough to be reused by the allocator, instead of allocating a new buffer of the whole batch
+    buffer = acquire_output_buffer(msgs_size)
+    target = buffer.obj
+    offset = 0
+    for index in range(0, len(msgs), DATA_ROWS_COPY_CHUNK) :
+        chunk = b"".join(msgs[index : index + DATA_ROWS_COPY_CHUNK])
+        target[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return buffer
+
+
 def T_Msg_RowDescription_Serialize(cols_desc):
         """! Serialize a row description section.
 
@@ -1146,6 +1423,87 @@ def R_Msg_AuthOk_Serialize():
 
     return auth_req_OK
 
+def H_Msg_CopyOutResponse_Serialize(copy_format, num_of_cols) :
+    """! Serialize a copy out response section.
+    @param copy_format COL_FORMAT_TEXT (text / csv) or COL_FORMAT_BINARY
+    @param num_of_cols Number of columns in the copied data
+
+    @return packed bytes of copy out response (H message)
+
+    CopyOutResponse (Backend)
+        Byte1('H')
+        Identifies the message as a Start Copy Out response. This message will be followed by copy-out data.
+
+        Int32
+        Length of message contents in bytes, including self.
+
+        Int8
+        0 indicates the overall COPY format is textual (rows separated by newlines, columns separated by separator characters, etc.). 
+        1 indicates the overall copy format is binary (similar to DataRow format).
+
+        Int16
+        The number of columns in the data to be copied (denoted N below).
+
+        Int16[N]
+        The format codes to be used for each column. Each must presently be zero (text) or one (binary). 
+        All must be zero if the overall copy format is textual.
+    """
+    HEADERFORMAT = "!ibh"       # Length / Overall format / Number of columns
+
+    cols_format = struct.pack("!{}h".format(num_of_cols), *([copy_format] * num_of_cols))
+
+    Length = struct.calcsize(HEADERFORMAT) + len(cols_format)
+
+    msg = COPY_OUT_RESPONSE_MSG_ID + struct.pack(HEADERFORMAT, Length, copy_format, num_of_cols) + cols_format
+
+    return msg
+
+def d_Msg_CopyData_Serialize(data) :
+    """! Serialize a copy data section.
+    @param data bytes of the copied data
+
+    @return packed bytes of copy data (d message)
+
+    CopyData (Frontend & Backend)
+        Byte1('d')
+        Identifies the message as COPY data.
+
+        Int32
+        Length of message contents in bytes, including self.
+
+        Byten
+        Data that forms part of a COPY data stream. Messages sent from the backend will always correspond to single data rows, 
+        but messages sent by frontends might divide the data stream arbitrarily.
+    """
+    HEADERFORMAT = "!i"         # Length 
+
+    Length = struct.calcsize(HEADERFORMAT) + len(data)
+
+    msg = COPY_DATA_MSG_ID + struct.pack(HEADERFORMAT, Length) + data
+
+    return msg
+
+def c_Msg_CopyDone_Serialize() :
+    """! Serialize a copy done section.
+    @param 
+
+    @return
+
+    CopyDone (Frontend & Backend)
+        Byte1('c')
+        Identifies the message as a COPY-complete indicator.
+
+        Int32(4)
+        Length of message contents in bytes, including self.
+    """
+    HEADERFORMAT = "!i"         # Length 
+
+    Length = struct.calcsize(HEADERFORMAT) 
+
+    msg = COPY_DONE_MSG_ID + struct.pack(HEADERFORMAT, Length) 
+
+    return msg
+
 def Z_Msg_ReadyForQuery_Serialize(server_status) :
     """! Serialize a ready for query section.
     @param server_status - Enumeration for the server status ('T' / 'T' / 'E')
@@ -1175,6 +1533,33 @@ def Z_Msg_ReadyForQuery_Serialize(server_status) :
     return msg
 
 
+def K_Msg_BackendKeyData_Serialize(process_id, secret_key) :
+    """! Serialize a backend key data section.
+    @param process_id Process ID of the session
+    @param secret_key Secret key of the session
+
+    @return packed bytes of backend key data (K message)
+
+    BackendKeyData (Backend)
+        Byte1('K')
+        Identifies the message as cancellation key data. The frontend must save these values if it wishes to be 
+        able to issue CancelRequest messages later.
+
+        Int32(12)
+        Length of message contents in bytes, including self.
+
+        Int32
+        The process ID of this backend.
+
+        Int32
+        The secret key of this backend.
+    """
+    HEADERFORMAT = "!iii"       # Length, Process ID, Secret key
+
+    msg = BACKEND_KEY_DATA_MSG_ID + struct.pack(HEADERFORMAT, struct.calcsize(HEADERFORMAT), process_id, secret_key)
+
+    return msg
+
 def One_Msg_ParseComplete_Serialize() :
     """! Serialize a parse complete section.
     @param 
@@ -1220,6 +1605,140 @@ def Two_Msg_BindComplete_Serialize() :
 
     return msg
 
+def Three_Msg_CloseComplete_Serialize() :
+    """! Serialize a close complete section.
+    @param 
+
+    @return
+
+    CloseComplete (Backend)
+        Byte1('3')
+        Identifies the message as a Close-complete indicator.
+
+        Int32(4)
+        Length of message contents in bytes, including self.
+
+    """
+    HEADERFORMAT = "!i"         # Length 
+
+    Length = struct.calcsize(HEADERFORMAT) 
+
+    msg = CLOSE_COMPLETE_MSG_ID + struct.pack(HEADERFORMAT, Length) 
+
+    return msg
+
+def n_Msg_NoData_Serialize() :
+    """! Serialize a no data section.
+    @param 
+
+    @return
+
+    NoData (Backend)
+        Byte1('n')
+        Identifies the message as a no-data indicator.
+
+        Int32(4)
+        Length of message contents in bytes, including self.
+
+    """
+    HEADERFORMAT = "!i"         # Length 
+
+    Length = struct.calcsize(HEADERFORMAT) 
+
+    msg = NO_DATA_MSG_ID + struct.pack(HEADERFORMAT, Length) 
+
+    return msg
+
+def s_Msg_PortalSuspended_Serialize() :
+    """! Serialize a portal suspended section.
+    @param 
+
+    @return
+
+    PortalSuspended (Backend)
+        Byte1('s')
+        Identifies the message as a portal-suspended indicator. 
+        Note this only appears if an Execute message's row-count limit was reached.
+
+        Int32(4)
+        Length of message contents in bytes, including self.
+
+    """
+    HEADERFORMAT = "!i"         # Length 
+
+    Length = struct.calcsize(HEADERFORMAT) 
+
+    msg = PORTAL_SUSPENDED_MSG_ID + struct.pack(HEADERFORMAT, Length) 
+
+    return msg
+
+def t_Msg_ParameterDescription_Serialize(param_types) :
+    """! Serialize a parameter description section.
+    @param param_types list of parameters type OIDs
+
+    @return packed bytes of parameter description (t message)
+
+    ParameterDescription (Backend)
+        Byte1('t')
+        Identifies the message as a parameter description.
+
+        Int32
+        Length of message contents in bytes, including self.
+
+        Int16
+        The number of parameters used by the statement (can be zero).
+
+        Then, for each parameter, there is the following:
+
+        Int32
+        Specifies the object ID of the parameter data type.
+    """
+    HEADERFORMAT = "!ih"        # Length / Parameters count
+    PARAMS_FORMAT = "!{}i".format(len(param_types))
+
+    Length = struct.calcsize(HEADERFORMAT) + struct.calcsize(PARAMS_FORMAT)
+
+    msg = PARAMETER_DESC_MSG_ID + struct.pack(HEADERFORMAT, Length, len(param_types)) + struct.pack(PARAMS_FORMAT, *param_types)
+
+    return msg
+
+def E_Msg_ErrorResponse_Serialize(sqlstate, message, severity = ERROR_SEVERITY_ERROR) :
+    """! Serialize an error response section.
+    @param sqlstate SQLSTATE code of the error (e.g. SQLSTATE_INVALID_STATEMENT_NAME)
+    @param message  Primary human-readable error message
+    @param severity ERROR_SEVERITY_ERROR / ERROR_SEVERITY_FATAL
+
+    @return packed bytes of error response (E message)
+
+    ErrorResponse (Backend)
+        Byte1('E')
+        Identifies the message as an error.
+
+        Int32
+        Length of message contents in bytes, including self.
+
+        The message body consists of one or more identified fields, followed by a zero byte as a terminator. 
+        Fields can appear in any order. For each field there is the following:
+
+        Byte1
+        A code identifying the field type; if zero, this is the message terminator and no string follows. 
+
+        String
+        The field value.
+    """
+    HEADERFORMAT = "!i"         # Length 
+
+    fields = ERROR_FIELD_SEVERITY + bytes(severity, "utf-8") + NULL_TERMINATOR + \
+             ERROR_FIELD_CODE     + bytes(sqlstate, "utf-8") + NULL_TERMINATOR + \
+             ERROR_FIELD_MESSAGE  + bytes(message,  "utf-8") + NULL_TERMINATOR + \
+             NULL_TERMINATOR
+
+    Length = struct.calcsize(HEADERFORMAT) + len(fields)
+
+    msg = ERROR_RESPONSE_MSG_ID + struct.pack(HEADERFORMAT, Length) + fields
+
+    return msg
+
 # *****************************************************
 # * Unit Testing
 # *****************************************************
@@ -22,9 +22,63 @@ logging.basicConfig(level=logging.DEBUG)
 # * PG server logic
 # *****************************************************
 from pg_statemachine import *
+from pg_profiler import PROFILER, install_profiler_signal_handler
+from pg_capture import SessionRecorder
+from pg_buffers import OUTPUT_BUFFER_POOL
+from pg_backend_pool import BackendPool, BackendPoolExhausted
+from pg_reaper import SessionActivity, SessionReaper, set_tcp_keepalive
+from pg_cancel import QueryCanceller, create_cancel_key, get_cancel_key_worker
+from pg_scheduler import QueryScheduler
 
+import time
+import queue
+import socket
+import selectors
 import threading
+import itertools
 import socketserver
+import concurrent.futures
+
+# Maximum number of buffers in a single sendmsg call (IOV_MAX)
+SENDMSG_MAX_BUFFERS = 1024
+
+# Admission control - Sessions beyond SERVER_MAX_SESSIONS are rejected with an ErrorResponse
+SERVER_MAX_SESSIONS   = 64      # Also the number of session threads, and of backend connections
+SERVER_ACCEPT_BACKLOG = 128     # Connections waiting to be accepted (listen backlog)
+SERVER_FIRST_MESSAGE_TIMEOUT = 10   # Seconds for a new connection to send its first message, before it is closed
+SERVER_CANCEL_POLL_INTERVAL  = 1    # Seconds between two checks that the server stopped, while waiting for forwarded cancels
+
+# Complete CancelRequest message - Length, cancel request code, process ID, secret key
+CANCEL_REQUEST_LENGTH = 16
+
+# Server metrics keys
+SERVER_METRICS__SESSIONS_ACTIVE = "SESSIONS_ACTIVE"
+SERVER_METRICS__SESSIONS_TOTAL  = "SESSIONS_TOTAL"
+SERVER_METRICS__REQUESTS        = "REQUESTS"
+SERVER_METRICS__BYTES_SENT      = "BYTES_SENT"
+SERVER_METRICS__SESSIONS_REJECTED = "SESSIONS_REJECTED"
+
+def send_buffers(sock, buffers) :
+    """! Send a list of buffers, as sendall does for a single buffer : Scatter-gather writes (sendmsg), 
+         so the buffers (e.g. cached messages, encoded batches) are not copied to a single contiguous buffer.
+         Falls back to sendall where sendmsg is not available (e.g. Windows).
+    @param sock    connected socket
+    @param buffers list of bytes-like objects
+    """
+    if not hasattr(sock, "sendmsg") :
+        sock.sendall(b"".join(buffers))
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+    index = 0
+    while index < len(buffers) :
+        num_of_bytes = sock.sendmsg(buffers[index : index + SENDMSG_MAX_BUFFERS])
+        # Skip the buffers that were sent, and keep the unsent part of a partially sent buffer
+        while index < len(buffers) and num_of_bytes >= len(buffers[index]) :
+            num_of_bytes -= len(buffers[index])
+            index += 1
+        if num_of_bytes > 0 :
+            buffers[index] = buffers[index][num_of_bytes:]
 
 class MyPGHandler(socketserver.BaseRequestHandler):
     """
@@ -32,73 +86,512 @@ class MyPGHandler(socketserver.BaseRequestHandler):
     """
     INPUT_BUFF_SIZE = 1024 * 1024
 
+    def setup(self):
+        # Each session has its own state machine (prepared statements, portals) and backend connection, from the pool.
+        # The connection is attached by the Startup message, keyed by its connection parameters (get_backend_db_key)
+        self.is_clean_exit = False
+        self.pg_sm = CreatePGStateMachine(is_connect = False)
+        self.backend_key = None
+        self.backend_db_con = None
+
+        # The running query can be canceled by a CancelRequest with the session cancel key, or by its statement timeout (see pg_cancel).
+        # Its backend statements are admitted by the server scheduler (see pg_scheduler)
+        self.canceller = QueryCanceller(lambda : self.pg_sm.session[SESSION__STATEMENT_TIMEOUT], self.server.scheduler)
+        self.cancel_key = create_cancel_key(next(self.server.session_ids), self.server.worker_index)
+        self.pg_sm.session[SESSION__CANCEL_KEY] = self.cancel_key
+
+        # Idle sessions are terminated by the server reaper, and dead peers are detected by TCP keepalive
+        self.activity = SessionActivity()
+        set_tcp_keepalive(self.request)
+        self.server.add_session(self)
+
+        # Received bytes not parsed yet - A message may be split between several receives
+        self.rx_buffer = b""
+
+        # Optional traffic capture of this session, for later replay (see pg_capture.py)
+        self.recorder = None
+        if self.server.capture_dir is not None :
+            self.recorder = SessionRecorder(self.server.capture_dir, self.client_address)
+
+        self.server.update_metrics({SERVER_METRICS__SESSIONS_ACTIVE : 1, SERVER_METRICS__SESSIONS_TOTAL : 1})
+
+    def finish(self):
+        self.server.remove_session(self)
+        self.server.update_metrics({SERVER_METRICS__SESSIONS_ACTIVE : -1})
+        # Scheduler slots of statements left open (e.g. a suspended portal of a client that disconnected)
+        self.canceller.release_all()
+        # A session that failed may leave its backend connection in an unknown state - Not reused
+        if self.backend_db_con is not None :
+            if self.is_clean_exit :
+                self.park_backend()
+            else :
+                self.discard_backend()
+        if self.recorder is not None :
+            self.recorder.close()
+
     def handle(self):
         while True :
             # RX Request
-            self.data = self.request.recv(self.INPUT_BUFF_SIZE)
+            try :
+                self.data = self.request.recv(self.INPUT_BUFF_SIZE)
+            except OSError as e :
+                # The client is gone (e.g. no answer to TCP keepalive) - Ends the session as a client disconnect
+                logging.error("*** pg_server_proxy : Receive failed - {}".format(e))
+                self.data = b""
+            self.activity.on_receive()
+            if self.recorder is not None :
+                self.recorder.record_inbound(self.data)
 
             cur_thread = threading.current_thread()
 
             logging.info("*** {} : Client Port {}".format(cur_thread.name, self.client_address[1]))
             logging.info(self.data)
-            logging.info("New state : {}".format(self.server.pg_sm.new_state))
+            logging.info("New state : {}".format(self.pg_sm.new_state))
 
             # Received an empty message - This means end of communication
             if len(self.data) == 0 :
                 logging.error("*** pg_server_proxy : Received zero length message. Exiting")
-                force_initial_state(self.server.pg_sm)
+                force_initial_state(self.pg_sm)
+                self.is_clean_exit = True
                 break
-            # Received a Startup message at the middle of the session - Return to initial state
-            is_startup_msg = is_init_message(self.data[0:1])
-            if is_startup_msg: 
-               force_initial_state(self.server.pg_sm)
-
-            # Tokenize input bytes stream to discrete messages
-            tokens = tokenization(self.data, is_startup_msg)
-
-            # Parse messages to their attributes
-            parsed_msgs = parse(tokens)
-
-            # Initialize the result return object from the state machine 
-            res = {}
-            res[STATE_MACHINE__IS_TX_MSG]   = False
-            res[STATE_MACHINE__OUTPUT_MSG]  = bytes('', "utf-8")
-            res[STATE_MACHINE__PARSED_MSGS] = parsed_msgs
-
-            # As long as there are messages received from client that were not munched, keep processing them
-            while len(res[STATE_MACHINE__PARSED_MSGS]) > 0: 
-                # Run state machine as long as the state transitions have nothing to transmit
-                while res[STATE_MACHINE__IS_TX_MSG] == False : 
-                    res = self.server.pg_sm.run(res[STATE_MACHINE__PARSED_MSGS], 
-                                                res[STATE_MACHINE__OUTPUT_MSG])
-
-                # TX Response
-                self.request.sendall(res[STATE_MACHINE__OUTPUT_MSG])
-                # Enable running the state machine, if there are additional messages in the parsed_msgs
-                res[STATE_MACHINE__IS_TX_MSG] = False
-                res[STATE_MACHINE__OUTPUT_MSG]  = bytes('', "utf-8")
+            # Tokenize the complete messages in the input bytes stream, keep a partial message for the next receive
+            self.rx_buffer += self.data
+            is_startup_msg = is_init_message(self.rx_buffer[0:1])
+            tokens, num_of_bytes = split_frames(self.rx_buffer, is_startup_msg)
+            self.rx_buffer = self.rx_buffer[num_of_bytes:]
+            if len(tokens) == 0 :
+                continue
+
+            # The session was terminated by the reaper meanwhile
+            if not self.activity.start_request() :
+                force_initial_state(self.pg_sm)
+                self.is_clean_exit = True
+                break
+            try :
+                # Received a Startup message at the middle of the session - Return to initial state
+                if is_startup_msg: 
+                   force_initial_state(self.pg_sm)
+
+                # Parse messages to their attributes
+                parsed_msgs = parse(tokens)
+
+                # CancelRequest, on a connection of its own - Cancel the query of the session with the key, no response
+                if parsed_msgs[0][MSG_ID] == CANCEL_REQUEST_MSG_ID :
+                    self.server.cancel_session((parsed_msgs[0][CANCEL_REQUEST_MSG__PROCESS_ID], 
+                                                parsed_msgs[0][CANCEL_REQUEST_MSG__SECRET_KEY]))
+                    self.is_clean_exit = True
+                    break
+
+                # Attach a backend connection - At the session start, or after a DISCARD ALL parked it
+                if not self.attach_backend(get_backend_db_key()) :
+                    self.is_clean_exit = True
+                    break
+
+                # Run the state machine on the parsed messages, under the profiler if it was armed
+                self.canceller.start_request()
+                try :
+                    if PROFILER.is_armed :
+                        num_of_queries = len([msg for msg in parsed_msgs if msg[MSG_ID] in (QUERY_MSG_ID, PARSE_MSG_ID)])
+                        PROFILER.run(self.client_address[1], num_of_queries, self.process_parsed_msgs, parsed_msgs)
+                    else :
+                        self.process_parsed_msgs(parsed_msgs)
+                finally :
+                    # A canceled backend call closed the backend connection - Replaced before the next request
+                    if self.canceller.end_request() :
+                        self.discard_backend()
+
+                # The client reset the session (DISCARD ALL) - Park its connection until its next request
+                if self.pg_sm.session[SESSION__IS_DISCARDED] and self.backend_db_con is not None and not self.is_in_transaction() :
+                    self.pg_sm.session[SESSION__IS_DISCARDED] = False
+                    self.park_backend()
+            finally :
+                self.activity.end_request()
+
+    def attach_backend(self, key):
+        """
+        Attach a backend connection of the key to the session, parking the connection of another key.
+        On failure, the client is sent a FATAL ErrorResponse.
+        Returns True if attached, False if the session must end
+        """
+        if self.backend_db_con is not None :
+            if key == self.backend_key :
+                return True
+            self.park_backend()
+
+        try :
+            self.backend_db_con = self.server.backend_pool.acquire(key)
+        except BackendPoolExhausted as e :
+            error_msg = E_Msg_ErrorResponse_Serialize(SQLSTATE_TOO_MANY_CONNECTIONS, str(e), ERROR_SEVERITY_FATAL)
+        except Exception as e :
+            logging.error("*** pg_server_proxy : Backend connection failed - {}".format(e))
+            error_msg = E_Msg_ErrorResponse_Serialize(SQLSTATE_CONNECTION_FAILURE, 
+                                                      "could not connect to the backend database", ERROR_SEVERITY_FATAL)
+        else :
+            self.backend_key = key
+            self.pg_sm.backend_db_con = self.canceller.wrap(self.backend_db_con)
+            return True
+
+        self.tx_response([error_msg])
+        return False
+
+    def park_backend(self):
+        """
+        Return the session backend connection to the pool, for the next session of its key
+        """
+        self.server.backend_pool.release(self.backend_db_con, self.backend_key)
+        self.backend_db_con = None
+        self.pg_sm.backend_db_con = None
+
+    def discard_backend(self):
+        """
+        Close the session backend connection (e.g. broken or aborted) instead of returning it to the pool
+        """
+        self.server.backend_pool.discard(self.backend_db_con)
+        self.backend_db_con = None
+        self.pg_sm.backend_db_con = None
+
+    def cancel(self):
+        """
+        Cancel the running query, from another thread (see ThreadedTCPServer.cancel_session)
+        """
+        if self.canceller.cancel() :
+            logging.error("*** pg_server_proxy : Canceled the query of client port {}".format(self.client_address[1]))
+
+    def is_in_transaction(self):
+        return self.pg_sm is not None and is_session_in_transaction(self.pg_sm.session)
+
+    def terminate(self, sqlstate, message):
+        """
+        Terminate the session from another thread (see pg_reaper) : Send a FATAL ErrorResponse, and shut the 
+        connection down - The session thread receive returns, and the session ends as if the client closed it
+        """
+        try :
+            send_buffers(self.request, [E_Msg_ErrorResponse_Serialize(sqlstate, message, ERROR_SEVERITY_FATAL)])
+        finally :
+            self.request.shutdown(socket.SHUT_RDWR)
+
+    def process_parsed_msgs(self, parsed_msgs):
+        """
+        Run the state machine over the parsed client messages, and transmit its responses.
+        """
+        self.server.update_metrics({SERVER_METRICS__REQUESTS : 1})
+        run_state_machine(self.pg_sm, parsed_msgs, self.tx_response)
+
+    def tx_response(self, output_msgs):
+        """
+        Transmit a response - A list of packed bytes buffers
+        """
+        send_buffers(self.request, output_msgs)
+        self.server.update_metrics({SERVER_METRICS__BYTES_SENT : sum(len(msg) for msg in output_msgs)})
+        if self.recorder is not None :
+            self.recorder.record_outbound(b"".join(output_msgs))
+
+class ConnectionsDispatcher(threading.Thread):
+    """
+    Waits for the first message of the new connections, without holding a session thread :
+        * A CancelRequest is served right away, and the connection closed - It does not take a session slot,
+          so a query can be canceled when the server is full
+        * Other connections (Startup message, SSLRequest) are admitted as sessions (see ThreadedTCPServer.admit_request).
+          The first message is only peeked at - The session reads it.
+    Connections which send nothing for SERVER_FIRST_MESSAGE_TIMEOUT seconds are closed.
+    """
+    def __init__(self, server):
+        super().__init__(daemon = True, name = "pg_dispatcher")
+        self.server      = server
+        self.selector    = selectors.DefaultSelector()
+        self.lock        = threading.Lock()
+        self.new_connections = []       # (request, client address), to register by the dispatcher thread
+        self.deadlines   = {}           # request -> Time to close it if it sent nothing
+        self.is_stopped  = threading.Event()
+        self.wake_up_rx, self.wake_up_tx = socket.socketpair()
+        self.selector.register(self.wake_up_rx, selectors.EVENT_READ)
+
+    def add(self, request, client_address):
+        """! Wait for the first message of a new connection - Called by the accept loop
+        """
+        with self.lock :
+            self.new_connections.append((request, client_address))
+        self.wake_up_tx.send(b"\x00")
+
+    def stop(self):
+        self.is_stopped.set()
+        self.wake_up_tx.send(b"\x00")
+        self.join()
+        for request in list(self.deadlines) :
+            self.selector.unregister(request)
+            self.server.shutdown_request(request)
+        self.deadlines = {}
+        self.selector.close()
+        self.wake_up_rx.close()
+        self.wake_up_tx.close()
+
+    def run(self):
+        while not self.is_stopped.is_set() :
+            for key, _ in self.selector.select(timeout = SERVER_FIRST_MESSAGE_TIMEOUT) :
+                if key.fileobj is self.wake_up_rx :
+                    self.wake_up_rx.recv(4096)
+                    self.register_new_connections()
+                else :
+                    self.selector.unregister(key.fileobj)
+                    del self.deadlines[key.fileobj]
+                    self.dispatch(key.fileobj, key.data)
+            self.close_expired()
+
+    def register_new_connections(self):
+        with self.lock :
+            new_connections, self.new_connections = self.new_connections, []
+        deadline = time.monotonic() + SERVER_FIRST_MESSAGE_TIMEOUT
+        for request, client_address in new_connections :
+            self.selector.register(request, selectors.EVENT_READ, client_address)
+            self.deadlines[request] = deadline
+
+    def close_expired(self):
+        now = time.monotonic()
+        for request, deadline in list(self.deadlines.items()) :
+            if now >= deadline :
+                logging.error("*** pg_server_proxy : No message from client port {} - Closing".format(self.selector.get_key(request).data[1]))
+                self.selector.unregister(request)
+                del self.deadlines[request]
+                self.server.shutdown_request(request)
+
+    def dispatch(self, request, client_address):
+        """! Serve a CancelRequest, or admit the connection as a session.
+             A first message split over several packets is left to the session - It handles CancelRequests as well.
+        """
+        try :
+            data = request.recv(CANCEL_REQUEST_LENGTH, socket.MSG_PEEK)
+        except OSError :
+            data = b""
+        if len(data) == 0 :
+            self.server.shutdown_request(request)
+            return
+
+        tokens, num_of_bytes = split_frames(data, True)
+        if len(tokens) > 0 and is_cancel_request(tokens[0]) :
+            parsed_msg = CancelRequest_Msg_Deserialize(tokens[0])
+            try :
+                request.recv(num_of_bytes)
+                self.server.cancel_session((parsed_msg[CANCEL_REQUEST_MSG__PROCESS_ID], parsed_msg[CANCEL_REQUEST_MSG__SECRET_KEY]))
+            finally :
+                self.server.shutdown_request(request)
+            return
+
+        self.server.admit_request(request, client_address)
 
 # Multithreading the Server, enabling a client to start a new session, without closing the first one.
 # This is a behaviour seen with PowerBI, after the Table Preview stage during connection to the database.
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+# Sessions run on a bounded pool of threads - Once SERVER_MAX_SESSIONS are active, new connections are rejected
+# right away with an ErrorResponse (too many connections), so a reconnect storm cannot exhaust the server.
+# CancelRequests are served by the connections dispatcher, before admission - They do not take a session slot.
+class ThreadedTCPServer(socketserver.TCPServer):
+    """
+    Sessions server, with the server wide state of its sessions - Backend connections pool, session threads,
+    capture directory and metrics
+    """
+    allow_reuse_address = True
+    request_queue_size  = SERVER_ACCEPT_BACKLOG
 
-def RunPGServer(host, port) :
-    # Create the server, binding to localhost on port PG_PORT
-    ThreadedTCPServer.allow_reuse_address = True
-    with ThreadedTCPServer((host, port), MyPGHandler) as server:
-        server.pg_sm = CreatePGStateMachine()
+    def __init__(self, server_address, handler_class, capture_dir = None, reuse_port = False, 
+                 max_sessions = SERVER_MAX_SESSIONS, worker_index = 0, cancel_queues = None):
+        """
+        worker_index  : Index of this worker process (see pg_workers.py) - Held by the sessions cancel keys
+        cancel_queues : multiprocessing.Queue of forwarded cancel keys, per worker index (None - Single server process)
+        """
+        self.allow_reuse_port = reuse_port     # Several worker processes bind the same port (see pg_workers.py)
+        self.worker_index  = worker_index
+        self.cancel_queues = cancel_queues
+        self.capture_dir   = capture_dir
+        self.max_sessions  = max_sessions
+        self.num_of_sessions = 0                # Admitted sessions, running or about to run
+        self.metrics       = {SERVER_METRICS__SESSIONS_ACTIVE   : 0,
+                              SERVER_METRICS__SESSIONS_TOTAL    : 0,
+                              SERVER_METRICS__SESSIONS_REJECTED : 0,
+                              SERVER_METRICS__REQUESTS          : 0,
+                              SERVER_METRICS__BYTES_SENT        : 0}
+        self.metrics_lock  = threading.Lock()
+        self.sessions      = set()              # Handlers of the running sessions
+        self.cancel_keys   = {}                 # Cancel key -> Handler of the running session
+        self.session_ids   = itertools.count(1)
+        self.scheduler     = QueryScheduler()       # Admission of the backend statements of all the sessions
+        super().__init__(server_address, handler_class)
 
-        # Activate the server; this will keep running until you
-        # interrupt the program with Ctrl-C
+        self.sessions_pool = concurrent.futures.ThreadPoolExecutor(max_workers = max_sessions, thread_name_prefix = "pg_session")
+        # The proxy logs in to the backend with its own credentials (see pg_statemachine.py) - The connections are 
+        # keyed by the parameters they connect with, so a parked connection serves the next session of any client
+        self.backend_pool  = BackendPool(connect_backend_db_key, max_connections = max_sessions)
+        # Connect once at start - Fail fast if the backend is not reachable
+        self.backend_pool.discard(self.backend_pool.acquire(get_backend_db_key()))
+
+        self.reaper = SessionReaper(self.get_sessions)
+        self.reaper.start()
+
+        self.dispatcher = ConnectionsDispatcher(self)
+        self.dispatcher.start()
+
+        # CancelRequests received by the other workers, for sessions of this worker
+        self.is_stopping = threading.Event()
+        self.cancels_thread = None
+        if self.cancel_queues is not None :
+            self.cancels_thread = threading.Thread(target = self.serve_forwarded_cancels, daemon = True, name = "pg_cancels")
+            self.cancels_thread.start()
+
+    def add_session(self, session):
+        with self.metrics_lock :
+            self.sessions.add(session)
+            self.cancel_keys[session.cancel_key] = session
+
+    def remove_session(self, session):
+        with self.metrics_lock :
+            self.sessions.discard(session)
+            self.cancel_keys.pop(session.cancel_key, None)
+
+    def cancel_session(self, cancel_key):
+        """
+        Cancel the running query of the session with the cancel key (process ID, secret key) - Ignored if there is none.
+        A key of another worker process is forwarded to it.
+        """
+        worker_index = get_cancel_key_worker(cancel_key)
+        if worker_index != self.worker_index and self.cancel_queues is not None and worker_index < len(self.cancel_queues) :
+            self.cancel_queues[worker_index].put(cancel_key)
+            return
+
+        with self.metrics_lock :
+            session = self.cancel_keys.get(cancel_key)
+        if session is None :
+            logging.error("*** pg_server_proxy : CancelRequest with an unknown key - Ignored")
+            return
+        session.cancel()
+
+    def serve_forwarded_cancels(self):
+        """
+        Cancel the sessions of the keys forwarded by the other workers, until the server stops
+        """
+        cancel_queue = self.cancel_queues[self.worker_index]
+        while not self.is_stopping.is_set() :
+            try :
+                cancel_key = cancel_queue.get(timeout = SERVER_CANCEL_POLL_INTERVAL)
+            except queue.Empty :
+                continue
+            self.cancel_session(tuple(cancel_key))
+
+    def get_sessions(self):
+        with self.metrics_lock :
+            return list(self.sessions)
+
+    def process_request(self, request, client_address):
+        """
+        Wait for the first message of the connection, without holding a session thread (see ConnectionsDispatcher)
+        """
+        self.dispatcher.add(request, client_address)
 
-        # Start a thread with the server -- that thread will then start one
-        # more thread for each request
-        server_thread = threading.Thread(target=server.serve_forever)
+    def admit_request(self, request, client_address):
+        """
+        Run the session on a pool thread, or reject it if the server is full
+        """
+        with self.metrics_lock :
+            is_admitted = self.num_of_sessions < self.max_sessions
+            if is_admitted :
+                self.num_of_sessions += 1
+            else :
+                self.metrics[SERVER_METRICS__SESSIONS_REJECTED] += 1
 
-        server_thread.start()
-        print("Server loop running in thread:", server_thread.name)
+        if not is_admitted :
+            self.reject_request(request, client_address)
+            return
+        self.sessions_pool.submit(self.process_request_thread, request, client_address)
 
+    def process_request_thread(self, request, client_address):
+        try :
+            self.finish_request(request, client_address)
+        except Exception :
+            self.handle_error(request, client_address)
+        finally :
+            self.shutdown_request(request)
+            with self.metrics_lock :
+                self.num_of_sessions -= 1
+
+    def reject_request(self, request, client_address):
+        """
+        Reply with a FATAL ErrorResponse and close - Sent without reading the client Startup message, 
+        so the accept loop is not held by the rejected client
+        """
+        logging.error("*** pg_server_proxy : {} sessions are active - Rejecting client port {}".format(self.max_sessions, client_address[1]))
+        try :
+            request.sendall(E_Msg_ErrorResponse_Serialize(SQLSTATE_TOO_MANY_CONNECTIONS, "sorry, too many clients already", 
+                                                          ERROR_SEVERITY_FATAL))
+            # Drop what the client sent already - Closing with unread data would reset the connection, 
+            # and the client could lose the error
+            request.setblocking(False)
+            request.recv(self.RequestHandlerClass.INPUT_BUFF_SIZE)
+        except OSError :
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        self.reaper.stop()
+        self.dispatcher.stop()
+        self.is_stopping.set()
+        if self.cancels_thread is not None :
+            self.cancels_thread.join()
+        super().server_close()
+        self.sessions_pool.shutdown(wait = True)
+
+    def server_bind(self):
+        if self.allow_reuse_port :
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def update_metrics(self, increments):
+        """! Add to the server metrics
+        @param increments dictionary of metric key -> increment
+        """
+        with self.metrics_lock :
+            for key, increment in increments.items() :
+                self.metrics[key] += increment
+
+    def get_metrics(self):
+        """! Snapshot of the server metrics, with the output buffers and backend connections pools, and the query
+             scheduler statistics
+        """
+        with self.metrics_lock :
+            metrics = dict(self.metrics)
+        metrics.update(OUTPUT_BUFFER_POOL.get_stats())
+        metrics.update(self.backend_pool.get_stats())
+        metrics.update(self.scheduler.get_stats())
+        return metrics
+
+def CreatePGServer(host, port, capture_dir = None, reuse_port = False, worker_index = 0, cancel_queues = None) :
+    """
+    Bind the server, and connect it to the backend
+    capture_dir   : Directory to record each session traffic to (None - No capture)
+    reuse_port    : Share the port with other processes (SO_REUSEPORT) - The kernel balances the connections between them
+    worker_index  : Index of the worker process (see pg_workers.py)
+    cancel_queues : Forwarded cancel keys queue per worker index - CancelRequests reach any worker (None - Single process)
+    """
+    return ThreadedTCPServer((host, port), MyPGHandler, capture_dir, reuse_port, 
+                             worker_index = worker_index, cancel_queues = cancel_queues)
+
+def start_server_thread(server) :
+    """
+    Start a thread with the server -- that thread will then start one more thread for each request
+    """
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    print("Server loop running in thread:", server_thread.name)
+    return server_thread
+
+def RunPGServer(host, port, capture_dir = None) :
+    """
+    capture_dir : Directory to record each session traffic to (None - No capture)
+    """
+    # Create the server, binding to localhost on port PG_PORT
+    with CreatePGServer(host, port, capture_dir) as server:
+        # On-demand profiling - Toggled by SIGUSR1 (or by the PG_MIMIC PROFILE admin query)
+        install_profiler_signal_handler()
+
+        # Activate the server; this will keep running until you
+        # interrupt the program with Ctrl-C
+        server_thread = start_server_thread(server)
         server_thread.join()
 
 # *****************************************************
@@ -107,4 +600,5 @@ def RunPGServer(host, port) :
 if __name__ == "__main__" :
     PG_PORT = 5432
     HOST, PORT = "localhost", PG_PORT
-    RunPGServer(HOST, PORT)
\ No newline at end of file
+    CAPTURE_DIR = None          # e.g. "captures" - Record sessions traffic, for replay with pg_capture.py
+    RunPGServer(HOST, PORT, CAPTURE_DIR)
\ No newline at end of file
@@ -8,6 +8,8 @@ Postgres network messages formats : https://www.postgresql.org/docs/12/protocol-
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+import time
+
 # *****************************************************
 # * State machine constants
 # *****************************************************
@@ -15,6 +17,7 @@ STATE_MACHINE__NEW_STATE   = "new_state"
 STATE_MACHINE__OUTPUT_MSG  = "output_msg"
 STATE_MACHINE__IS_TX_MSG   = "is_tx_msg"
 STATE_MACHINE__PARSED_MSGS = "parsed_msgs"
+STATE_MACHINE__OUTPUT_STREAM = "output_stream"  # Optional - Generator of the response batches that follow OUTPUT_MSG (large results)
 
 # ********************************************************
 # * PG communication protocol State machine implementation
@@ -24,6 +27,7 @@ class PG_StateMachine:
         self.handlers = {}
         self.new_state = None
         self.backend_db_con = None
+        self.session = {}
 
     def add_state(self, name, handler, end_state=0):
         name = name.upper()
@@ -35,7 +39,8 @@ class PG_StateMachine:
     def run(self, parsed_msgs, output_msg):
         """
         parsed_msgs : List of dictionaries, holding the input mesages
-        output_msg  : A string being built by the states in the state machine.
+        output_msg  : List of packed bytes buffers, being built by the states in the state machine.
+                      Buffers are transmitted as they are (scatter-gather), without copying them to a single buffer.
         """
 
         res = {}
@@ -45,7 +50,8 @@ class PG_StateMachine:
         # Run state logic
         res = handler(  parsed_msgs, 
                         output_msg, 
-                        self.backend_db_con)        
+                        self.backend_db_con,
+                        self.session)        
 
         # Update next state logic handler
         self.new_state = res[STATE_MACHINE__NEW_STATE] 
@@ -56,6 +62,13 @@ class PG_StateMachine:
 
 from pg_serdes import *
 from sqream_backend import *
+from pg_profiler import is_profiler_admin_query, run_profiler_admin_query
+from pg_copy import *
+from pg_stream import *
+from pg_buffers import release_output_buffers
+from pg_parallel import create_batch_encoder
+from pg_cancel import QueryCanceled, get_default_statement_timeout
+from pg_local import *
 
 # *****************************************************
 # * Postgres Protocol Implementation
@@ -68,7 +81,110 @@ SIMPLE_QUERY_STATE      = "SIMPLE_QUERY_STATE"
 PARSE_QUERY_STATE       = "PARSE_QUERY_STATE"
 END_STATE               = "END_STATE"
 
-def startup_transition(parsed_msgs, output_msg, backend_db_con) :
+# Session state - Per client session, passed to all the state transitions
+SESSION__PREPARED_STATEMENTS = "prepared_statements"   # Statement name -> Prepared statement
+SESSION__PORTALS             = "portals"               # Portal name -> Portal
+SESSION__IS_SKIP_TO_SYNC     = "is_skip_to_sync"       # An extended query message failed - Discard messages until the next Sync
+SESSION__STARTUP_PARAMETERS  = "startup_parameters"    # Parameters of the client Startup message (user, database, ...)
+SESSION__IS_DISCARDED        = "is_discarded"          # The client reset the session (DISCARD ALL) - Its backend connection can be parked
+SESSION__CANCEL_KEY          = "cancel_key"            # (process ID, secret key) sent in BackendKeyData, None - Not cancellable
+SESSION__PARAMETERS          = "parameters"            # Session parameters (SET / SHOW), see pg_local
+SESSION__STATEMENT_TIMEOUT   = "statement_timeout"     # Milliseconds, 0 - No timeout (see pg_cancel) - Of the statement_timeout parameter
+
+# Prepared statement attributes
+STATEMENT__QUERY         = "query"              # Query as received in the Parse message (null terminated bytes)
+STATEMENT__IS_CATALOG    = "is_catalog"         # PowerBI catalog query, answered by the proxy
+STATEMENT__IS_LOCAL      = "is_local"           # Session-level or trivial query, answered by the proxy (see pg_local)
+STATEMENT__BACKEND_QUERY = "backend_query"      # Query string sent to the backend (regular queries), or run locally
+STATEMENT__PARAM_TYPES   = "param_types"
+STATEMENT__COLS_DESC     = "cols_desc"          # Cached columns description (default formats), None until first known
+STATEMENT__ROW_DESC_MSGS = "row_desc_msgs"      # Cached serialized RowDescription, by result-column formats
+
+# Portal attributes
+PORTAL__STATEMENT   = "statement"
+PORTAL__RESULT_FORMATS = "result_formats"      # Result-column format codes, as received in the Bind message
+PORTAL__COLS_DESC   = "cols_desc"               # Columns description, with the portal result formats
+PORTAL__IS_RUN      = "is_run"                  # Portal query was run
+PORTAL__IS_DONE     = "is_done"                 # All rows were sent
+PORTAL__CURSOR      = "cursor"                  # Open backend cursor, rows are fetched by Execute (regular queries)
+PORTAL__COLS_VALUES = "cols_values"             # Rows not sent yet (catalog and local queries)
+PORTAL__COMMAND_TAG = "command_tag"             # CommandComplete tag of a local query, None - SELECT <number of rows>
+
+def create_session_state() :
+    """
+    Returns a new (empty) session state
+    """
+    return {SESSION__PREPARED_STATEMENTS : {},
+            SESSION__PORTALS             : {},
+            SESSION__IS_SKIP_TO_SYNC     : False,
+            SESSION__STARTUP_PARAMETERS  : {},
+            SESSION__IS_DISCARDED        : False,
+            SESSION__CANCEL_KEY          : None,
+            SESSION__PARAMETERS          : create_session_parameters({}),
+            SESSION__STATEMENT_TIMEOUT   : get_default_statement_timeout({})}
+
+def create_portal(statement, result_formats = ()) :
+    return {PORTAL__STATEMENT   : statement,
+            PORTAL__RESULT_FORMATS : result_formats,
+            PORTAL__COLS_DESC   : None,
+            PORTAL__IS_RUN      : False,
+            PORTAL__IS_DONE     : False,
+            PORTAL__CURSOR      : None,
+            PORTAL__COLS_VALUES : None,
+            PORTAL__COMMAND_TAG : None}
+
+def close_portal(portal) :
+    """
+    Releases the portal backend cursor, if still open
+    """
+    if portal[PORTAL__CURSOR] is not None :
+        close_query(portal[PORTAL__CURSOR])
+        portal[PORTAL__CURSOR] = None
+    portal[PORTAL__COLS_VALUES] = None
+    portal[PORTAL__IS_DONE] = True
+
+def drop_portal(name, session) :
+    portal = session[SESSION__PORTALS].pop(name, None)
+    if portal is not None :
+        close_portal(portal)
+
+def close_session(session) :
+    """
+    Releases all the session portals, and forgets its prepared statements.
+    The cancel key is kept - It belongs to the client connection.
+    """
+    for portal in session.get(SESSION__PORTALS, {}).values() :
+        close_portal(portal)
+    cancel_key = session.get(SESSION__CANCEL_KEY)
+    session.update(create_session_state())
+    session[SESSION__CANCEL_KEY] = cancel_key
+
+def is_session_in_transaction(session) :
+    """
+    True if the session holds an open backend query - A portal suspended by an Execute row limit
+    """
+    return any(portal[PORTAL__CURSOR] is not None for portal in session[SESSION__PORTALS].values())
+
+def set_session_parameters(session, parameters) :
+    """! Set the session parameters, and the settings the proxy enforces from them (statement timeout)
+    """
+    session[SESSION__PARAMETERS] = parameters
+    session[SESSION__STATEMENT_TIMEOUT] = get_default_statement_timeout(parameters)
+
+def parameter_status_msgs(changed_parameters) :
+    """! ParameterStatus messages of the reported parameters a command changed
+    """
+    return [S_Msg_ParameterStatus_Serialize(str.encode(name), str.encode(value)) for name, value in changed_parameters]
+
+def run_session_local_query(query, session) :
+    """! Answer a local query (see pg_local) from the session parameters
+    @return (local query result, ParameterStatus messages of the reported parameters it changed)
+    """
+    result = run_local_query(query, session[SESSION__PARAMETERS], session[SESSION__STARTUP_PARAMETERS])
+    set_session_parameters(session, session[SESSION__PARAMETERS])
+    return result, parameter_status_msgs(result[LOCAL_QUERY__CHANGED_PARAMETERS])
+
+def startup_transition(parsed_msgs, output_msg, backend_db_con, session) :
     logging.info("Entering startup_transition")
 
     res = {}
@@ -78,8 +194,13 @@ def startup_transition(parsed_msgs, output_msg, backend_db_con) :
     # "munch" the input parsed_msgs
     res[STATE_MACHINE__PARSED_MSGS] = parsed_msgs[1:]
 
+    # New session - Forget prepared statements and portals of a previous session
+    close_session(session)
+    session[SESSION__STARTUP_PARAMETERS] = input_msg.get(STARTUP_MSG__PARAMETERS, {})
+    set_session_parameters(session, create_session_parameters(session[SESSION__STARTUP_PARAMETERS]))
+
     # Serialize Response
-    res[STATE_MACHINE__OUTPUT_MSG] = R_Msg_AuthRequest_Serialize()
+    res[STATE_MACHINE__OUTPUT_MSG] = [R_Msg_AuthRequest_Serialize()]
 
     # Send response immediately
     res[STATE_MACHINE__IS_TX_MSG] = True
@@ -89,7 +210,7 @@ def startup_transition(parsed_msgs, output_msg, backend_db_con) :
 
     return res
 
-def password_state_transition(parsed_msgs, output_msg, backend_db_con) :
+def password_state_transition(parsed_msgs, output_msg, backend_db_con, session) :
     res = {}
 
     assert len(parsed_msgs) > 0, "Receied an empty input parsed messages"
@@ -117,7 +238,7 @@ def password_state_transition(parsed_msgs, output_msg, backend_db_con) :
 
     return res
 
-def init_param_state_transition(parsed_msgs, output_msg, backend_db_con) :
+def init_param_state_transition(parsed_msgs, output_msg, backend_db_con, session) :
     """! Builds parameter status message during intialization phase.
          Does not take into account the password (the msg parameter)
     @param msg password 
@@ -134,19 +255,16 @@ def init_param_state_transition(parsed_msgs, output_msg, backend_db_con) :
     # Serialize Response    
     output_msg = R_Msg_AuthOk_Serialize()
 
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('client_encoding'), str.encode('UTF8'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('DateStyle'), str.encode('ISO, MDY'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('integer_datetimes'), str.encode('on'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('IntervalStyle'), str.encode('postgres'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('is_superuser'), str.encode('on'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('server_encoding'), str.encode('UTF8'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('server_version'), str.encode('12.7'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('session_authorization'), str.encode('postgres'))
-    output_msg += S_Msg_ParameterStatus_Serialize (str.encode('standard_conforming_strings'), str.encode('on'))
+    for param_name, param_value in STARTUP_PARAMETER_STATUS :
+        output_msg += S_Msg_ParameterStatus_Serialize (str.encode(param_name), str.encode(param_value))
+
+    # Cancel key, for the client CancelRequests
+    if session[SESSION__CANCEL_KEY] is not None :
+        output_msg += K_Msg_BackendKeyData_Serialize(*session[SESSION__CANCEL_KEY])
 
     output_msg += Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)
 
-    res[STATE_MACHINE__OUTPUT_MSG] = output_msg
+    res[STATE_MACHINE__OUTPUT_MSG] = [output_msg]
     res[STATE_MACHINE__IS_TX_MSG] = True
 
     # Next state
@@ -154,7 +272,10 @@ def init_param_state_transition(parsed_msgs, output_msg, backend_db_con) :
 
     return res
 
-def query_state_transition(parsed_msgs, output_msg, backend_db_con) :
+# Extended query protocol messages, handled by the parse query state
+EXTENDED_QUERY_MSG_IDS = (PARSE_MSG_ID, BIND_MSG_ID, DESCRIBE_MSG_ID, EXECUTE_MSG_ID, CLOSE_MSG_ID, FLUSH_MSG_ID)
+
+def query_state_transition(parsed_msgs, output_msg, backend_db_con, session) :
     """! In-between state, to decide if this is a simple or parse message.
     @param msg password string
 
@@ -174,7 +295,7 @@ def query_state_transition(parsed_msgs, output_msg, backend_db_con) :
     # Update logic
     if input_msg[MSG_ID] == QUERY_MSG_ID :        
         res[STATE_MACHINE__NEW_STATE] = SIMPLE_QUERY_STATE 
-    elif input_msg[MSG_ID] == PARSE_MSG_ID :
+    elif input_msg[MSG_ID] in EXTENDED_QUERY_MSG_IDS :
         res[STATE_MACHINE__NEW_STATE] = PARSE_QUERY_STATE
     elif input_msg[MSG_ID] == SYNC_MSG_ID :
         res[STATE_MACHINE__NEW_STATE] = QUERY_STATE
@@ -182,9 +303,10 @@ def query_state_transition(parsed_msgs, output_msg, backend_db_con) :
         input_msg = parsed_msgs[0]
         parsed_msgs = parsed_msgs[1:]
         res[STATE_MACHINE__PARSED_MSGS] = parsed_msgs
-        output_msg += Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)
+        output_msg = output_msg + [Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)]
+        session[SESSION__IS_SKIP_TO_SYNC] = False
+        # Pipelined messages may follow the Sync - The response is transmitted together with theirs
         is_tx_msg = True
-        assert len(parsed_msgs) == 0, "Error - Receied additional message after the Sync message"
     else :
         raise ValueError('Received unknown message ID : ', input_msg[MSG_ID])
 
@@ -193,7 +315,7 @@ def query_state_transition(parsed_msgs, output_msg, backend_db_con) :
 
     return res 
 
-def simple_query_state_transition(parsed_msgs, output_msg, backend_db_con) :
+def simple_query_state_transition(parsed_msgs, output_msg, backend_db_con, session) :
     """! Performs simple query. Use case : Activated from the psql client
     @param msg password string
 
@@ -211,44 +333,509 @@ def simple_query_state_transition(parsed_msgs, output_msg, backend_db_con) :
     
     query = input_msg[QUERY_MSG__SIMPLE_QUERY]
 
-    is_DISCARD_ALL_msg = True if query == PG_DISCARD_ALL_QUERY else False
+    # A simple Query message destroys the unnamed prepared statement and portal
+    session[SESSION__PREPARED_STATEMENTS].pop(UNNAMED, None)
+    drop_portal(UNNAMED, session)
+
+    # A Query may hold several statements - They are run in order, and answered with a single ReadyForQuery
+    statements = split_query_statements(query.decode('utf-8'))
+    if len(statements) <= 1 :
+        statements = [query.decode('utf-8')]
+    msgs, stream = run_simple_statements(statements, backend_db_con, session)
+
+    # Ready for query - After the streamed rows, if the result is streamed
+    ready_for_query_msg = Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)
+    if stream is None :
+        msgs.append(ready_for_query_msg)
+    else :
+        stream = append_to_stream(stream, ready_for_query_msg)
+
+    res[STATE_MACHINE__IS_TX_MSG] = True
+    res[STATE_MACHINE__OUTPUT_MSG] = output_msg + msgs
+    res[STATE_MACHINE__OUTPUT_STREAM] = stream
+    # Next state - Query state, be prepared for the next query
+    res[STATE_MACHINE__NEW_STATE] = QUERY_STATE
+    return res
+
+def run_simple_statements(statements, backend_db_con, session) :
+    """! Run the statements of a simple Query in order, on the session backend connection - A failed statement ends
+         the Query, the following statements are not run (as in Postgres)
+    @param statements list of statement strings (see split_query_statements)
+
+    @return (list of packed bytes of the responses, None), or once a statement result is streamed :
+            (list of packed bytes of the responses so far, stream of the next batches - The rest of the streamed result,
+             followed by the responses of the next statements)
+    """
+    msgs = []
+    for index, statement in enumerate(statements) :
+        statement_msgs, stream, is_failed = run_simple_statement(statement, backend_db_con, session)
+        msgs += statement_msgs
+        if is_failed :
+            break
+        if stream is not None :
+            return msgs, stream_simple_statements(stream, statements[index + 1:], backend_db_con, session)
+    return msgs, None
+
+def stream_simple_statements(stream, statements, backend_db_con, session) :
+    """! A streamed statement result, followed by the responses of the next statements of its Query - They are run 
+         once the result was streamed, as the backend connection runs a single query at a time
+    @return generator of packed bytes
+    """
+    try :
+        yield from stream
+    except Exception as e :
+        error = get_statement_error(e)
+        logging.error("stream_simple_statements : {}".format(error.message))
+        session[SESSION__IS_SKIP_TO_SYNC] = False
+        yield E_Msg_ErrorResponse_Serialize(error.sqlstate, error.message)
+        return
+
+    msgs, stream = run_simple_statements(statements, backend_db_con, session)
+    yield from msgs
+    if stream is not None :
+        yield from stream
+
+def get_statement_error(e) :
+    """! The PG_Error of a failed backend statement - Backend errors (e.g. a SQL error of the SQream server) and 
+         result columns the proxy can not serialize are internal errors
+    """
+    if isinstance(e, PG_Error) :
+        return e
+    return PG_Error(SQLSTATE_INTERNAL_ERROR, str(e))
+
+def run_simple_statement(query, backend_db_con, session) :
+    """! Run a single statement of a simple Query - Its response, without ReadyForQuery
+    @param query Statement string
 
-    if is_DISCARD_ALL_msg :
-        # Do nothing for 'DISCAR ALL' query
+    @return (list of packed bytes, stream of the next batches or None (see fetch_query_batches), True if it failed)
+    """
+    # The statement of a single statement Query is null terminated, as received
+    statement = query.rstrip(NULL_TERMINATOR.decode('utf-8'))
+    is_DISCARD_ALL_msg = True if statement == PG_DISCARD_ALL_STRING else False
+    is_profiler_msg    = is_profiler_admin_query(statement)
+    is_copy_msg        = is_copy_query(query)
+    is_local_msg       = is_local_query(query)
+
+    msgs = []
+    stream = None
+    is_failed = False
+
+    if is_copy_msg :
+        # Bulk extract - COPY ... TO STDOUT
+        try :
+            msgs, stream = copy_out(statement, backend_db_con)
+        except PG_Error as e :
+            msgs = [E_Msg_ErrorResponse_Serialize(e.sqlstate, e.message)]
+            is_failed = True
+    elif is_profiler_msg :
+        # Admin query - Arm / disarm the on-demand profiler, without querying the backend
+        try :
+            command_tag = run_profiler_admin_query(statement)
+            msgs = [C_Msg_CommandComplete_Serialize(command_tag)]
+        except PG_Error as e :
+            logging.error("run_simple_statement : {}".format(e.message))
+            msgs = [E_Msg_ErrorResponse_Serialize(e.sqlstate, e.message)]
+            is_failed = True
+    elif is_DISCARD_ALL_msg :
+        # Reset the session, keeping its startup parameters - Its backend connection can be parked meanwhile
+        startup_parameters = session[SESSION__STARTUP_PARAMETERS]
+        parameters = session[SESSION__PARAMETERS]
+        close_session(session)
+        session[SESSION__STARTUP_PARAMETERS] = startup_parameters
+        changed_parameters = reset_parameters(parameters, startup_parameters)
+        set_session_parameters(session, parameters)
+        session[SESSION__IS_DISCARDED] = True
         msg =  S_Msg_ParameterStatus_Serialize (str.encode('is_superuser'), str.encode('on'))
         msg += S_Msg_ParameterStatus_Serialize (str.encode('session_authorization'), str.encode('postgres'))
+        msg += b"".join(parameter_status_msgs(changed_parameters))
         msg += C_Msg_CommandComplete_Serialize(PG_DISCARD_ALL_STRING) 
-        msg += Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)
+        msgs = [msg]
+    elif is_local_msg :
+        # Session setting or trivial query, answered by the proxy without a backend round trip (see pg_local)
+        try :
+            result, status_msgs = run_session_local_query(statement, session)
+            cols_desc = result[LOCAL_QUERY__COLS_DESC]
+            rows      = result[LOCAL_QUERY__ROWS]
+            if len(cols_desc) > 0 :
+                msgs.append(T_Msg_RowDescription_Serialize(cols_desc))
+                if len(rows) > 0 :
+                    msgs.append(D_Msg_DataCols_Serialize(cols_desc, rows_to_cols(rows)))
+            msgs.append(C_Msg_CommandComplete_Serialize(result[LOCAL_QUERY__COMMAND_TAG] or 'SELECT ' + str(len(rows))))
+            msgs += status_msgs
+        except PG_Error as e :
+            logging.error("run_simple_statement : {}".format(e.message))
+            msgs = [E_Msg_ErrorResponse_Serialize(e.sqlstate, e.message)]
+            is_failed = True
     else :  # Regular Query
+        try :
+            # Query backend database
+            query_output = open_query(backend_db_con, query)
+            try :
+                cols_desc = prepare_cols_desc(query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NAME],
+                                              query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_TYPE],
+                                              query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_LENGTH],
+                                              query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_FORMAT],
+                                              query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NULLABLE])
+            except Exception :
+                close_query(query_output[BACKEND_QUERY__CURSOR])
+                raise
+
+            # Serialize Response
+            msgs = [T_Msg_RowDescription_Serialize(cols_desc)]
+
+            first_batch_msgs, stream = fetch_query_batches(query_output[BACKEND_QUERY__CURSOR], 
+                                                           lambda cols : D_Msg_DataCols_Serialize(cols_desc, cols),
+                                                           lambda num_of_lines : C_Msg_CommandComplete_Serialize('SELECT ' + str(num_of_lines)),
+                                                           cols_desc)
+            msgs += first_batch_msgs
+        except Exception as e :
+            # The cursor of a failed query was closed (see open_query / fetch_query_batches)
+            error = get_statement_error(e)
+            logging.error("run_simple_statement : {}".format(error.message))
+            msgs.append(E_Msg_ErrorResponse_Serialize(error.sqlstate, error.message))
+            is_failed = True
+
+    return msgs, stream, is_failed
+
+def prepare_statement(parse_msg, session) :
+    """! Create a prepared statement from a Parse message, and store it in the session.
+         Re-parsing the same query under the same name keeps the existing statement, and its cached description.
+    @param parse_msg Parsed Parse message
+    @param session   Session state
+    """
+    name  = parse_msg[PARSE_MSG__STATEMENT]
+    query = parse_msg[PARSE_MSG__QUERY]
+
+    statement = session[SESSION__PREPARED_STATEMENTS].get(name)
+    if statement is not None and statement[STATEMENT__QUERY] == query :
+        logging.info("prepare_statement : Reusing prepared statement {}".format(name))
+        return
+
+    is_catalog_query = is_pg_catalog_msg(query)
+    is_local = False
+    backend_query = None
+    if not is_catalog_query :
+        backend_query = query.rstrip(NULL_TERMINATOR).decode("utf-8")
+        logging.info ("Recieved query :\n" + (backend_query))
+        is_local = is_local_query(backend_query)
+        if not is_local :
+            # Substitue variables to actual parameters in the SQL query
+            backend_query = remove_table_varable_from_query(backend_query)
+
+    session[SESSION__PREPARED_STATEMENTS][name] = {STATEMENT__QUERY         : query,
+                                                   STATEMENT__IS_CATALOG    : is_catalog_query,
+                                                   STATEMENT__IS_LOCAL      : is_local,
+                                                   STATEMENT__BACKEND_QUERY : backend_query,
+                                                   STATEMENT__PARAM_TYPES   : parse_msg[PARSE_MSG__PARAMETER_TYPES],
+                                                   STATEMENT__COLS_DESC     : None,
+                                                   STATEMENT__ROW_DESC_MSGS : {}}
+
+def get_statement(name, session) :
+    statement = session[SESSION__PREPARED_STATEMENTS].get(name)
+    if statement is None :
+        raise PG_Error(SQLSTATE_INVALID_STATEMENT_NAME, 
+                       "prepared statement \"{}\" does not exist".format(name.rstrip(NULL_TERMINATOR).decode("utf-8")))
+    return statement
+
+def get_portal(name, session) :
+    portal = session[SESSION__PORTALS].get(name)
+    if portal is None :
+        raise PG_Error(SQLSTATE_INVALID_CURSOR_NAME, 
+                       "portal \"{}\" does not exist".format(name.rstrip(NULL_TERMINATOR).decode("utf-8")))
+    return portal
+
+def run_portal_query(portal, backend_db_con) :
+    """! Run the portal query (on the backend, or on the proxy for catalog queries), 
+         and cache the columns description on its prepared statement.
+         Backend rows are left on the cursor, to be fetched by the Execute messages.
+    """
+    statement = portal[PORTAL__STATEMENT]
+
+    if statement[STATEMENT__IS_CATALOG] :
+        cols_desc = statement[STATEMENT__COLS_DESC] or prepare_pg_catalog_cols_desc(statement[STATEMENT__QUERY])
+        portal[PORTAL__COLS_VALUES] = prepare_pg_catalog_cols_value(backend_db_con, statement[STATEMENT__QUERY])
+    else :
         # Query backend database
-        query_output = execute_query(backend_db_con, query.decode('utf-8'))
+        query_output = open_query(backend_db_con, statement[STATEMENT__BACKEND_QUERY])
         cols_desc   = prepare_cols_desc(query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NAME],
                                         query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_TYPE],
                                         query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_LENGTH],
-                                        query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_FORMAT])
-        cols_values = query_output[BACKEND_QUERY__RESULT]
+                                        query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_FORMAT],
+                                        query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NULLABLE])
+        portal[PORTAL__CURSOR] = query_output[BACKEND_QUERY__CURSOR]
 
-        # Serialize Response
-        msg = T_Msg_RowDescription_Serialize(cols_desc) 
+    statement[STATEMENT__COLS_DESC] = cols_desc
+    set_portal_cols_desc(portal, cols_desc)
+    portal[PORTAL__IS_RUN] = True
 
-        for col_values in cols_values :
-            msg += D_Msg_DataRow_Serialize(cols_desc, col_values) 
+def run_local_portal_query(portal, session) :
+    """! Run the query of a local portal (see pg_local) - Its rows are sent by execute_portal, as for catalog queries
+    @return ParameterStatus messages of the reported parameters it changed
+    """
+    statement = portal[PORTAL__STATEMENT]
+    result, status_msgs = run_session_local_query(statement[STATEMENT__BACKEND_QUERY], session)
+    statement[STATEMENT__COLS_DESC] = result[LOCAL_QUERY__COLS_DESC]
+    set_portal_cols_desc(portal, result[LOCAL_QUERY__COLS_DESC])
+    portal[PORTAL__COLS_VALUES] = result[LOCAL_QUERY__ROWS]
+    portal[PORTAL__COMMAND_TAG] = result[LOCAL_QUERY__COMMAND_TAG]
+    portal[PORTAL__IS_RUN] = True
+    return status_msgs
+
+def set_portal_cols_desc(portal, cols_desc) :
+    """! Set the portal columns description, with the result-column formats the client asked for in Bind
+    """
+    try :
+        portal[PORTAL__COLS_DESC] = apply_result_formats(cols_desc, portal[PORTAL__RESULT_FORMATS])
+    except ValueError as e :
+        raise PG_Error(SQLSTATE_PROTOCOL_VIOLATION, str(e))
 
-        num_of_lines = len(cols_values)
+def fetch_portal_cols(portal, max_rows) :
+    """! Fetch the next rows of a portal
+    @param max_rows Maximum number of rows to fetch, FETCH_ALL_ROWS for all the remaining rows
 
-        msg += C_Msg_CommandComplete_Serialize('SELECT ' + str(num_of_lines)) 
+    @return list of column batches (see fetch_cols)
+    """
+    if portal[PORTAL__IS_DONE] :
+        return []
 
-        msg += Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)
+    if portal[PORTAL__CURSOR] is not None :
+        return fetch_cols(portal[PORTAL__CURSOR], max_rows)
 
+    cols_values = portal[PORTAL__COLS_VALUES] or []
+    if max_rows == FETCH_ALL_ROWS :
+        max_rows = len(cols_values)
+    portal[PORTAL__COLS_VALUES] = cols_values[max_rows:]
+    return rows_to_cols(cols_values[:max_rows])
 
-    res[STATE_MACHINE__IS_TX_MSG] = True
-    res[STATE_MACHINE__OUTPUT_MSG] = output_msg + msg
-    # Next state - Query state, be prepared for the next query
-    res[STATE_MACHINE__NEW_STATE] = QUERY_STATE
-    return res
+def get_portal_fetch_size(max_rows, num_of_lines, batch_sizer) :
+    """! Number of rows to fetch in the next batch of an Execute, limited by the rows left to its max_rows
+    """
+    return batch_sizer.fetch_rows if max_rows == FETCH_ALL_ROWS else min(batch_sizer.fetch_rows, max_rows - num_of_lines)
+
+def fetch_batch(fetch, encoder, num_of_rows) :
+    """! Fetch a batch of rows, and encode it
+    @param fetch   function (number of rows) -> column batches
+    @param encoder BatchEncoder / ParallelBatchEncoder - Tunes the next batch size by the encoded batch
+
+    @return (number of rows fetched, list of the encoded batches ready to be sent)
+    """
+    fetch_start = time.perf_counter()
+    cols = fetch(num_of_rows)
+    fetch_seconds = time.perf_counter() - fetch_start
+
+    num_of_batch_lines = get_num_of_col_rows(cols)
+    return num_of_batch_lines, encoder.encode(cols, num_of_batch_lines, fetch_seconds)
+
+def complete_portal_execute(portal, max_rows, num_of_lines) :
+    """! End of an Execute response - PortalSuspended if max_rows were sent (the next Execute continues from there),
+         otherwise the portal is closed, with CommandComplete
+    """
+    if max_rows != FETCH_ALL_ROWS and num_of_lines == max_rows :
+        # Keep the cursor open for the next Execute
+        return s_Msg_PortalSuspended_Serialize()
+
+    close_portal(portal)
 
-def parse_query_state_transition(parsed_msgs, output_msg, backend_db_con) :
-    """! Performs parse query.
+    #  ***  Prepare command complete message
+    return C_Msg_CommandComplete_Serialize(portal[PORTAL__COMMAND_TAG] or 'SELECT ' + str(num_of_lines))
+
+def execute_portal(portal, max_rows, backend_db_con) :
+    """! Execute a portal : DataRows, followed by CommandComplete,
+         or by PortalSuspended if max_rows were sent (the next Execute continues from there)
+    @param max_rows Execute message row limit, 0 for no limit
+
+    @return (list of packed bytes of the Execute response, None), or for results larger than a batch :
+            (list of packed bytes of the first batch, stream of the next batches - see stream_portal_batches)
+    """
+    if not portal[PORTAL__IS_RUN] :
+        run_portal_query(portal, backend_db_con)
+
+    batch_sizer = BatchSizer()
+    fetch_size = get_portal_fetch_size(max_rows, 0, batch_sizer)
+    try :
+        num_of_lines, msgs = fetch_batch(lambda num_of_rows : fetch_portal_cols(portal, num_of_rows),
+                                         BatchEncoder(lambda cols : D_Msg_DataCols_Serialize(portal[PORTAL__COLS_DESC], cols), batch_sizer),
+                                         fetch_size)
+    except PG_Error :
+        # e.g. Canceled - The portal can not be resumed
+        close_portal(portal)
+        raise
+
+    if num_of_lines < fetch_size or num_of_lines == max_rows :
+        return msgs + [complete_portal_execute(portal, max_rows, num_of_lines)], None
+
+    return msgs, stream_portal_batches(portal, max_rows, num_of_lines, batch_sizer)
+
+def stream_portal_batches(portal, max_rows, num_of_lines, batch_sizer) :
+    """! The next batches of an Execute response, the last one followed by CommandComplete / PortalSuspended
+    @param num_of_lines Number of rows already sent
+
+    @return generator of packed bytes
+    """
+    encoder = create_batch_encoder(lambda cols : D_Msg_DataCols_Serialize(portal[PORTAL__COLS_DESC], cols), batch_sizer,
+                                   portal[PORTAL__COLS_DESC])
+    try :
+        while True :
+            fetch_size = get_portal_fetch_size(max_rows, num_of_lines, batch_sizer)
+            num_of_batch_lines, msgs = fetch_batch(lambda num_of_rows : fetch_portal_cols(portal, num_of_rows), encoder, fetch_size)
+            num_of_lines += num_of_batch_lines
+
+            yield from yield_batches(msgs)
+            if num_of_batch_lines < fetch_size or num_of_lines == max_rows :
+                yield from yield_batches(encoder.flush())
+                break
+    except PG_Error :
+        close_portal(portal)
+        raise
+    finally :
+        encoder.close()
+
+    yield complete_portal_execute(portal, max_rows, num_of_lines)
+
+def end_stream_on_error(batches, session, is_skip_to_sync = False) :
+    """! A response stream ending with an ErrorResponse if its query fails (e.g. it was canceled) - The batches sent 
+         so far are followed by the error, instead of ending the session
+    @param is_skip_to_sync True for an extended query protocol response - Messages are then discarded until the next Sync
+
+    @return generator of packed bytes
+    """
+    try :
+        yield from batches
+    except PG_Error as e :
+        logging.error("end_stream_on_error : {}".format(e.message))
+        session[SESSION__IS_SKIP_TO_SYNC] = is_skip_to_sync
+        yield E_Msg_ErrorResponse_Serialize(e.sqlstate, e.message)
+
+def fetch_query_batches(cursor, encode_cols, complete, data_rows_cols_desc = None) :
+    """! Fetch and encode the first batch of rows of an open backend query.
+         Results larger than a batch leave the rest of their rows to a stream.
+    @param cursor      open backend query cursor, closed when all rows were fetched
+    @param encode_cols function (column batches) -> packed bytes
+    @param complete    function (number of rows) -> packed bytes following the last batch
+    @param data_rows_cols_desc Columns description, if encode_cols packs DataRows - Their stream may be encoded 
+                               in parallel (see pg_parallel)
+
+    @return (list of packed bytes of the whole response, None), or
+            (list of packed bytes of the first batch, stream of the next batches - see stream_query_batches)
+    """
+    batch_sizer = BatchSizer()
+    fetch_size = batch_sizer.fetch_rows
+    try :
+        num_of_lines, msgs = fetch_batch(lambda num_of_rows : fetch_cols(cursor, num_of_rows), BatchEncoder(encode_cols, batch_sizer), fetch_size)
+    except Exception :
+        close_query(cursor)
+        raise
+
+    if num_of_lines < fetch_size :
+        close_query(cursor)
+        return msgs + [complete(num_of_lines)], None
+
+    return msgs, stream_query_batches(cursor, create_batch_encoder(encode_cols, batch_sizer, data_rows_cols_desc), 
+                                      complete, num_of_lines, batch_sizer)
+
+def stream_query_batches(cursor, encoder, complete, num_of_lines, batch_sizer) :
+    """! The next batches of rows of an open backend query, the last one followed by complete(number of rows)
+    @param encoder      BatchEncoder / ParallelBatchEncoder of the batches
+    @param num_of_lines Number of rows already sent
+
+    @return generator of packed bytes
+    """
+    try :
+        while True :
+            fetch_size = batch_sizer.fetch_rows
+            num_of_batch_lines, msgs = fetch_batch(lambda num_of_rows : fetch_cols(cursor, num_of_rows), encoder, fetch_size)
+            num_of_lines += num_of_batch_lines
+            yield from yield_batches(msgs)
+            if num_of_batch_lines < fetch_size :
+                yield from yield_batches(encoder.flush())
+                break
+    finally :
+        encoder.close()
+        close_query(cursor)
+
+    yield complete(num_of_lines)
+
+def copy_out(query, backend_db_con) :
+    """! Perform a COPY TO STDOUT : CopyOutResponse, a CopyData per batch of backend rows, CopyDone and CommandComplete
+    @param query COPY statement string
+
+    @return (list of packed bytes of the COPY response, None), or for results larger than a batch :
+            (list of packed bytes of the response start, stream of the next batches)
+    """
+    try :
+        copy = parse_copy_query(query)
+    except ValueError as e :
+        raise PG_Error(SQLSTATE_FEATURE_NOT_SUPPORTED, str(e))
+
+    query_output = open_query(backend_db_con, copy[COPY__QUERY])
+    cols_desc   = prepare_cols_desc(query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NAME],
+                                    query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_TYPE],
+                                    query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_LENGTH],
+                                    query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_FORMAT],
+                                    query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NULLABLE])
+
+    msg = H_Msg_CopyOutResponse_Serialize(get_copy_cols_format(copy), len(cols_desc))
+    header = copy_data_header(copy, cols_desc)
+    if len(header) > 0 :
+        msg += d_Msg_CopyData_Serialize(header)
+
+    def complete_copy(num_of_lines) :
+        trailer = copy_data_trailer(copy)
+        msg = d_Msg_CopyData_Serialize(trailer) if len(trailer) > 0 else bytes('', "utf-8")
+        msg += c_Msg_CopyDone_Serialize()
+        return msg + C_Msg_CommandComplete_Serialize('COPY ' + str(num_of_lines))
+
+    first_batch_msgs, stream = fetch_query_batches(query_output[BACKEND_QUERY__CURSOR],
+                                                   lambda cols : d_Msg_CopyData_Serialize(copy_data_cols(copy, cols_desc, cols)),
+                                                   complete_copy)
+    return [msg] + first_batch_msgs, stream
+
+def get_portal_row_description(portal, backend_db_con) :
+    """! Get the RowDescription of a portal. 
+         Served from the prepared statement cache when possible, otherwise the portal query is run to learn it.
+    @return packed bytes of RowDescription, or NoData if the portal returns no rows
+    """
+    statement = portal[PORTAL__STATEMENT]
+
+    if statement[STATEMENT__COLS_DESC] is None :
+        if statement[STATEMENT__IS_CATALOG] :
+            statement[STATEMENT__COLS_DESC] = prepare_pg_catalog_cols_desc(statement[STATEMENT__QUERY])
+        elif statement[STATEMENT__IS_LOCAL] :
+            statement[STATEMENT__COLS_DESC] = describe_local_query(statement[STATEMENT__BACKEND_QUERY])
+        else :
+            run_portal_query(portal, backend_db_con)
+    if portal[PORTAL__COLS_DESC] is None :
+        set_portal_cols_desc(portal, statement[STATEMENT__COLS_DESC])
+
+    cols_desc = portal[PORTAL__COLS_DESC]
+    cols_format = tuple(col_desc[COL_DESC__FORMAT] for col_desc in cols_desc)
+    row_desc_msg = statement[STATEMENT__ROW_DESC_MSGS].get(cols_format)
+    if row_desc_msg is None :
+        row_desc_msg = T_Msg_RowDescription_Serialize(cols_desc) if len(cols_desc) > 0 else n_Msg_NoData_Serialize()
+        statement[STATEMENT__ROW_DESC_MSGS][cols_format] = row_desc_msg
+
+    return row_desc_msg
+
+def get_statement_description(statement, backend_db_con) :
+    """! Describe a prepared statement - ParameterDescription followed by RowDescription (or NoData)
+    """
+    # Unspecified parameters types are described as text
+    param_types = [param_type if param_type != 0 else COL_TEXT_TYPE_3_OID for param_type in statement[STATEMENT__PARAM_TYPES]]
+    msg = t_Msg_ParameterDescription_Serialize(param_types)
+
+    # In a RowDescription of a statement, the format code is not yet known and is always zero (text) - 
+    # This is the description of a portal without result formats
+    portal = create_portal(statement)
+    msg += get_portal_row_description(portal, backend_db_con)
+    close_portal(portal)
+
+    return msg
+
+def parse_query_state_transition(parsed_msgs, output_msg, backend_db_con, session) :
+    """! Performs extended query protocol messages : Parse, Bind, Describe, Execute, Close and Flush.
+         Processes the messages up to the next Sync (or simple Query), which is left to the query state.
+         Prepared statements and portals are kept in the session, so a statement can be parsed once,
+         and bound / executed many times.
     @param 
 
     @return
@@ -258,76 +845,86 @@ def parse_query_state_transition(parsed_msgs, output_msg, backend_db_con) :
 
     # Initialization
     res = {}
-    msg = bytes('', "utf-8")
+    msgs = []
     is_tx_msg = False
+    stream = None
 
-    # *** Munch Parse message from input, output parse complete message (input 'P', output '1')
     assert len(parsed_msgs) > 0, "Receied an empty input parsed messages"
-    input_msg = parsed_msgs[0]
-    parsed_msgs = parsed_msgs[1:]
-    assert (input_msg[MSG_ID] == PARSE_MSG_ID), f"Received a wrong message ID {input_msg[MSG_ID]}"
-
-    # Get query stinrg
-    query = input_msg[PARSE_MSG__QUERY]
-    is_catalog_query = is_pg_catalog_msg(query)
-    
-    msg += One_Msg_ParseComplete_Serialize()
-    
-    # ***  Munch Bind message from input, output bind complete message (input 'B', output '2') 
-    assert len(parsed_msgs) > 0, "Receied an empty input parsed messages"
-    input_msg = parsed_msgs[0]
-    parsed_msgs = parsed_msgs[1:]
-    assert (input_msg[MSG_ID] == BIND_MSG_ID), f"Received a wrong message ID {input_msg[MSG_ID]}"
-    msg += Two_Msg_BindComplete_Serialize()
-
-    # ***  Munch Describe message from input, output row description message (input 'D', output 'T') 
-    assert len(parsed_msgs) > 0, "Receied an empty input parsed messages"
-    input_msg = parsed_msgs[0]
-    parsed_msgs = parsed_msgs[1:]
-    assert (input_msg[MSG_ID] == DESCRIBE_MSG_ID), f"Received a wrong message ID {input_msg[MSG_ID]}"
-
-    cols_desc = {}
-    if is_catalog_query:        
-        # logging.info ("Got initial PBI type query\n")         
-        cols_desc   = prepare_pg_catalog_cols_desc(query)
-        cols_values = prepare_pg_catalog_cols_value(backend_db_con, query)
-    else : 
-        # Regular query
-        query = query.decode("utf-8")
-        logging.info ("Recieved query :\n" + (query))
-        # Substitue variables to actual parameters in the SQL query
-        query = remove_table_varable_from_query(query)
-        # Query backend database
-        query_output = execute_query(backend_db_con, query)
-        cols_desc   = prepare_cols_desc(query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_NAME],
-                                        query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_TYPE],
-                                        query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_LENGTH],
-                                        query_output[BACKEND_QUERY__DESCRIPTION][BACKEND_QUERY__DESC_COLS_FORMAT])
-        cols_values  = query_output[BACKEND_QUERY__RESULT]
-
-    msg += T_Msg_RowDescription_Serialize(cols_desc)
-
-    # ***  Munch Execution message from input, output Data messages (input 'E', output: a lot of 'D's) 
-    assert len(parsed_msgs) > 0, "Receied an empty input parsed messages"
-    input_msg = parsed_msgs[0]
-    parsed_msgs = parsed_msgs[1:]
-    assert (input_msg[MSG_ID] == EXECUTE_MSG_ID), f"Received a wrong message ID {input_msg[MSG_ID]}"
 
-    for col_values in cols_values :
-        msg += D_Msg_DataRow_Serialize(cols_desc, col_values) 
-
-    #  ***  Prepare command complete message
-    num_of_lines = len(cols_values)
-    msg += C_Msg_CommandComplete_Serialize('SELECT ' + str(num_of_lines)) 
-
-    # *** Prepare ready for query message, if finished munching the input message
-    if len(parsed_msgs) == 0 :
-        msg += Z_Msg_ReadyForQuery_Serialize(READY_FOR_QUERY_SERVER_STATUS_IDLE)
+    while len(parsed_msgs) > 0 and parsed_msgs[0][MSG_ID] in EXTENDED_QUERY_MSG_IDS :
+        input_msg = parsed_msgs[0]
+        parsed_msgs = parsed_msgs[1:]
+        msg_id = input_msg[MSG_ID]
+
+        # After an error, messages are discarded until the next Sync (which may arrive in a later packet)
+        if session[SESSION__IS_SKIP_TO_SYNC] :
+            continue
+
+        try :
+            if msg_id == PARSE_MSG_ID :
+                # *** Parse message : input 'P', output parse complete message '1'
+                prepare_statement(input_msg, session)
+                msgs.append(One_Msg_ParseComplete_Serialize())
+
+            elif msg_id == BIND_MSG_ID :
+                # *** Bind message : input 'B', output bind complete message '2'
+                statement = get_statement(input_msg[BIND_MSG__STATEMENT], session)
+                drop_portal(input_msg[BIND_MSG__PORTAL], session)
+                session[SESSION__PORTALS][input_msg[BIND_MSG__PORTAL]] = create_portal(statement, input_msg[BIND_MSG__RESULT_FORMATS])
+                msgs.append(Two_Msg_BindComplete_Serialize())
+
+            elif msg_id == DESCRIBE_MSG_ID :
+                # *** Describe message : input 'D', output row description message 'T' (with 't' for a statement)
+                if input_msg[DESCRIBE_MSG__TYPE] == DESCRIBE_TYPE_STATEMENT :
+                    statement = get_statement(input_msg[DESCRIBE_MSG__PORTAL], session)
+                    msgs.append(get_statement_description(statement, backend_db_con))
+                else :
+                    portal = get_portal(input_msg[DESCRIBE_MSG__PORTAL], session)
+                    msgs.append(get_portal_row_description(portal, backend_db_con))
+
+            elif msg_id == EXECUTE_MSG_ID :
+                # *** Execute message : input 'E', output Data messages (a lot of 'D's) and command complete 'C' 
+                #     (or portal suspended 's' when the rows limit was reached)
+                portal = get_portal(input_msg[EXECUTE_MSG__PORTAL], session)
+                if portal[PORTAL__STATEMENT][STATEMENT__IS_LOCAL] and not portal[PORTAL__IS_RUN] :
+                    msgs += run_local_portal_query(portal, session)
+                first_batch_msgs, stream = execute_portal(portal, input_msg[EXECUTE_MSG__ROWS_TO_RETURN], backend_db_con)
+                msgs += first_batch_msgs
+                if stream is not None :
+                    # Large result - The next messages are processed after it was streamed
+                    stream = end_stream_on_error(stream, session, is_skip_to_sync = True)
+                    break
+
+            elif msg_id == CLOSE_MSG_ID :
+                # *** Close message : input 'C', output close complete message '3'
+                name = input_msg[CLOSE_MSG__NAME]
+                if input_msg[CLOSE_MSG__TYPE] == DESCRIBE_TYPE_STATEMENT :
+                    statement = session[SESSION__PREPARED_STATEMENTS].pop(name, None)
+                    # Closing a prepared statement implicitly closes its portals
+                    for portal_name, portal in list(session[SESSION__PORTALS].items()) :
+                        if portal[PORTAL__STATEMENT] is statement :
+                            drop_portal(portal_name, session)
+                else :
+                    drop_portal(name, session)
+                msgs.append(Three_Msg_CloseComplete_Serialize())
+
+            elif msg_id == FLUSH_MSG_ID :
+                # *** Flush message : Transmit everything prepared so far
+                break
+
+        except PG_Error as e :
+            logging.error("parse_query_state_transition : {}".format(e.message))
+            msgs.append(E_Msg_ErrorResponse_Serialize(e.sqlstate, e.message))
+            session[SESSION__IS_SKIP_TO_SYNC] = True
+
+    # Transmit on Flush, before streaming a large result, or when there is nothing left to munch (a Sync may arrive in a later packet)
+    if msg_id == FLUSH_MSG_ID or stream is not None or len(parsed_msgs) == 0 :
         is_tx_msg = True
         
     res[STATE_MACHINE__PARSED_MSGS] = parsed_msgs
-    res[STATE_MACHINE__OUTPUT_MSG]  = output_msg + msg
+    res[STATE_MACHINE__OUTPUT_MSG]  = output_msg + msgs
     res[STATE_MACHINE__IS_TX_MSG]   = is_tx_msg
+    res[STATE_MACHINE__OUTPUT_STREAM] = stream
 
     # Next state - Query state, be prepared for the next query
     res[STATE_MACHINE__NEW_STATE] = QUERY_STATE
@@ -343,8 +940,34 @@ CLUSTERED = False
 USERNAME = "sqream"
 PASSWORD = "sqream"
 
+def get_backend_db_key() :
+    """
+    Returns the key of the backend connections - The (host, port, database, username) they connect with.
+    The proxy logs in with its own credentials, whatever the user and database of the client Startup message
+    """
+    return (HOST, PORT, DATABASE, USERNAME)
+
+def connect_backend_db_key(key) :
+    """
+    Connects to the SQream server with the connection parameters of a key (see get_backend_db_key)
+    """
+    host, port, database, username = key
+    return get_db(host = host, port = port, 
+                  database = database, 
+                  username = username, password = PASSWORD)
+
+def get_backend_db_con() :
+    """
+    Connects to the SQream server (HOST / PORT)
+    """
+    return connect_backend_db_key(get_backend_db_key())
+
 # Put it all together
-def CreatePGStateMachine() :
+def CreatePGStateMachine(backend_db_con = None, is_connect = True) :
+    """
+    Input : backend_db_con - Backend database connection. None - Connect to the SQream server (HOST / PORT)
+            is_connect     - False : Do not connect, the backend connection is attached later (e.g. from a pool)
+    """
     pg_mimic = PG_StateMachine()
     pg_mimic.add_state(STARTUP_STATE, startup_transition)
     pg_mimic.add_state(PASSWORD_STATE, password_state_transition)
@@ -355,9 +978,10 @@ def CreatePGStateMachine() :
     pg_mimic.add_state(END_STATE, None, end_state=1)
     pg_mimic.set_start(STARTUP_STATE)
 
-    pg_mimic.backend_db_con = get_db(   host = HOST, port = PORT, 
-                                        database = DATABASE, 
-                                        username = USERNAME, password = PASSWORD)
+    if backend_db_con is None and is_connect :
+        backend_db_con = get_backend_db_con()
+    pg_mimic.backend_db_con = backend_db_con
+    pg_mimic.session = create_session_state()
 
     return pg_mimic
 
@@ -378,4 +1002,127 @@ def force_initial_state(sm) :
     Input : Receives a  PG_StateMachine()
     Output : N/A
     """
-    sm.new_state = STARTUP_STATE
\ No newline at end of file
+    sm.new_state = STARTUP_STATE
+    close_session(sm.session)
+
+def run_state_machine(sm, parsed_msgs, tx_func) :
+    """
+    Runs the state machine over the parsed client messages, transmitting its responses.
+    The parsed messages may hold several pipelined statement groups and Syncs. Responses are transmitted 
+    once all the received messages were processed, coalescing them into a single (scatter-gather) write.
+    Large results are streamed (see pg_stream) : The output prepared so far is transmitted, 
+    followed by the result batches, overlapping the backend fetch with the transmission.
+    Input : sm          - PG_StateMachine()
+            parsed_msgs - Parsed input messages
+            tx_func     - Called with each list of response buffers (packed bytes) to transmit.
+                          Pooled output buffers (see pg_buffers) are reused once it returns - It must not keep them
+    Output : N/A
+    """
+    # Initialize the result return object from the state machine 
+    res = {}
+    res[STATE_MACHINE__IS_TX_MSG]   = False
+    res[STATE_MACHINE__OUTPUT_MSG]  = []
+    res[STATE_MACHINE__PARSED_MSGS] = parsed_msgs
+
+    # As long as there are messages received from client that were not munched, 
+    # or the state transitions have nothing to transmit yet, keep running the state machine.
+    # A state transition with something to transmit (IS_TX_MSG) that is followed by more pipelined messages 
+    # keeps accumulating the output - The client reads it all after its last message
+    try :
+        while len(res[STATE_MACHINE__PARSED_MSGS]) > 0 or res[STATE_MACHINE__IS_TX_MSG] == False : 
+            res = sm.run(res[STATE_MACHINE__PARSED_MSGS], 
+                         res[STATE_MACHINE__OUTPUT_MSG])
+
+            if res.get(STATE_MACHINE__OUTPUT_STREAM) is not None :
+                output_msg, res[STATE_MACHINE__OUTPUT_MSG] = res[STATE_MACHINE__OUTPUT_MSG], []
+                if len(output_msg) > 0 :
+                    transmit_batches(output_msg, tx_func)
+                stream_response(res[STATE_MACHINE__OUTPUT_STREAM], tx_func)
+
+        # TX Response
+        output_msg, res[STATE_MACHINE__OUTPUT_MSG] = res[STATE_MACHINE__OUTPUT_MSG], []
+        if len(output_msg) > 0 :
+            transmit_batches(output_msg, tx_func)
+    finally :
+        # Failed before transmitting the output (e.g. a state transition raised) - Return its pooled buffers
+        release_output_buffers(res[STATE_MACHINE__OUTPUT_MSG])
+
+# *****************************************************
+# * Unit Testing
+# *****************************************************
+def PG_STATEMACHINE_UT() :
+    """
+    Simple Query statements - A failed backend statement is answered with an ErrorResponse, and ends the Query
+    """
+    import struct
+
+    class StubCursor:
+        def __init__(self, connection):
+            self.connection = connection
+            self.num_of_fetches = 0
+            self.is_closed = False
+
+        def execute(self, query):
+            self.connection.cursors.append(self)
+            if "missing" in query :
+                raise RuntimeError("Table missing not found")
+            self.col_type_tups = [(SQREAM_TYPE_INT, 4)]
+            self.description   = [("x",)]
+            self.col_nul       = [False]
+            self.rows          = [(1,)] * self.connection.num_of_rows
+
+        def fetchmany(self, size):
+            self.num_of_fetches += 1
+            if self.num_of_fetches > 1 and self.connection.is_fetch_failing :
+                raise RuntimeError("Connection lost")
+            rows, self.rows = self.rows[:size], self.rows[size:]
+            return rows
+
+        def close(self):
+            self.is_closed = True
+
+    class StubConnection:
+        def __init__(self, num_of_rows, is_fetch_failing = False):
+            self.num_of_rows = num_of_rows
+            self.is_fetch_failing = is_fetch_failing
+            self.cursors = []
+
+        def cursor(self):
+            return StubCursor(self)
+
+    def get_msgs(batches) :
+        """! (message ID, payload) of the messages of a response, consecutive DataRows as one
+        """
+        data = b"".join(batches)
+        release_output_buffers(batches)
+        msgs = []
+        while len(data) > 0 :
+            msg_len = struct.unpack("!i", data[1:5])[0]
+            if len(msgs) == 0 or data[0:1] != DATA_COLS_MSG_ID or msgs[-1][0] != DATA_COLS_MSG_ID :
+                msgs.append((data[0:1], data[5 : 1 + msg_len]))
+            data = data[1 + msg_len : ]
+        return msgs
+
+    # The second statement fails on the backend - The third one is not run
+    connection = StubConnection(num_of_rows = 1)
+    statements = ["select x from t", "select x from missing", "select x from t2"]
+    msgs, stream = run_simple_statements(statements, connection, create_session_state())
+    msgs = get_msgs(msgs)
+    assert stream is None and [msg_id for msg_id, payload in msgs] == [ROW_DESC_MSG_ID, DATA_COLS_MSG_ID, CMD_COMPLETE_MSG_ID, 
+                                                                        ERROR_RESPONSE_MSG_ID], msgs
+    assert (b"C" + SQLSTATE_INTERNAL_ERROR.encode("utf-8") + NULL_TERMINATOR) in msgs[-1][1], msgs[-1]
+    assert len(connection.cursors) == 2 and all(cursor.is_closed for cursor in connection.cursors), "Cursor left open"
+
+    # The streamed result of the first statement fails - Its stream ends with the error, the second one is not run
+    connection = StubConnection(num_of_rows = STREAM_INITIAL_FETCH_ROWS * 2, is_fetch_failing = True)
+    msgs, stream = run_simple_statements(["select x from t", "select x from t2"], connection, create_session_state())
+    assert stream is not None, "The result was not streamed"
+    msgs = get_msgs(msgs + list(stream))
+    assert [msg_id for msg_id, payload in msgs] == [ROW_DESC_MSG_ID, DATA_COLS_MSG_ID, ERROR_RESPONSE_MSG_ID], msgs
+    assert len(connection.cursors) == 1 and connection.cursors[0].is_closed, "Cursor left open"
+
+    print("PG_STATEMACHINE_UT Passed")
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.CRITICAL)
+    PG_STATEMACHINE_UT()
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+"""
+Streaming of large result sets - A producer / consumer pipeline per query
+A worker thread fetches the next batch of rows from the backend and encodes it (the producer),
+while the session thread sends the previous batch to the client socket (the consumer).
+The batches are handed over through a bounded queue, so at most STREAM_QUEUE_DEPTH encoded batches
+are held in memory, and a slow client stalls the backend fetch instead of buffering the whole result.
+
+Results which fit a single batch are not streamed - They are sent with the rest of the response, with no thread.
+
+Batch sizes are tuned per query :
+    * Backend fetch size (BatchSizer) - Starts small (fast first rows), and doubles the batch bytes as long as it improves
+      the backend fetch rate (amortizing the per fetch latency). Rows per fetch follow the observed encoded row width,
+      so wide and narrow tables get batches of similar size in bytes.
+    * Socket flush threshold - Batches waiting in the queue are coalesced to a single send, up to the bytes the socket
+      drains in STREAM_TARGET_FLUSH_SECONDS at the observed send rate.
+    Both are capped so a session holds at most about STREAM_MAX_BUFFER_BYTES of encoded batches.
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import time
+import queue
+import threading
+
+from pg_buffers import release_output_buffers
+
+# ***********************************************
+# * Constants
+# ***********************************************
+STREAM_QUEUE_DEPTH   = 2            # Encoded batches waiting to be sent - Double buffering
+STREAM_MAX_BUFFER_BYTES = 16 * 1024 * 1024                                      # Per session - Queued, produced and coalesced batches
+STREAM_MAX_BATCH_BYTES  = STREAM_MAX_BUFFER_BYTES // (STREAM_QUEUE_DEPTH + 3)
+
+STREAM_INITIAL_FETCH_ROWS   = 1000      # First batch of a query - Also the largest result sent without streaming
+STREAM_MIN_FETCH_ROWS       = 100
+STREAM_MAX_FETCH_ROWS       = 100000
+STREAM_INITIAL_BATCH_BYTES  = 256 * 1024
+STREAM_FETCH_RATE_GAIN      = 1.1       # Keep growing the batches while the fetch rate improves by at least 10%
+STREAM_ROW_WIDTH_WEIGHT     = 0.5       # Exponential moving average weight of the latest row width
+
+STREAM_MIN_FLUSH_BYTES      = 64 * 1024
+STREAM_MAX_FLUSH_BYTES      = STREAM_MAX_BATCH_BYTES
+STREAM_TARGET_FLUSH_SECONDS = 0.01
+STREAM_PUT_TIMEOUT   = 1            # Seconds between producer checks that the consumer is still there
+
+STREAM_END           = None         # Producer -> consumer : No more batches
+
+# ***********************************************
+# * Adaptive batch sizing
+# ***********************************************
+class BatchSizer:
+    """
+    Number of rows to fetch from the backend per batch, tuned during a single query
+    """
+    def __init__(self):
+        self.fetch_rows  = STREAM_INITIAL_FETCH_ROWS
+        self.batch_bytes = STREAM_INITIAL_BATCH_BYTES
+        self.row_width   = None         # Encoded bytes per row
+        self.fetch_rate  = None         # Rows per second of the last batch
+        self.is_growing  = True
+
+    def observe(self, num_of_rows, num_of_bytes, fetch_seconds):
+        """! Tune the next fetch size by a fetched batch
+        @param num_of_rows   Rows in the batch
+        @param num_of_bytes  Encoded batch size
+        @param fetch_seconds Backend fetch time of the batch
+        """
+        if num_of_rows == 0 :
+            return
+
+        row_width = num_of_bytes / num_of_rows
+        self.row_width = row_width if self.row_width is None else \
+                         STREAM_ROW_WIDTH_WEIGHT * row_width + (1 - STREAM_ROW_WIDTH_WEIGHT) * self.row_width
+
+        # Grow the batches while it pays off - The backend per fetch latency is amortized over more rows
+        fetch_rate = num_of_rows / max(fetch_seconds, 1e-6)
+        if self.is_growing and self.fetch_rate is not None and fetch_rate < self.fetch_rate * STREAM_FETCH_RATE_GAIN :
+            self.is_growing = False
+        self.fetch_rate = fetch_rate
+        if self.is_growing :
+            self.batch_bytes = min(self.batch_bytes * 2, STREAM_MAX_BATCH_BYTES)
+
+        self.fetch_rows = int(min(max(self.batch_bytes / max(self.row_width, 1), STREAM_MIN_FETCH_ROWS), STREAM_MAX_FETCH_ROWS))
+
+class BatchEncoder:
+    """
+    Encodes the fetched batches in the calling thread, and tunes the batch sizes by them.
+    ParallelBatchEncoder (see pg_parallel) has the same interface, encoding in worker processes.
+    """
+    def __init__(self, encode_cols, batch_sizer):
+        self.encode_cols = encode_cols
+        self.batch_sizer = batch_sizer
+
+    def encode(self, cols, num_of_rows, fetch_seconds):
+        """! Encode a fetched batch
+        @param cols          column batches
+        @param num_of_rows   Rows in the batch
+        @param fetch_seconds Backend fetch time of the batch
+        @return list of encoded batches ready to be sent, in order
+        """
+        if num_of_rows == 0 :
+            return []
+        msg = self.encode_cols(cols)
+        self.batch_sizer.observe(num_of_rows, len(msg), fetch_seconds)
+        return [msg]
+
+    def flush(self):
+        """! @return list of the encoded batches not returned yet, in order
+        """
+        return []
+
+    def close(self):
+        pass
+
+def get_flush_bytes(send_rate) :
+    """! Socket flush threshold - The bytes sent in STREAM_TARGET_FLUSH_SECONDS at the observed send rate (bytes per second)
+    """
+    return int(min(max(send_rate * STREAM_TARGET_FLUSH_SECONDS, STREAM_MIN_FLUSH_BYTES), STREAM_MAX_FLUSH_BYTES))
+
+# ***********************************************
+# * Streaming pipeline
+# ***********************************************
+class StreamProducer(threading.Thread):
+    """
+    Runs the batches generator (backend fetch + encoding), and queues the encoded batches for the consumer.
+    An exception in the generator is handed to the consumer, to be raised in the session thread.
+    """
+    def __init__(self, batches, batches_queue):
+        super().__init__(daemon = True)
+        self.batches       = batches
+        self.batches_queue = batches_queue
+        self.is_stopped    = threading.Event()
+        self.error         = None
+
+    def run(self):
+        try :
+            for batch in self.batches :
+                if not self.put(batch) :
+                    # The consumer stopped - The batch in hand will not be sent
+                    release_output_buffers([batch])
+                    break
+        except Exception as e :
+            self.error = e
+        finally :
+            # Release the backend resources held by the generator (e.g. close the query cursor)
+            self.batches.close()
+            self.put(STREAM_END)
+
+    def put(self, batch):
+        """! Queue a batch, unless the consumer stopped
+        @return False if the consumer stopped
+        """
+        while not self.is_stopped.is_set() :
+            try :
+                self.batches_queue.put(batch, timeout = STREAM_PUT_TIMEOUT)
+                return True
+            except queue.Full :
+                pass
+        return False
+
+    def stop(self):
+        self.is_stopped.set()
+
+def yield_batches(batches) :
+    """! Yield a list of encoded batches from a stream generator - If the stream is closed meanwhile (e.g. the client
+         went away), the pooled buffers of the batches not yielded yet are released
+    @return generator of packed bytes
+    """
+    for index, batch in enumerate(batches) :
+        try :
+            yield batch
+        except GeneratorExit :
+            release_output_buffers(batches[index + 1 :])
+            raise
+
+def transmit_batches(batches, tx_func) :
+    """! Transmit a list of batches, and release their pooled buffers - Also when the transmission failed
+    """
+    try :
+        tx_func(batches)
+    finally :
+        release_output_buffers(batches)
+
+def drain_queue(batches_queue) :
+    """! Release the pooled buffers of the batches left in the queue of a stopped stream
+    """
+    while True :
+        try :
+            batch = batches_queue.get_nowait()
+        except queue.Empty :
+            return
+        if batch is not STREAM_END :
+            release_output_buffers([batch])
+
+def append_to_stream(batches, last_batch) :
+    """! A stream of batches, followed by one more batch (e.g. ReadyForQuery after the streamed rows)
+    @return generator of packed bytes
+    """
+    yield from batches
+    yield last_batch
+
+def stream_response(batches, tx_func, queue_depth = STREAM_QUEUE_DEPTH) :
+    """! Send a stream of response batches, overlapping their production (backend fetch + encoding) with their transmission
+    @param batches     generator of packed bytes - The response batches, in order
+    @param tx_func     Called with a list of batches to transmit - Batches waiting in the queue are coalesced to a single
+                       (scatter-gather) write, up to the flush threshold. Pooled batch buffers are released once it returns
+                       (or raises - e.g. the client closed the connection).
+    @param queue_depth Maximum number of batches produced ahead of the transmission
+
+    @return Total number of bytes transmitted
+    """
+    batches_queue = queue.Queue(maxsize = queue_depth)
+    producer = StreamProducer(batches, batches_queue)
+    producer.start()
+
+    num_of_bytes = 0
+    flush_bytes  = STREAM_MIN_FLUSH_BYTES
+    pending_batches = []
+    pending_bytes   = 0
+    try :
+        while True :
+            batch = batches_queue.get()
+            if batch is not STREAM_END :
+                pending_batches.append(batch)
+                pending_bytes += len(batch)
+                # Coalesce with the next batch if it is ready already, and the flush threshold was not reached
+                if pending_bytes < flush_bytes and not batches_queue.empty() :
+                    continue
+
+            if pending_bytes > 0 :
+                tx_start = time.perf_counter()
+                tx_batches, pending_batches = pending_batches, []
+                transmit_batches(tx_batches, tx_func)
+                flush_bytes = get_flush_bytes(pending_bytes / max(time.perf_counter() - tx_start, 1e-6))
+                num_of_bytes += pending_bytes
+                pending_bytes   = 0
+
+            if batch is STREAM_END :
+                break
+    finally :
+        # Transmission failed (e.g. the client closed the connection) - Let the producer give up,
+        # and release the batches which will not be sent
+        producer.stop()
+        producer.join()
+        release_output_buffers(pending_batches)
+        drain_queue(batches_queue)
+
+    if producer.error is not None :
+        raise producer.error
+
+    return num_of_bytes
@@ -0,0 +1,484 @@
+#!/usr/bin/python3
+"""
+SQream to Postgres types mapping, and the columns values codecs
+Maps the SQream column types (cursor metadata and GET_DDL type names) to Postgres types,
+and encodes column values to their Postgres wire representation, in text or binary format.
+
+Two encoders flavours, by (Type OID, Format code) :
+    * COL_ENCODERS       : Single value -> bytes
+    * COL_BATCH_ENCODERS : Column of values -> list of DataRow fields (Int32 length + value bytes).
+                           Used for result sets - The encoder is looked up once per column, and fixed width
+                           binary types are packed with a precompiled struct, together with their length.
+                           Batch encoders assume no NULL values (NOT NULL columns). Nullable columns wrap them
+                           with a NULL bitmap - Only the non NULL values are encoded.
+
+Postgres binary formats : https://github.com/postgres/postgres/tree/master/src/backend/utils/adt (*_send functions)
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import re
+import sys
+import math
+import array
+import struct
+import decimal
+import datetime
+
+from sqream_backend import  COL_FORMAT_TEXT,                    \
+                            COL_FORMAT_BINARY,                  \
+                            SQREAM_TYPE_BOOL,                   \
+                            SQREAM_TYPE_TINYINT,                \
+                            SQREAM_TYPE_SMALLINT,               \
+                            SQREAM_TYPE_INT,                    \
+                            SQREAM_TYPE_BIGINT,                 \
+                            SQREAM_TYPE_REAL,                   \
+                            SQREAM_TYPE_DOUBLE,                 \
+                            SQREAM_TYPE_NUMERIC,                \
+                            SQREAM_TYPE_DATE,                   \
+                            SQREAM_TYPE_DATETIME,               \
+                            SQREAM_TYPE_VARCHAR,                \
+                            SQREAM_TYPE_TEXT,                   \
+                            TextBuffer
+
+# ***********************************************
+# * Constants
+# ***********************************************
+# Postgres Column types - https://github.com/postgres/postgres/blob/master/src/include/catalog/pg_type.dat
+COL_BOOL_TYPE_OID       = 16
+COL_CHAR_TYPE_OID       = 18
+COL_TEXT_TYPE_OID       = 19        # name
+COL_BIGINT_TYPE_OID     = 20
+COL_SMALLINT_TYPE_OID   = 21
+COL_INT_TYPE_OID        = 23
+COL_TEXT_TYPE_3_OID     = 25        # text
+COL_LONG_INT_TYPE_OID   = 26        # oid
+COL_REAL_TYPE_OID       = 700
+COL_DOUBLE_TYPE_OID     = 701
+COL_TEXT_TYPE_2_OID     = 1043      # varchar
+COL_DATE_TYPE_OID       = 1082
+COL_TIMESTAMP_TYPE_OID  = 1114
+COL_NUMERIC_TYPE_OID    = 1700
+
+VARIABLE_LENGTH = -1                # pg_type.typlen of variable width types
+
+# SQream cursor column type -> (Postgres type OID, Postgres type length)
+SQREAM_TO_PG_TYPES = {SQREAM_TYPE_BOOL     : (COL_BOOL_TYPE_OID,       1),
+                      SQREAM_TYPE_TINYINT  : (COL_SMALLINT_TYPE_OID,   2),     # Postgres has no single byte integer
+                      SQREAM_TYPE_SMALLINT : (COL_SMALLINT_TYPE_OID,   2),
+                      SQREAM_TYPE_INT      : (COL_INT_TYPE_OID,        4),
+                      SQREAM_TYPE_BIGINT   : (COL_BIGINT_TYPE_OID,     8),
+                      SQREAM_TYPE_REAL     : (COL_REAL_TYPE_OID,       4),
+                      SQREAM_TYPE_DOUBLE   : (COL_DOUBLE_TYPE_OID,     8),
+                      SQREAM_TYPE_NUMERIC  : (COL_NUMERIC_TYPE_OID,    VARIABLE_LENGTH),
+                      SQREAM_TYPE_DATE     : (COL_DATE_TYPE_OID,       4),
+                      SQREAM_TYPE_DATETIME : (COL_TIMESTAMP_TYPE_OID,  8),
+                      SQREAM_TYPE_VARCHAR  : (COL_TEXT_TYPE_2_OID,     VARIABLE_LENGTH),
+                      SQREAM_TYPE_TEXT     : (COL_TEXT_TYPE_3_OID,     VARIABLE_LENGTH)}
+
+# SQream DDL type name (GET_DDL) -> Postgres information_schema data type name
+SQREAM_DDL_TYPE_REG_EXPR = r"^\s*(\w+)"
+SQREAM_DDL_TO_PG_DATA_TYPES = {"bool"     : "boolean",
+                               "tinyint"  : "smallint",
+                               "smallint" : "smallint",
+                               "int"      : "integer",
+                               "bigint"   : "bigint",
+                               "real"     : "real",
+                               "float"    : "double precision",
+                               "double"   : "double precision",
+                               "numeric"  : "numeric",
+                               "decimal"  : "numeric",
+                               "date"     : "date",
+                               "datetime" : "timestamp without time zone",
+                               "timestamp": "timestamp without time zone",
+                               "varchar"  : "character varying",
+                               "nvarchar" : "character varying",
+                               "text"     : "text"}
+
+# Binary date / timestamp - Days / microseconds since the Postgres epoch
+PG_EPOCH_ORDINAL     = datetime.date(2000, 1, 1).toordinal()
+SECONDS_PER_DAY      = 24 * 60 * 60
+USECS_PER_SEC        = 1000000
+
+# Binary numeric
+NUMERIC_BASE_DIGITS  = 4            # Decimal digits per base 10000 digit
+NUMERIC_POS          = 0x0000
+NUMERIC_NEG          = 0x4000
+NUMERIC_NAN          = 0xC000
+NUMERIC_PINF         = 0xD000
+NUMERIC_NINF         = 0xF000
+NUMERIC_HEADER       = struct.Struct("!hhHh")   # Number of digits / Weight / Sign / Display scale
+
+FIELD_LENGTH         = struct.Struct("!i")      # DataRow field length
+NULL_FIELD           = FIELD_LENGTH.pack(-1)    # DataRow NULL field - Length -1, no value bytes
+
+# ***********************************************
+# * Types mapping
+# ***********************************************
+def sqream_to_pg_type(sqream_type) :
+    """! Postgres type of a SQream cursor column type
+    @param sqream_type SQream type (e.g. 'ftInt')
+
+    @return tuple (Postgres type OID, Postgres type length)
+    """
+    pg_type = SQREAM_TO_PG_TYPES.get(sqream_type)
+    if pg_type is None :
+        raise ValueError(f"Unsupported type {sqream_type}")
+    return pg_type
+
+def sqream_ddl_to_pg_data_type(ddl_type) :
+    """! Postgres information_schema data type name of a SQream DDL column type
+    @param ddl_type SQream DDL type (e.g. 'nvarchar(20)')
+
+    @return Postgres data type name (e.g. 'character varying')
+    """
+    type_name = re.findall(SQREAM_DDL_TYPE_REG_EXPR, ddl_type)
+    pg_data_type = SQREAM_DDL_TO_PG_DATA_TYPES.get(type_name[0].lower()) if len(type_name) > 0 else None
+    if pg_data_type is None :
+        raise ValueError(f"Unsupported type {ddl_type}")
+    return pg_data_type
+
+# ***********************************************
+# * Single value encoders
+# ***********************************************
+def encode_text(val) :
+    """! Text format of a column value (also the binary format of character types)
+    """
+    return bytes(str(val), "utf-8")
+
+def encode_bool_text(val) :
+    return b't' if val else b'f'
+
+def encode_float_text(val) :
+    if math.isnan(val) :
+        return b'NaN'
+    if math.isinf(val) :
+        return b'Infinity' if val > 0 else b'-Infinity'
+    return encode_text(val)
+
+FLOAT4     = struct.Struct("!f")
+FLOAT4_MIN = 1.1754943508222875e-38    # Smallest normal float4 - Subnormals carry fewer significant digits
+
+def encode_real_text(val) :
+    """! Text format of a real (float4) value - The shortest decimal which reads back as the same float4, as float4out.
+         The backend hands float4 values over as Python floats, whose str() shows the float8 digits (0.1 -> 0.10000000149011612).
+         Decimals of up to 6 significant digits round-trip normal float4 values (FLT_DIG), so the search starts there. 9 always round-trip.
+    """
+    if math.isnan(val) or math.isinf(val) :
+        return encode_float_text(val)
+    packed = FLOAT4.pack(val)
+    for precision in range(6 if abs(val) >= FLOAT4_MIN else 1, 10) :
+        shortest = float("{:.{}g}".format(val, precision))
+        if FLOAT4.pack(shortest) == packed :
+            break
+    return encode_text(shortest)
+
+def encode_numeric_text(val) :
+    """! Text format of a numeric (decimal.Decimal / int) value - Positional notation, as numeric_out.
+         str(Decimal) uses exponent notation for small / large exponents (e.g. 1E-8, 1E+3), which Postgres never sends.
+    """
+    if not isinstance(val, decimal.Decimal) :
+        return encode_text(val)
+    if val.is_nan() :
+        return b'NaN'
+    if val.is_infinite() :
+        return b'Infinity' if val > 0 else b'-Infinity'
+    if val.is_zero() :
+        val = abs(val)
+    return bytes(format(val, 'f'), "utf-8")
+
+def encode_timestamp_text(val) :
+    return bytes(val.isoformat(sep = ' '), "utf-8")
+
+def date_to_pg_days(val) :
+    return val.toordinal() - PG_EPOCH_ORDINAL
+
+def timestamp_to_pg_usecs(val) :
+    return ((val.toordinal() - PG_EPOCH_ORDINAL) * SECONDS_PER_DAY + \
+            val.hour * 3600 + val.minute * 60 + val.second) * USECS_PER_SEC + val.microsecond
+
+def encode_numeric_binary(val) :
+    """! Binary format of a numeric (decimal.Decimal / int) value :
+         Header, followed by base 10000 digits (see numeric_send)
+    """
+    sign, digits, exponent = val.as_tuple() if hasattr(val, "as_tuple") else (int(val < 0), tuple(int(digit) for digit in str(abs(val))), 0)
+    if exponent in ('n', 'N') :
+        return NUMERIC_HEADER.pack(0, 0, NUMERIC_NAN, 0)
+    if exponent == 'F' :
+        return NUMERIC_HEADER.pack(0, 0, NUMERIC_NINF if sign else NUMERIC_PINF, 0)
+
+    display_scale = max(0, -exponent)
+    digits_str = "".join(str(digit) for digit in digits)
+    if exponent > 0 :
+        digits_str += "0" * exponent
+        exponent = 0
+
+    # Align the decimal point to a base 10000 digit boundary
+    num_of_int_digits = len(digits_str) + exponent
+    left_pad  = (-num_of_int_digits) % NUMERIC_BASE_DIGITS
+    right_pad = (exponent) % NUMERIC_BASE_DIGITS
+    digits_str = "0" * left_pad + digits_str + "0" * right_pad
+    base_digits = [int(digits_str[i : i + NUMERIC_BASE_DIGITS]) for i in range(0, len(digits_str), NUMERIC_BASE_DIGITS)]
+    weight = (num_of_int_digits + left_pad) // NUMERIC_BASE_DIGITS - 1
+
+    # Strip leading and trailing zero digits
+    while len(base_digits) > 0 and base_digits[0] == 0 :
+        base_digits.pop(0)
+        weight -= 1
+    while len(base_digits) > 0 and base_digits[-1] == 0 :
+        base_digits.pop()
+    if len(base_digits) == 0 :
+        weight = 0
+        sign = 0
+
+    return NUMERIC_HEADER.pack(len(base_digits), weight, NUMERIC_NEG if sign else NUMERIC_POS, display_scale) + \
+           struct.pack("!{}H".format(len(base_digits)), *base_digits)
+
+COL_ENCODERS = {(COL_BOOL_TYPE_OID,      COL_FORMAT_TEXT)   : encode_bool_text,
+                (COL_BOOL_TYPE_OID,      COL_FORMAT_BINARY) : struct.Struct("!?").pack,
+                (COL_SMALLINT_TYPE_OID,  COL_FORMAT_TEXT)   : encode_text,
+                (COL_SMALLINT_TYPE_OID,  COL_FORMAT_BINARY) : struct.Struct("!h").pack,
+                (COL_INT_TYPE_OID,       COL_FORMAT_TEXT)   : encode_text,
+                (COL_INT_TYPE_OID,       COL_FORMAT_BINARY) : struct.Struct("!i").pack,
+                (COL_BIGINT_TYPE_OID,    COL_FORMAT_TEXT)   : encode_text,
+                (COL_BIGINT_TYPE_OID,    COL_FORMAT_BINARY) : struct.Struct("!q").pack,
+                (COL_LONG_INT_TYPE_OID,  COL_FORMAT_TEXT)   : encode_text,
+                (COL_LONG_INT_TYPE_OID,  COL_FORMAT_BINARY) : struct.Struct("!I").pack,
+                (COL_REAL_TYPE_OID,      COL_FORMAT_TEXT)   : encode_real_text,
+                (COL_REAL_TYPE_OID,      COL_FORMAT_BINARY) : FLOAT4.pack,
+                (COL_DOUBLE_TYPE_OID,    COL_FORMAT_TEXT)   : encode_float_text,
+                (COL_DOUBLE_TYPE_OID,    COL_FORMAT_BINARY) : struct.Struct("!d").pack,
+                (COL_NUMERIC_TYPE_OID,   COL_FORMAT_TEXT)   : encode_numeric_text,
+                (COL_NUMERIC_TYPE_OID,   COL_FORMAT_BINARY) : encode_numeric_binary,
+                (COL_DATE_TYPE_OID,      COL_FORMAT_TEXT)   : encode_text,
+                (COL_DATE_TYPE_OID,      COL_FORMAT_BINARY) : lambda val : struct.pack("!i", date_to_pg_days(val)),
+                (COL_TIMESTAMP_TYPE_OID, COL_FORMAT_TEXT)   : encode_timestamp_text,
+                (COL_TIMESTAMP_TYPE_OID, COL_FORMAT_BINARY) : lambda val : struct.pack("!q", timestamp_to_pg_usecs(val))}
+
+# Character types : the binary representation is the text itself
+for char_type_oid in (COL_TEXT_TYPE_OID, COL_TEXT_TYPE_2_OID, COL_TEXT_TYPE_3_OID, COL_CHAR_TYPE_OID) :
+    COL_ENCODERS[(char_type_oid, COL_FORMAT_TEXT)]   = encode_text
+    COL_ENCODERS[(char_type_oid, COL_FORMAT_BINARY)] = encode_text
+
+def get_col_encoder(type_oid, col_format) :
+    """! Get the encoder of a column value to its wire representation
+    @param type_oid   Postgres type OID
+    @param col_format COL_FORMAT_TEXT / COL_FORMAT_BINARY
+
+    @return function (value) -> bytes
+    """
+    encoder = COL_ENCODERS.get((type_oid, col_format))
+    if encoder is None :
+        raise ValueError("Unsupported serialize type : {} {}".format(type_oid, col_format))
+    return encoder
+
+# ***********************************************
+# * Batch encoders - Column of values to DataRow fields
+# ***********************************************
+# array.array typecode of each struct format of a fixed width binary type
+STRUCT_FORMAT_ARRAY_TYPECODES = {"?" : "B", "h" : "h", "i" : "i", "q" : "q", "I" : "I", "f" : "f", "d" : "d"}
+
+class FixedWidthFields:
+    """
+    Column of fixed width DataRow fields, packed back to back in a single buffer.
+    Iterating it yields the fields, so it can be used wherever a list of fields is expected.
+    """
+    def __init__(self, buffer, field_size):
+        self.buffer     = buffer
+        self.field_size = field_size
+
+    def __len__(self):
+        return len(self.buffer) // self.field_size
+
+    def __iter__(self):
+        buffer, field_size = self.buffer, self.field_size
+        return (buffer[offset : offset + field_size] for offset in range(0, len(buffer), field_size))
+
+def pack_fixed_width_array(values, value_format) :
+    """! Pack an array.array of a fixed width type to DataRow fields, without a Python object per value :
+         The values are converted to network byte order as a whole, and interleaved with the fields lengths
+         by strided slice assignments - One per byte of the field, for the whole column.
+    @return FixedWidthFields
+    """
+    typecode = STRUCT_FORMAT_ARRAY_TYPECODES[value_format]
+    if values.typecode != typecode or sys.byteorder == "little" :
+        values = array.array(typecode, values)
+    if sys.byteorder == "little" :
+        values.byteswap()
+    value_size = values.itemsize
+    field_size = FIELD_LENGTH.size + value_size
+    num_of_values = len(values)
+
+    raw = values.tobytes()
+    buffer = bytearray(num_of_values * field_size)
+    for index, length_byte in enumerate(FIELD_LENGTH.pack(value_size)) :
+        buffer[index : : field_size] = bytes((length_byte,)) * num_of_values
+    for index in range(value_size) :
+        buffer[FIELD_LENGTH.size + index : : field_size] = raw[index : : value_size]
+    return FixedWidthFields(bytes(buffer), field_size)
+
+def fixed_width_batch_encoder(value_format) :
+    """! Batch encoder of a fixed width binary type - Length and value are packed together
+    @param value_format struct format of a single value (e.g. "q")
+    """
+    field = struct.Struct("!i" + value_format)
+    field_len = field.size - FIELD_LENGTH.size
+    def batch_encoder(values) :
+        if isinstance(values, array.array) :
+            return pack_fixed_width_array(values, value_format)
+        return [field.pack(field_len, val) for val in values]
+    return batch_encoder
+
+def encode_text_batch(values) :
+    """! Character types (text and binary formats) - Fields are sliced from a TextBuffer, without decoding its values
+    """
+    pack_len = FIELD_LENGTH.pack
+    if isinstance(values, TextBuffer) :
+        data, offsets = values.data, values.offsets
+        return [pack_len(end - start) + data[start : end] for start, end in zip(offsets, offsets[1:])]
+    return [pack_len(len(encoded)) + encoded for encoded in map(encode_text, values)]
+
+def single_value_batch_encoder(encoder) :
+    """! Batch encoder of a variable width type, based on its single value encoder
+    """
+    pack_len = FIELD_LENGTH.pack
+    def batch_encoder(values) :
+        fields = []
+        for encoded in map(encoder, values) :
+            fields.append(pack_len(len(encoded)) + encoded)
+        return fields
+    return batch_encoder
+
+def encode_date_binary_batch(values) :
+    """! Binary dates - Days since 2000-01-01
+    """
+    field = struct.Struct("!ii")
+    epoch = PG_EPOCH_ORDINAL
+    return [field.pack(4, val.toordinal() - epoch) for val in values]
+
+def encode_timestamp_binary_batch(values) :
+    """! Binary timestamps (without time zone) - Microseconds since 2000-01-01 00:00:00
+    """
+    field = struct.Struct("!iq")
+    epoch = PG_EPOCH_ORDINAL
+    return [field.pack(8, ((val.toordinal() - epoch) * SECONDS_PER_DAY + val.hour * 3600 + val.minute * 60 + val.second) * USECS_PER_SEC + val.microsecond)
+            for val in values]
+
+COL_BATCH_ENCODERS = {(COL_BOOL_TYPE_OID,      COL_FORMAT_BINARY) : fixed_width_batch_encoder("?"),
+                      (COL_SMALLINT_TYPE_OID,  COL_FORMAT_BINARY) : fixed_width_batch_encoder("h"),
+                      (COL_INT_TYPE_OID,       COL_FORMAT_BINARY) : fixed_width_batch_encoder("i"),
+                      (COL_BIGINT_TYPE_OID,    COL_FORMAT_BINARY) : fixed_width_batch_encoder("q"),
+                      (COL_LONG_INT_TYPE_OID,  COL_FORMAT_BINARY) : fixed_width_batch_encoder("I"),
+                      (COL_REAL_TYPE_OID,      COL_FORMAT_BINARY) : fixed_width_batch_encoder("f"),
+                      (COL_DOUBLE_TYPE_OID,    COL_FORMAT_BINARY) : fixed_width_batch_encoder("d"),
+                      (COL_DATE_TYPE_OID,      COL_FORMAT_BINARY) : encode_date_binary_batch,
+                      (COL_TIMESTAMP_TYPE_OID, COL_FORMAT_BINARY) : encode_timestamp_binary_batch}
+
+for char_type_oid in (COL_TEXT_TYPE_OID, COL_TEXT_TYPE_2_OID, COL_TEXT_TYPE_3_OID, COL_CHAR_TYPE_OID) :
+    COL_BATCH_ENCODERS[(char_type_oid, COL_FORMAT_TEXT)]   = encode_text_batch
+    COL_BATCH_ENCODERS[(char_type_oid, COL_FORMAT_BINARY)] = encode_text_batch
+
+# All other types - Based on their single value encoder
+for type_and_format, encoder in COL_ENCODERS.items() :
+    if type_and_format not in COL_BATCH_ENCODERS :
+        COL_BATCH_ENCODERS[type_and_format] = single_value_batch_encoder(encoder)
+
+def nullable_batch_encoder(encoder) :
+    """! Batch encoder of a nullable column, based on the (NOT NULL) batch encoder of its type :
+         A NULL bitmap selects the values to encode, and the NULL fields are merged back in their positions.
+         Column batches of arrays / TextBuffer hold no NULL values.
+    """
+    def batch_encoder(values) :
+        if isinstance(values, (array.array, TextBuffer)) :
+            return encoder(values)
+        is_null = [val is None for val in values]
+        if not any(is_null) :
+            return encoder(values)
+        fields = iter(encoder([val for val in values if val is not None]))
+        return [NULL_FIELD if is_null_val else next(fields) for is_null_val in is_null]
+    return batch_encoder
+
+# Nullable columns batch encoders
+COL_NULLABLE_BATCH_ENCODERS = {type_and_format : nullable_batch_encoder(encoder) for type_and_format, encoder in COL_BATCH_ENCODERS.items()}
+
+def get_col_batch_encoder(type_oid, col_format, is_nullable = True) :
+    """! Get the batch encoder of a column values to DataRow fields
+    @param is_nullable False for NOT NULL columns - Values are encoded without checking for NULL
+
+    @return function (list of values) -> list of fields bytes (Int32 length + value)
+    """
+    encoders = COL_NULLABLE_BATCH_ENCODERS if is_nullable else COL_BATCH_ENCODERS
+    encoder = encoders.get((type_oid, col_format))
+    if encoder is None :
+        raise ValueError("Unsupported serialize type : {} {}".format(type_oid, col_format))
+    return encoder
+
+# *****************************************************
+# * Unit Testing
+# *****************************************************
+def PG_TYPES_UT() :
+    """
+    Encoders unit testing - Known Postgres wire representations, and batch encoders agree with single value encoders
+    """
+    test_vectors = [
+        # Type OID              Value                                               Text                            Binary
+        (COL_BOOL_TYPE_OID,      True,                                               b't',                           b'\x01'),
+        (COL_SMALLINT_TYPE_OID,  -2,                                                 b'-2',                          b'\xff\xfe'),
+        (COL_INT_TYPE_OID,       0,                                                  b'0',                           b'\x00\x00\x00\x00'),
+        (COL_BIGINT_TYPE_OID,    2**40,                                              b'1099511627776',               b'\x00\x00\x01\x00\x00\x00\x00\x00'),
+        (COL_REAL_TYPE_OID,      1.5,                                                b'1.5',                         b'\x3f\xc0\x00\x00'),
+        (COL_REAL_TYPE_OID,      FLOAT4.unpack(FLOAT4.pack(0.1))[0],                 b'0.1',                         b'\x3d\xcc\xcc\xcd'),
+        (COL_REAL_TYPE_OID,      FLOAT4.unpack(FLOAT4.pack(123456789))[0],           b'123456790.0',                 b'\x4c\xeb\x79\xa3'),
+        (COL_REAL_TYPE_OID,      -3.4028234663852886e+38,                            b'-3.4028235e+38',              b'\xff\x7f\xff\xff'),
+        (COL_DOUBLE_TYPE_OID,    float("inf"),                                       b'Infinity',                    b'\x7f\xf0\x00\x00\x00\x00\x00\x00'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("12345.678"),                       b'12345.678',                   b'\x00\x03\x00\x01\x00\x00\x00\x03\x00\x01\x09\x29\x1a\x7c'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("-0.00012"),                        b'-0.00012',                    b'\x00\x02\xff\xff\x40\x00\x00\x05\x00\x01\x07\xd0'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("0.00"),                            b'0.00',                        b'\x00\x00\x00\x00\x00\x00\x00\x02'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("0.00000001"),                      b'0.00000001',                  b'\x00\x01\xff\xfe\x00\x00\x00\x08\x00\x01'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("-1.5E-7"),                         b'-0.00000015',                 b'\x00\x01\xff\xfe\x40\x00\x00\x08\x00\x0f'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("1E+3"),                            b'1000',                        b'\x00\x01\x00\x00\x00\x00\x00\x00\x03\xe8'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("1.2E+9"),                          b'1200000000',                  b'\x00\x01\x00\x02\x00\x00\x00\x00\x00\x0c'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("-0.0"),                            b'0.0',                         b'\x00\x00\x00\x00\x00\x00\x00\x01'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("NaN"),                             b'NaN',                         b'\x00\x00\x00\x00\xc0\x00\x00\x00'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("Infinity"),                        b'Infinity',                    b'\x00\x00\x00\x00\xd0\x00\x00\x00'),
+        (COL_NUMERIC_TYPE_OID,   decimal.Decimal("-Infinity"),                       b'-Infinity',                   b'\x00\x00\x00\x00\xf0\x00\x00\x00'),
+        (COL_DATE_TYPE_OID,      datetime.date(2000, 1, 2),                          b'2000-01-02',                  b'\x00\x00\x00\x01'),
+        (COL_DATE_TYPE_OID,      datetime.date(1999, 12, 31),                        b'1999-12-31',                  b'\xff\xff\xff\xff'),
+        (COL_TIMESTAMP_TYPE_OID, datetime.datetime(2000, 1, 1, 0, 0, 1, 5),          b'2000-01-01 00:00:01.000005',  b'\x00\x00\x00\x00\x00\x0f\x42\x45'),
+        (COL_TEXT_TYPE_2_OID,    "שלום",                                             "שלום".encode("utf-8"),         "שלום".encode("utf-8"))]
+
+    for type_oid, value, text, binary in test_vectors :
+        for col_format, expected in ((COL_FORMAT_TEXT, text), (COL_FORMAT_BINARY, binary)) :
+            encoded = get_col_encoder(type_oid, col_format)(value)
+            assert encoded == expected, f"Type {type_oid} format {col_format} : encoded {value} to {encoded} instead of {expected}"
+            field = FIELD_LENGTH.pack(len(expected)) + expected
+            batch_encoded = get_col_batch_encoder(type_oid, col_format, is_nullable = False)([value, value])
+            assert batch_encoded == [field] * 2, f"Type {type_oid} format {col_format} : batch encoded {value} to {batch_encoded}"
+            batch_encoded = get_col_batch_encoder(type_oid, col_format, is_nullable = True)([None, value, None, value])
+            assert batch_encoded == [NULL_FIELD, field, NULL_FIELD, field], f"Type {type_oid} format {col_format} : batch encoded {value} with NULLs to {batch_encoded}"
+
+    # Column batches - Arrays and text buffers are encoded as their list of values
+    for type_oid, value_format, values in ((COL_BOOL_TYPE_OID, "?", [True, False]), (COL_SMALLINT_TYPE_OID, "h", [-2, 3]),
+                                           (COL_BIGINT_TYPE_OID, "q", [2**40, -1]), (COL_DOUBLE_TYPE_OID, "d", [0.5, -1e300])) :
+        batch_encoder = get_col_batch_encoder(type_oid, COL_FORMAT_BINARY)
+        array_fields = batch_encoder(array.array(STRUCT_FORMAT_ARRAY_TYPECODES[value_format], values))
+        assert isinstance(array_fields, FixedWidthFields) and list(array_fields) == batch_encoder(values), f"Type {type_oid} : array encoded to {list(array_fields)}"
+    text_values = ["a", "", "שלום"]
+    for col_format in (COL_FORMAT_TEXT, COL_FORMAT_BINARY) :
+        batch_encoder = get_col_batch_encoder(COL_TEXT_TYPE_2_OID, col_format)
+        assert batch_encoder(TextBuffer(text_values)) == batch_encoder(text_values), "Text buffer encoding"
+    assert list(TextBuffer(text_values)) == text_values, "Text buffer values"
+
+    for sqream_type in SQREAM_TO_PG_TYPES :
+        type_oid = sqream_to_pg_type(sqream_type)[0]
+        assert (type_oid, COL_FORMAT_TEXT) in COL_ENCODERS and (type_oid, COL_FORMAT_BINARY) in COL_ENCODERS, f"No encoder for {sqream_type}"
+
+    assert sqream_ddl_to_pg_data_type("nvarchar(20)") == "character varying"
+    assert sqream_ddl_to_pg_data_type("bigint") == "bigint"
+
+    print("PG_TYPES_UT : Passed")
+
+
+if __name__ == "__main__" :
+    PG_TYPES_UT()
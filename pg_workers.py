@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+"""
+Multi-process worker mode - Pre-forked server processes sharing the Postgres port
+Serialization is pure Python and CPU bound, so a single server process uses a single core, however many sessions
+are active. In worker mode, N worker processes bind the same port with SO_REUSEPORT (the kernel balances the
+incoming connections between them), each running its own sessions threads, backend connection and output buffers pool.
+
+A supervisor process :
+    * Starts the workers, and restarts a worker which exited - With an increasing delay if it keeps exiting
+      right after its start (e.g. the backend is down), up to WORKERS_MAX_RESTART_DELAY.
+    * Aggregates the metrics the workers report every WORKERS_METRICS_INTERVAL seconds, and logs them.
+      Cumulative metrics (e.g. requests) of exited workers are kept in the totals.
+    * Forwards SIGUSR1 (profiling, see pg_profiler.py) to the workers, and stops them on SIGTERM / SIGINT.
+    * Creates a cancel keys queue per worker - A CancelRequest may reach any worker, which forwards it to the worker
+      of the session (see pg_cancel.py). A restarted worker takes over the queue of its worker index.
+
+Usage : python pg_workers.py  (see the Main Functionality section)
+"""
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import os
+import time
+import queue
+import signal
+import socket
+import threading
+import multiprocessing
+
+from pg_server_proxy import *
+from pg_buffers import POOL__CHECK_OUTS, POOL__REUSES
+from pg_backend_pool import BACKEND_POOL__CONNECTS, BACKEND_POOL__REUSES
+from pg_scheduler import SCHEDULER__QUEUE_SECONDS, SCHEDULER__ADMITTED, QUERY_CLASSES
+from pg_cancel import CANCEL_KEY_MAX_WORKERS
+
+# ***********************************************
+# * Constants
+# ***********************************************
+WORKERS_METRICS_INTERVAL  = 10      # Seconds between two metrics reports of a worker
+WORKERS_POLL_INTERVAL     = 1       # Seconds between two supervisor checks of the workers
+WORKERS_MIN_UPTIME        = 10      # Seconds - A worker which exits sooner is restarted with a delay
+WORKERS_MAX_RESTART_DELAY = 60      # Seconds
+WORKERS_STOP_TIMEOUT      = 10      # Seconds for a worker to stop gracefully, before it is killed
+
+# Worker metrics report
+WORKER_REPORT__WORKER_ID = "WORKER_ID"
+WORKER_REPORT__PID       = "PID"
+WORKER_REPORT__METRICS   = "METRICS"
+
+# Aggregated metrics keys, in addition to the server metrics keys (see pg_server_proxy.py)
+WORKERS_METRICS__ALIVE    = "WORKERS_ALIVE"
+WORKERS_METRICS__RESTARTS = "WORKERS_RESTARTS"
+
+# Metrics which count since the worker start - Summed over the exited workers too
+WORKERS_CUMULATIVE_METRICS = (SERVER_METRICS__SESSIONS_TOTAL, SERVER_METRICS__SESSIONS_REJECTED, SERVER_METRICS__REQUESTS,
+                              SERVER_METRICS__BYTES_SENT, POOL__CHECK_OUTS, POOL__REUSES, BACKEND_POOL__CONNECTS,
+                              BACKEND_POOL__REUSES, SCHEDULER__QUEUE_SECONDS) + \
+                             tuple(SCHEDULER__ADMITTED.format(query_class) for query_class in QUERY_CLASSES)
+
+# ***********************************************
+# * Worker process
+# ***********************************************
+def run_worker(worker_id, host, port, capture_dir, metrics_queue, cancel_queues) :
+    """! Worker process main - Serves sessions on the shared port, and reports its metrics until SIGTERM
+    @param metrics_queue multiprocessing.Queue of the worker reports to the supervisor
+    @param cancel_queues multiprocessing.Queue of forwarded cancel keys, per worker id
+    """
+    is_stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame : is_stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)       # Ctrl-C is handled by the supervisor
+
+    with CreatePGServer(host, port, capture_dir, reuse_port = True, worker_index = worker_id, cancel_queues = cancel_queues) as server :
+        install_profiler_signal_handler()
+        server_thread = start_server_thread(server)
+        logging.info("run_worker : Worker %d (pid %d) serving on port %d", worker_id, os.getpid(), port)
+
+        def report() :
+            metrics_queue.put({WORKER_REPORT__WORKER_ID : worker_id,
+                               WORKER_REPORT__PID       : os.getpid(),
+                               WORKER_REPORT__METRICS   : server.get_metrics()})
+
+        while not is_stopping.wait(WORKERS_METRICS_INTERVAL) :
+            report()
+
+        server.shutdown()
+        server_thread.join()
+        report()
+
+# ***********************************************
+# * Supervisor
+# ***********************************************
+class WorkersSupervisor:
+    """
+    Starts the worker processes, restarts the ones that exit, and aggregates their metrics
+    """
+    def __init__(self, host, port, num_of_workers, capture_dir = None):
+        self.host           = host
+        self.port           = port
+        self.num_of_workers = num_of_workers
+        self.capture_dir    = capture_dir
+        self.metrics_queue  = multiprocessing.Queue()
+        self.cancel_queues  = [multiprocessing.Queue() for _ in range(num_of_workers)]
+        self.is_stopping    = threading.Event()
+
+        self.workers        = {}    # Worker id -> multiprocessing.Process
+        self.start_times    = {}    # Worker id -> start time
+        self.restart_delays = {}    # Worker id -> Delay of its next restart (seconds)
+        self.restart_times  = {}    # Worker id -> Time to restart an exited worker
+        self.reports        = {}    # Worker id -> Metrics of its last report
+        self.exited_metrics = {key : 0 for key in WORKERS_CUMULATIVE_METRICS}
+        self.num_of_restarts = 0
+
+    def start_worker(self, worker_id) :
+        worker = multiprocessing.Process(target = run_worker, name = "pg_worker_{}".format(worker_id),
+                                         args = (worker_id, self.host, self.port, self.capture_dir, self.metrics_queue,
+                                                 self.cancel_queues))
+        worker.start()
+        self.workers[worker_id]     = worker
+        self.start_times[worker_id] = time.monotonic()
+
+    def on_worker_exit(self, worker_id) :
+        """! Schedule the restart of an exited worker, and keep its cumulative metrics
+        """
+        worker = self.workers.pop(worker_id)
+        uptime = time.monotonic() - self.start_times[worker_id]
+
+        # Exiting right after the start - Delay the restart, doubling the delay as long as it keeps exiting
+        if uptime < WORKERS_MIN_UPTIME :
+            delay = min(max(self.restart_delays.get(worker_id, 0) * 2, WORKERS_POLL_INTERVAL), WORKERS_MAX_RESTART_DELAY)
+        else :
+            delay = 0
+        self.restart_delays[worker_id] = delay
+        self.restart_times[worker_id]  = time.monotonic() + delay
+        logging.error("WorkersSupervisor : Worker %d (pid %d) exited with code %s after %.1f seconds - Restarting in %d seconds",
+                      worker_id, worker.pid, worker.exitcode, uptime, delay)
+
+        report = self.reports.pop(worker_id, None)
+        if report is not None :
+            for key in WORKERS_CUMULATIVE_METRICS :
+                self.exited_metrics[key] += report.get(key, 0)
+
+    def check_workers(self) :
+        """! Restart the workers which exited, once their restart delay passed
+        """
+        for worker_id, worker in list(self.workers.items()) :
+            if not worker.is_alive() :
+                self.on_worker_exit(worker_id)
+
+        for worker_id, restart_time in list(self.restart_times.items()) :
+            if time.monotonic() >= restart_time :
+                del self.restart_times[worker_id]
+                self.num_of_restarts += 1
+                self.start_worker(worker_id)
+
+    def collect_reports(self) :
+        while True :
+            try :
+                report = self.metrics_queue.get_nowait()
+            except queue.Empty :
+                return
+            # Ignore a late report of an exited worker process
+            worker = self.workers.get(report[WORKER_REPORT__WORKER_ID])
+            if worker is not None and worker.pid == report[WORKER_REPORT__PID] :
+                self.reports[report[WORKER_REPORT__WORKER_ID]] = report[WORKER_REPORT__METRICS]
+
+    def get_metrics(self) :
+        """! Metrics of all the workers - The sum of their last reports
+        @return dictionary of metric key -> value
+        """
+        metrics = dict(self.exited_metrics)
+        for report in self.reports.values() :
+            for key, value in report.items() :
+                metrics[key] = metrics.get(key, 0) + value
+        metrics[WORKERS_METRICS__ALIVE]    = len(self.workers)
+        metrics[WORKERS_METRICS__RESTARTS] = self.num_of_restarts
+        return metrics
+
+    def forward_signal(self, signum) :
+        for worker in self.workers.values() :
+            if worker.is_alive() :
+                os.kill(worker.pid, signum)
+
+    def stop(self) :
+        """! Stop the workers gracefully (SIGTERM), killing the ones which do not stop in time
+        """
+        for worker in self.workers.values() :
+            worker.terminate()
+        deadline = time.monotonic() + WORKERS_STOP_TIMEOUT
+        for worker in self.workers.values() :
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive() :
+                logging.error("WorkersSupervisor : Worker pid %d did not stop - Killing it", worker.pid)
+                worker.kill()
+                worker.join()
+        self.workers = {}
+
+    def run(self) :
+        """! Run the workers until SIGTERM / SIGINT. Must be called from the main thread (signal handlers).
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame : self.is_stopping.set())
+        signal.signal(signal.SIGINT,  lambda signum, frame : self.is_stopping.set())
+        profiler_signum = getattr(signal, "SIGUSR1", None)
+        if profiler_signum is not None :
+            signal.signal(profiler_signum, lambda signum, frame : self.forward_signal(signum))
+
+        for worker_id in range(self.num_of_workers) :
+            self.start_worker(worker_id)
+        logging.info("WorkersSupervisor : Started %d workers on port %d", self.num_of_workers, self.port)
+
+        next_log_time = time.monotonic() + WORKERS_METRICS_INTERVAL
+        try :
+            while not self.is_stopping.wait(WORKERS_POLL_INTERVAL) :
+                self.collect_reports()
+                self.check_workers()
+                if time.monotonic() >= next_log_time :
+                    logging.info("WorkersSupervisor : Metrics %s", self.get_metrics())
+                    next_log_time += WORKERS_METRICS_INTERVAL
+        finally :
+            self.stop()
+            logging.info("WorkersSupervisor : Stopped")
+
+def RunPGWorkers(host, port, num_of_workers = None, capture_dir = None) :
+    """
+    num_of_workers : Number of worker processes (None - One per core)
+    capture_dir    : Directory to record each session traffic to (None - No capture)
+    """
+    if not hasattr(socket, "SO_REUSEPORT") :
+        logging.error("RunPGWorkers : SO_REUSEPORT is not supported on this platform - Running a single server process")
+        RunPGServer(host, port, capture_dir)
+        return
+
+    num_of_workers = num_of_workers or os.cpu_count() or 1
+    if num_of_workers > CANCEL_KEY_MAX_WORKERS :
+        logging.error("RunPGWorkers : Cancel keys support up to %d workers - Running %d workers", CANCEL_KEY_MAX_WORKERS, CANCEL_KEY_MAX_WORKERS)
+        num_of_workers = CANCEL_KEY_MAX_WORKERS
+
+    WorkersSupervisor(host, port, num_of_workers, capture_dir).run()
+
+# *****************************************************
+# * Main Functionality
+# *****************************************************
+if __name__ == "__main__" :
+    PG_PORT = 5432
+    HOST, PORT = "localhost", PG_PORT
+    NUM_OF_WORKERS = None       # None - One worker per core
+    CAPTURE_DIR = None          # e.g. "captures" - Record sessions traffic, for replay with pg_capture.py
+    RunPGWorkers(HOST, PORT, NUM_OF_WORKERS, CAPTURE_DIR)
@@ -7,6 +7,9 @@ According to example in https://pypi.org/project/pysqream/
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+import array
+import itertools
+
 import pysqream
 
 # ***********************************************
@@ -17,14 +20,38 @@ BACKEND_QUERY__DESC_COLS_NAME   = "cols_name"
 BACKEND_QUERY__DESC_COLS_TYPE   = "cols_type"
 BACKEND_QUERY__DESC_COLS_LENGTH = "cols_length"
 BACKEND_QUERY__DESC_COLS_FORMAT = "cols_format"
+BACKEND_QUERY__DESC_COLS_NULLABLE = "cols_nullable"
 
 
 BACKEND_QUERY__RESULT       = "backend_query__result"
+BACKEND_QUERY__CURSOR       = "backend_query__cursor"
+
+FETCH_ALL_ROWS              = 0
 
+SQREAM_TYPE_BOOL            = 'ftBool'
+SQREAM_TYPE_TINYINT         = 'ftUByte'
+SQREAM_TYPE_SMALLINT        = 'ftShort'
 SQREAM_TYPE_INT             = 'ftInt'
-SQREAM_TYPE_TEXT            = 'ftBlob'
+SQREAM_TYPE_BIGINT          = 'ftLong'
+SQREAM_TYPE_REAL            = 'ftFloat'
+SQREAM_TYPE_DOUBLE          = 'ftDouble'
+SQREAM_TYPE_NUMERIC         = 'ftNumeric'
+SQREAM_TYPE_DATE            = 'ftDate'
+SQREAM_TYPE_DATETIME        = 'ftDateTime'
+SQREAM_TYPE_VARCHAR         = 'ftVarchar'
+SQREAM_TYPE_TEXT            = 'ftBlob'          # nvarchar / text
 SQREAM_COL_NOT_NULLABLE     = 'not null'
 
+# Column batches (fetch_cols) : array.array typecodes of the fixed width types, and the types held in a TextBuffer
+SQREAM_TYPE_ARRAY_TYPECODES = {SQREAM_TYPE_BOOL     : 'B',
+                               SQREAM_TYPE_TINYINT  : 'B',
+                               SQREAM_TYPE_SMALLINT : 'h',
+                               SQREAM_TYPE_INT      : 'i',
+                               SQREAM_TYPE_BIGINT   : 'q',
+                               SQREAM_TYPE_REAL     : 'f',
+                               SQREAM_TYPE_DOUBLE   : 'd'}
+SQREAM_TEXT_TYPES           = (SQREAM_TYPE_VARCHAR, SQREAM_TYPE_TEXT)
+
 SQREAM_CATALOG_TABLES_QUERY  = "SELECT * FROM sqream_catalog.tables"
 SQREAM_CATALOG_COLS_QUERY    = "SELECT GET_DDL('{tbl}')"
 SQREAM_CATALOG_SCHEMA_NAME   = 'schema_name'
@@ -51,37 +78,135 @@ def get_db(host, port, database, username, password) :
     con = pysqream.connect( host, port,database, username, password)
     return con
 
-def execute_query (connection, query) :
+def open_query (connection, query) :
     """
-    Execute a simple query on Sqream DB 
+    Execute a query on Sqream DB, leaving the result on the cursor to be fetched incrementally (fetch_rows)
+    The cursor is closed if the query fails
     """
     cur = connection.cursor()
 
     logging.info("Executing query: \"{}\"".format(query))
-    cur.execute(query)
-
-    # logging.debug("get_db : Column names {}".format(str(cur.col_names)))
-    # logging.debug("get_db : Column types {}".format(str(cur.description)))
-
-    result = cur.fetchall()
-
-    # logging.debug("get_db : Result {}".format(str(result)))
-
-    # Get column type
-    cols_type   = [metadata[0] for metadata in cur.col_type_tups]
-    cols_length = [metadata[1] for metadata in cur.col_type_tups]
-    cols_name   = [metadata[0] for metadata in cur.description]
+    try :
+        cur.execute(query)
+
+        # logging.debug("get_db : Column names {}".format(str(cur.col_names)))
+        # logging.debug("get_db : Column types {}".format(str(cur.description)))
+
+        # Get column type
+        cols_type   = [metadata[0] for metadata in cur.col_type_tups]
+        cols_length = [metadata[1] for metadata in cur.col_type_tups]
+        cols_name   = [metadata[0] for metadata in cur.description]
+        cols_nullable = list(cur.col_nul)
+    except Exception :
+        close_query(cur)
+        raise
     
     num_of_cols = len(cols_type)
-    cols_format = [COL_FORMAT_BINARY for i in range(num_of_cols)] # Hard coded - All columns are in Text format
+    cols_format = [COL_FORMAT_TEXT for i in range(num_of_cols)]   # Default format - Extended query protocol clients choose theirs in the Bind message
 
-    assert num_of_cols == len(cols_type) == len(cols_length) == len(cols_name), "Wrong number of column attributes"
+    assert num_of_cols == len(cols_type) == len(cols_length) == len(cols_name) == len(cols_nullable), "Wrong number of column attributes"
 
     return {BACKEND_QUERY__DESCRIPTION : {BACKEND_QUERY__DESC_COLS_NAME   : cols_name,
                                           BACKEND_QUERY__DESC_COLS_TYPE   : cols_type,
                                           BACKEND_QUERY__DESC_COLS_LENGTH : cols_length,
-                                          BACKEND_QUERY__DESC_COLS_FORMAT : cols_format},
-            BACKEND_QUERY__RESULT      : result}
+                                          BACKEND_QUERY__DESC_COLS_FORMAT : cols_format,
+                                          BACKEND_QUERY__DESC_COLS_NULLABLE : cols_nullable},
+            BACKEND_QUERY__CURSOR      : cur}
+
+def fetch_rows (cursor, num_of_rows = FETCH_ALL_ROWS) :
+    """
+    Fetch the next num_of_rows rows of an open query (all remaining rows if FETCH_ALL_ROWS)
+    """
+    if num_of_rows == FETCH_ALL_ROWS :
+        return cursor.fetchall()
+    return cursor.fetchmany(num_of_rows)
+
+class TextBuffer:
+    """
+    Column batch of text values : The UTF-8 encoded values concatenated in a single buffer, and their offsets in it
+    (value i is data[offsets[i] : offsets[i + 1]]). Iterating it yields the values as strings.
+    """
+    def __init__(self, values):
+        encoded = [val.encode("utf-8") for val in values]
+        self.data    = b"".join(encoded)
+        self.offsets = array.array('q', [0])
+        self.offsets.extend(itertools.accumulate(map(len, encoded)))
+
+    @classmethod
+    def from_buffers(cls, data, offsets):
+        """! A TextBuffer of already encoded values (e.g. received from another process)
+        @param data    bytes of the concatenated UTF-8 values
+        @param offsets array.array('q') of the values offsets, followed by the data length
+        """
+        text_buffer = cls.__new__(cls)
+        text_buffer.data    = data
+        text_buffer.offsets = offsets
+        return text_buffer
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        data, offsets = self.data, self.offsets
+        return (data[start : end].decode("utf-8") for start, end in zip(offsets, offsets[1:]))
+
+def rows_to_cols(rows) :
+    """
+    Transpose a list of rows to a list of column batches (lists of values)
+    """
+    return [list(col_values) for col_values in zip(*rows)]
+
+def get_num_of_col_rows(cols) :
+    return len(cols[0]) if len(cols) > 0 else 0
+
+def fetch_cols (cursor, num_of_rows = FETCH_ALL_ROWS) :
+    """
+    Fetch the next num_of_rows rows of an open query (all remaining rows if FETCH_ALL_ROWS), as column batches :
+        * array.array for fixed width types
+        * TextBuffer for text types
+        * list of values for other types, and for columns with NULL values in the batch
+    pysqream fetches rows - They are transposed once here, and the serializers consume the column batches directly
+    """
+    rows = fetch_rows(cursor, num_of_rows)
+
+    cols = []
+    for col_values, col_type, col_nullable in zip(zip(*rows), (metadata[0] for metadata in cursor.col_type_tups), cursor.col_nul) :
+        has_nulls = col_nullable and None in col_values
+        if has_nulls :
+            cols.append(list(col_values))
+        elif col_type in SQREAM_TYPE_ARRAY_TYPECODES :
+            cols.append(array.array(SQREAM_TYPE_ARRAY_TYPECODES[col_type], col_values))
+        elif col_type in SQREAM_TEXT_TYPES :
+            cols.append(TextBuffer(col_values))
+        else :
+            cols.append(list(col_values))
+    return cols
+
+def close_query (cursor) :
+    cursor.close()
+
+def abort_query (connection) :
+    """
+    Abort the statement running on a connection, from another thread. pysqream has no statement cancel - 
+    The connection is closed, which ends its statement on the server. The connection can not be used afterwards.
+    """
+    connection.close()
+
+def execute_query (connection, query) :
+    """
+    Execute a simple query on Sqream DB 
+    """
+    query_output = open_query(connection, query)
+    cur = query_output.pop(BACKEND_QUERY__CURSOR)
+
+    result = fetch_rows(cur)
+    close_query(cur)
+
+    # logging.debug("get_db : Result {}".format(str(result)))
+
+    query_output[BACKEND_QUERY__RESULT] = result
+
+    return query_output
 
 def sqream_catalog_tables(connection) :
     """